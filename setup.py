@@ -16,6 +16,7 @@ scripts = [
     'scripts/upho_sf',
     'scripts/upho_qpoints',
     'scripts/upho_fit',
+    'scripts/upho_merge',
 ]
 setup(name='upho',
       version='0.5.6',
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import os
+import shutil
+import tempfile
+import unittest
+import h5py
+import numpy as np
+from upho.phonon.band_hdf5 import (
+    BandHDF5Reader, BackgroundWriter, create_writer, create_group_name,
+    get_format_version, write_header_attribute,
+    FORMAT_VERSION_GROUPS, FORMAT_VERSION_STACKED, MAX_IRREPS)
+from upho.file_io import read_band_hdf5
+
+__author__ = 'Yuji Ikeda'
+
+
+def create_data_dict(ipath, ip, narms, nirreps, natoms_p=1, nelms=2, nbands=6):
+    """Create data for one q-point with the same structure as Eigenstates."""
+    rng = np.random.RandomState(100 * ipath + ip)
+    shape_e = (narms, natoms_p, nelms, natoms_p, nelms, nbands)
+    shape_s_e = (narms, nirreps, natoms_p, nelms, natoms_p, nelms, nbands)
+    ir_labels = ['A1', 'E', 'T1', 'T2', 'A2', 'Eg'][:nirreps]
+    ir_labels += ['X{}'.format(i) for i in range(len(ir_labels), nirreps)]
+    return {
+        'point'            : rng.rand(3),
+        'q_star'           : rng.rand(narms, 3),
+        'distance'         : 0.1 * (ipath * 10 + ip),
+        'natoms_primitive' : natoms_p,
+        'elements'         : np.array(['Cu', 'Au'][:nelms], dtype='S'),
+        'num_arms'         : narms,
+        'pointgroup_symbol': np.array('m-3m', dtype='S'),
+        'num_irreps'       : nirreps,
+        'ir_labels'        : np.array(ir_labels, dtype='S'),
+        'frequencies'      : rng.rand(narms, nbands) * 10.0,
+        'weights_t'        : rng.rand(narms, nbands),
+        'weights_e'        : rng.rand(*shape_e) + 1.0j * rng.rand(*shape_e),
+        'weights_s'        : rng.rand(narms, nirreps, nbands),
+        'weights_s_e'      : rng.rand(*shape_s_e) + 0.0j,
+        'weights_e2'       : rng.rand(narms, natoms_p, nelms, nbands),
+    }
+
+
+def write_band_hdf5(filename, layout, npaths=2, npoints=3, **kwargs):
+    paths = np.random.rand(npaths, npoints, 3)
+    data = {}
+    with h5py.File(filename, 'w') as f:
+        writer = create_writer(f, layout=layout, max_narms=4, **kwargs)
+        writer.write_header(paths)
+        for ipath in range(npaths):
+            for ip in range(npoints):
+                data_dict = create_data_dict(
+                    ipath, ip, narms=1 + (ip % 4), nirreps=1 + (ip + ipath) % 5)
+                writer.write_point(ipath, ip, data_dict)
+                data[ipath, ip] = data_dict
+    return paths, data
+
+
+class TestBandHDF5(unittest.TestCase):
+    def setUp(self):
+        self._root = os.getcwd()
+        self._tmpdir = tempfile.mkdtemp()
+        os.chdir(self._tmpdir)
+
+    def tearDown(self):
+        os.chdir(self._root)
+        shutil.rmtree(self._tmpdir)
+
+    def check_reader(self, layout, **kwargs):
+        paths, data = write_band_hdf5('band.hdf5', layout, **kwargs)
+        with h5py.File('band.hdf5', 'r') as f:
+            reader = BandHDF5Reader(f)
+            self.assertTrue(np.all(reader.get_paths() == paths))
+            for (ipath, ip), data_dict in data.items():
+                group = create_group_name(ipath, ip)
+                for k, v in data_dict.items():
+                    self.assertTrue(np.all(reader.load(group, k) == v), k)
+
+    def test_groups(self):
+        self.check_reader('groups')
+        with h5py.File('band.hdf5', 'r') as f:
+            self.assertEqual(get_format_version(f), FORMAT_VERSION_GROUPS)
+
+    def test_stacked(self):
+        self.check_reader('stacked')
+        with h5py.File('band.hdf5', 'r') as f:
+            self.assertEqual(get_format_version(f), FORMAT_VERSION_STACKED)
+            self.assertEqual(
+                f['weights_s_e'].shape[:4], (2, 3, 4, MAX_IRREPS))
+            self.assertEqual(
+                f['weights_s_e'].chunks[:4], (1, 1, 4, MAX_IRREPS))
+
+    def test_stacked_max_irreps(self):
+        # D_6h (6/mmm) has 12 irreps.
+        paths = np.random.rand(1, 2, 3)
+        data_dict = create_data_dict(0, 1, narms=2, nirreps=12)
+        with h5py.File('band.hdf5', 'w') as f:
+            writer = create_writer(f, layout='stacked', max_narms=4)
+            writer.write_header(paths)
+            writer.write_point(0, 1, data_dict)
+        with h5py.File('band.hdf5', 'r') as f:
+            reader = BandHDF5Reader(f)
+            for k, v in data_dict.items():
+                self.assertTrue(np.all(reader.load('0/1/', k) == v), k)
+
+    def test_stacked_compressed(self):
+        for compression in ['gzip', 'lzf']:
+            self.check_reader('stacked', compression=compression)
+            with h5py.File('band.hdf5', 'r') as f:
+                self.assertEqual(f['weights_t'].compression, compression)
+
+    def check_select(self, layout, is_index=True):
+        paths, data = write_band_hdf5('band.hdf5', layout)
+        with h5py.File('band.hdf5', 'a') as f:
+            if not is_index:
+                del f['index']
+            reader = BandHDF5Reader(f)
+            index = reader.get_index()
+            self.assertTrue(np.allclose(
+                index['distance'],
+                [data[ipath, ip]['distance'] for ipath, ip in sorted(data)]))
+            self.assertEqual(list(index['offset']), list(range(6)))
+            self.assertEqual(reader.select(), [
+                create_group_name(ipath, ip) for ipath, ip in sorted(data)])
+            self.assertEqual(reader.select(ipaths=[1]), ['1/0/', '1/1/', '1/2/'])
+            self.assertEqual(reader.select(ips=slice(1, None)),
+                             ['0/1/', '0/2/', '1/1/', '1/2/'])
+            self.assertEqual(reader.select(ipaths=[0], ips=[0, 2]),
+                             ['0/0/', '0/2/'])
+            self.assertEqual(reader.select(distance_range=(0.15, 1.05)),
+                             ['0/2/', '1/0/'])
+
+    def test_select_groups(self):
+        self.check_select('groups')
+
+    def test_select_stacked(self):
+        self.check_select('stacked')
+
+    def test_select_without_index(self):
+        self.check_select('groups', is_index=False)
+        self.check_select('stacked', is_index=False)
+
+    def check_resume(self, layout):
+        paths = np.random.rand(2, 3, 3)
+        with h5py.File('band.hdf5', 'w') as f:
+            writer = create_writer(f, layout=layout, max_narms=4)
+            writer.write_header(paths)
+            writer.write_point(0, 0, create_data_dict(0, 0, 2, 3))
+            writer.write_point(1, 2, create_data_dict(1, 2, 1, 1))
+
+        with h5py.File('band.hdf5', 'a') as f:
+            writer = create_writer(f, layout=layout, max_narms=4)
+            writer.write_header(paths)
+            for ipath in range(2):
+                for ip in range(3):
+                    expected = (ipath, ip) in [(0, 0), (1, 2)]
+                    self.assertEqual(writer.is_completed(ipath, ip), expected)
+            writer.write_point(0, 1, create_data_dict(0, 1, 3, 2))
+            self.assertTrue(writer.is_completed(0, 1))
+            self.assertTrue(BandHDF5Reader(f).is_completed('0/1/'))
+
+            with self.assertRaises(ValueError):
+                writer.write_header(paths + 1.0)
+
+    def test_resume_groups(self):
+        self.check_resume('groups')
+
+    def test_resume_stacked(self):
+        self.check_resume('stacked')
+
+    def test_header_attribute(self):
+        with h5py.File('band.hdf5', 'w') as f:
+            write_header_attribute(f, 'star', 'sym')
+            write_header_attribute(f, 'outputs', ['band.hdf5', 'sf.hdf5'])
+        with h5py.File('band.hdf5', 'a') as f:
+            # Resuming with the same settings
+            write_header_attribute(f, 'star', 'sym')
+            write_header_attribute(f, 'outputs', ['band.hdf5', 'sf.hdf5'])
+            with self.assertRaises(ValueError):
+                write_header_attribute(f, 'star', 'all')
+            with self.assertRaises(ValueError):
+                write_header_attribute(f, 'outputs', ['band.hdf5'])
+
+    def test_background_writer(self):
+        paths = np.random.rand(2, 3, 3)
+        with h5py.File('band.hdf5', 'w') as f:
+            writer = create_writer(f, layout='stacked', max_narms=4)
+            writer.write_header(paths)
+            with BackgroundWriter(writer, maxsize=1) as background_writer:
+                for ipath in range(2):
+                    for ip in range(3):
+                        background_writer.write_point(
+                            ipath, ip, create_data_dict(ipath, ip, 2, 3))
+            reader = BandHDF5Reader(f)
+            for ipath in range(2):
+                for ip in range(3):
+                    group = create_group_name(ipath, ip)
+                    self.assertTrue(reader.is_completed(group))
+                    expected = create_data_dict(ipath, ip, 2, 3)['weights_s']
+                    self.assertTrue(
+                        np.all(reader.load(group, 'weights_s') == expected))
+
+    def test_background_writer_error(self):
+        with h5py.File('band.hdf5', 'w') as f:
+            writer = create_writer(f, layout='groups')
+            writer.write_header(np.random.rand(1, 2, 3))
+            background_writer = BackgroundWriter(writer, maxsize=1)
+            # Objects cannot be stored in HDF5.
+            background_writer.write_point(0, 0, {'x': object()})
+            with self.assertRaises(TypeError):
+                background_writer.close()
+
+    def test_read_band_hdf5(self):
+        write_band_hdf5('band_groups.hdf5', 'groups')
+        write_band_hdf5('band_stacked.hdf5', 'stacked')
+        band_data_groups = read_band_hdf5('band_groups.hdf5')
+        band_data_stacked = read_band_hdf5('band_stacked.hdf5')
+        for k in ['frequencies', 'weights_s', 'num_arms', 'distance']:
+            v0 = band_data_groups[k]
+            v1 = band_data_stacked[k]
+            v1 = v1[tuple(slice(0, n) for n in v0.shape)]
+            self.assertTrue(np.all(v0 == v1), k)
+
+
+if __name__ == "__main__":
+    unittest.main()
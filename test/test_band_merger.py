@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import os
+import shutil
+import tempfile
+import unittest
+import h5py
+import numpy as np
+from phonopy import Phonopy
+from phonopy.file_IO import parse_FORCE_SETS
+from phonopy.interface.vasp import read_vasp
+from upho.phonon.band_hdf5 import (
+    BandHDF5Reader, create_group_name, mark_completed)
+from upho.phonon.band_merger import BandMerger
+from upho.phonon.single_point import SinglePoint
+from test_band_hdf5 import create_data_dict
+
+__author__ = 'Yuji Ikeda'
+
+
+class TestBandMerger(unittest.TestCase):
+    def setUp(self):
+        self._root = os.getcwd()
+        self._tmpdir = tempfile.mkdtemp()
+        os.chdir(self._tmpdir)
+        self._paths = np.zeros((2, 3, 3))
+        self._data = {}
+        for ipath in range(2):
+            for ip in range(3):
+                group = create_group_name(ipath, ip)
+                os.makedirs(group)
+                data_dict = create_data_dict(ipath, ip, 1 + ip, 2)
+                self.write_shard(group + 'point.hdf5', data_dict)
+                self._data[group] = data_dict
+                self._paths[ipath, ip] = data_dict['point']
+        self.write_band_hdf5()
+
+    def tearDown(self):
+        os.chdir(self._root)
+        shutil.rmtree(self._tmpdir)
+
+    def write_band_hdf5(self):
+        with h5py.File('band.hdf5', 'w') as w:
+            w.create_dataset('paths', data=self._paths)
+            for ipath, path in enumerate(self._paths):
+                for ip in range(len(path)):
+                    group = create_group_name(ipath, ip)
+                    w[group] = h5py.ExternalLink(group + 'point.hdf5', '/')
+
+    def write_shard(self, filename, data_dict, is_completed=True):
+        with h5py.File(filename, 'w') as f:
+            for k, v in data_dict.items():
+                f.create_dataset(k, data=v)
+            if is_completed:
+                mark_completed(f)
+
+    def check_merge(self, layout):
+        BandMerger(filename='band.hdf5', layout=layout).run()
+        shutil.rmtree('0')
+        shutil.rmtree('1')
+        with h5py.File('band.hdf5', 'r') as f:
+            reader = BandHDF5Reader(f)
+            self.assertTrue(np.all(reader.get_paths() == self._paths))
+            for group, data_dict in self._data.items():
+                self.assertTrue(reader.is_completed(group))
+                for k, v in data_dict.items():
+                    self.assertTrue(np.all(reader.load(group, k) == v), k)
+
+    def test_groups(self):
+        self.check_merge('groups')
+
+    def test_stacked(self):
+        self.check_merge('stacked')
+
+    def test_missing(self):
+        os.remove('1/2/point.hdf5')
+        with self.assertRaises(ValueError):
+            BandMerger(filename='band.hdf5').run()
+
+    def test_not_completed(self):
+        self.write_shard(
+            '0/1/point.hdf5', self._data['0/1/'], is_completed=False)
+        with self.assertRaises(ValueError):
+            BandMerger(filename='band.hdf5').run()
+
+    def test_legacy(self):
+        self.write_shard(
+            '0/1/point.hdf5', self._data['0/1/'], is_completed=False)
+        BandMerger(filename='band.hdf5', accepts_legacy=True).run()
+        with h5py.File('band.hdf5', 'r') as f:
+            reader = BandHDF5Reader(f)
+            self.assertTrue(reader.is_completed('0/1/'))
+            for k, v in self._data['0/1/'].items():
+                self.assertTrue(np.all(reader.load('0/1/', k) == v), k)
+
+    def test_legacy_incomplete(self):
+        data_dict = dict(self._data['0/1/'])
+        del data_dict['weights_s_e']
+        self.write_shard('0/1/point.hdf5', data_dict, is_completed=False)
+        with self.assertRaises(ValueError):
+            BandMerger(filename='band.hdf5', accepts_legacy=True).run()
+
+    def test_star(self):
+        dirname = os.path.join(self._root, 'L21_Cu3Au')
+        unitcell = read_vasp(os.path.join(dirname, 'POSCAR'))
+        unitcell_ideal = read_vasp(os.path.join(dirname, 'POSCAR_ideal'))
+        phonon = Phonopy(unitcell, np.diag([2, 2, 2]))
+        phonon.set_displacement_dataset(
+            parse_FORCE_SETS(filename=os.path.join(dirname, 'FORCE_SETS')))
+        phonon.produce_force_constants()
+        primitive_matrix = [[0, 0.5, 0.5], [0.5, 0, 0.5], [0.5, 0.5, 0]]
+
+        # Arms of the stars are mostly different from the q-points.
+        self._paths = np.array([
+            [[0.1, 0.0, 0.0], [0.2, 0.1, 0.0], [0.3, 0.2, 0.1]],
+            [[0.0, 0.0, 0.1], [0.0, 0.1, 0.25], [0.1, 0.25, 0.4]]])
+        self.write_band_hdf5()
+        for ipath, path in enumerate(self._paths):
+            for ip, point in enumerate(path):
+                os.chdir(create_group_name(ipath, ip))
+                SinglePoint(
+                    point, 0.0, phonon.get_dynamical_matrix(),
+                    unitcell_ideal, primitive_matrix, star='sym')
+                os.chdir(self._tmpdir)
+
+        BandMerger(filename='band.hdf5').run()
+        with h5py.File('band.hdf5', 'r') as f:
+            reader = BandHDF5Reader(f)
+            for ipath, path in enumerate(self._paths):
+                for ip, point in enumerate(path):
+                    group = create_group_name(ipath, ip)
+                    self.assertTrue(
+                        np.allclose(reader.load(group, 'point'), point))
+                    self.assertGreater(reader.load(group, 'num_arms'), 1)
+
+    def test_inconsistent(self):
+        data_dict = dict(self._data['1/0/'])
+        data_dict['elements'] = np.array(['Cu', 'Ag'], dtype='S')
+        self.write_shard('1/0/point.hdf5', data_dict)
+        with self.assertRaises(ValueError):
+            BandMerger(filename='band.hdf5').run()
+
+
+if __name__ == "__main__":
+    unittest.main()
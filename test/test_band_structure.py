@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import os
+import shutil
+import tempfile
+import unittest
+import h5py
+import numpy as np
+from phonopy.interface.vasp import read_vasp
+from phonopy.structure.atoms import PhonopyAtoms
+from upho.phonon import band_structure
+from upho.phonon.band_structure import BandStructure
+from upho.phonon.density_extractor import DensityExtractorHDF5
+from upho.phonon.eigenstates import Eigenstates
+from test_band_hdf5 import create_data_dict
+from test_density_extractor import load_sf_hdf5
+
+__author__ = 'Yuji Ikeda'
+
+PRIMITIVE_MATRIX = [[0.0, 0.5, 0.5], [0.5, 0.0, 0.5], [0.5, 0.5, 0.0]]
+
+SPECTRAL_FUNCTIONS = {
+    'function': 'gaussian',
+    'sigma': 0.2,
+    'fmin': -1.0,
+    'fmax': 12.0,
+    'fpitch': 0.1,
+    'is_squared': False,
+}
+
+
+class StubDynamicalMatrix(object):
+    """Dynamical matrix only with the attributes used for unfolding.
+
+    The primitive cell has two atoms for the six bands of
+    "create_data_dict".
+    """
+    def __init__(self):
+        self._primitive = PhonopyAtoms(
+            symbols=['Cu', 'Au'],
+            cell=np.eye(3),
+            scaled_positions=[[0.0, 0.0, 0.0], [0.5, 0.5, 0.5]])
+        self._force_constants = np.random.rand(2, 2, 3, 3)
+
+    def get_primitive(self):
+        return self._primitive
+
+    def is_nac(self):
+        return False
+
+
+class StubEigenstates(object):
+    """Eigenstates whose data are determined by the q-point.
+
+    The data do not depend on the order of the calculations, and therefore
+    they are the same among the processes.
+    """
+    def __init__(self, dynamical_matrix, unitcell_ideal,
+                 primitive_matrix_ideal, mode="eigenvector", star="none",
+                 verbose=False):
+        self._distance = 0.0
+        self._data_dict = None
+
+    def get_max_narms(self):
+        return 4
+
+    def set_distance(self, distance):
+        self._distance = distance
+
+    def extract_eigenstates(self, q):
+        seed = int(np.rint(1000.0 * np.dot(np.mod(q, 1.0), [1.0, 3.0, 7.0])))
+        data_dict = create_data_dict(
+            0, seed, narms=1 + seed % 4, nirreps=1 + seed % 5)
+        data_dict['point'] = np.array(q)
+        data_dict['distance'] = self._distance
+        self._data_dict = data_dict
+
+    def get_data_dict(self):
+        return self._data_dict
+
+
+def load_hdf5(filename):
+    """Load all the datasets and the attributes in the file."""
+    data = {}
+
+    def load(name, obj):
+        if isinstance(obj, h5py.Dataset):
+            data[name] = np.array(obj)
+        for k, v in obj.attrs.items():
+            data[name + '@' + k] = v
+
+    with h5py.File(filename, 'r') as f:
+        load('/', f)
+        f.visititems(load)
+    return data
+
+
+class TestBandStructure(unittest.TestCase):
+    def setUp(self):
+        self._unitcell_ideal = read_vasp('L21_Cu3Au/POSCAR_ideal')
+        self._root = os.getcwd()
+        self._tmpdir = tempfile.mkdtemp()
+        os.chdir(self._tmpdir)
+        self._paths = [
+            np.linspace([0.0, 0.0, 0.0], [0.5, 0.0, 0.0], 5),
+            np.linspace([0.0, 0.0, 0.0], [0.25, 0.25, 0.25], 5),
+        ]
+        band_structure.Eigenstates = StubEigenstates
+
+    def tearDown(self):
+        band_structure.Eigenstates = Eigenstates
+        os.chdir(self._root)
+        shutil.rmtree(self._tmpdir)
+
+    def run_band_structure(self, **kwargs):
+        BandStructure(
+            self._paths,
+            StubDynamicalMatrix(),
+            self._unitcell_ideal,
+            PRIMITIVE_MATRIX,
+            **kwargs)
+
+    def assert_same_data(self, data, data_expected):
+        self.assertEqual(sorted(data.keys()), sorted(data_expected.keys()))
+        for k, v in data_expected.items():
+            self.assertTrue(np.array_equal(data[k], v), k)
+
+    def check_same_band_hdf5(self, kwargs_list):
+        for layout in ['groups', 'stacked']:
+            self.run_band_structure(layout=layout)
+            data = load_hdf5('band.hdf5')
+            for kwargs in kwargs_list:
+                self.run_band_structure(layout=layout, **kwargs)
+                self.assert_same_data(load_hdf5('band.hdf5'), data)
+
+    def test_write_queue_size(self):
+        self.check_same_band_hdf5([{'write_queue_size': 1},
+                                   {'write_queue_size': 2}])
+
+    def test_parallel(self):
+        self.check_same_band_hdf5([{'nprocs': 2},
+                                   {'nprocs': 3, 'write_queue_size': 1}])
+
+    def test_spectral_functions(self):
+        self.run_band_structure(spectral_functions=SPECTRAL_FUNCTIONS)
+        data = load_sf_hdf5('sf.hdf5')
+        self.assertEqual(len(data), 5 * 10)
+
+        DensityExtractorHDF5(filename='band.hdf5', **SPECTRAL_FUNCTIONS)
+        self.assert_same_data(data, load_sf_hdf5('sf.hdf5'))
+
+        for kwargs in [{'nprocs': 2}, {'write_queue_size': 2}]:
+            self.run_band_structure(
+                spectral_functions=SPECTRAL_FUNCTIONS, **kwargs)
+            self.assert_same_data(load_sf_hdf5('sf.hdf5'), data)
+
+    def test_without_weights(self):
+        self.run_band_structure(spectral_functions=SPECTRAL_FUNCTIONS)
+        data = load_sf_hdf5('sf.hdf5')
+        os.remove('band.hdf5')
+
+        self.run_band_structure(
+            spectral_functions=SPECTRAL_FUNCTIONS, write_weights=False)
+        self.assertFalse(os.path.exists('band.hdf5'))
+        self.assert_same_data(load_sf_hdf5('sf.hdf5'), data)
+
+        with self.assertRaises(ValueError):
+            self.run_band_structure(write_weights=False)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import os
+import shutil
+import tempfile
+import unittest
+import h5py
+import numpy as np
+from upho.analysis.smearing import Smearing
+from upho.phonon.density_extractor import (
+    DensityExtractorHDF5, DensityExtractorText)
+from upho.phonon.band_hdf5 import create_writer
+from test_band_hdf5 import create_data_dict, write_band_hdf5
+
+__author__ = 'Yuji Ikeda'
+
+SF_KEYS = [
+    'total_sf',
+    'partial_sf_e',
+    'partial_sf_s',
+    'partial_sf_s_e',
+    'partial_sf_e2',
+]
+
+
+def load_sf_hdf5(filename):
+    data = {}
+    with h5py.File(filename, 'r') as f:
+        npaths, npoints = f['paths'].shape[:2]
+        for ipath in range(npaths):
+            for ip in range(npoints):
+                group = '{}/{}/'.format(ipath, ip)
+                if group not in f:
+                    continue
+                for k in SF_KEYS:
+                    data[group + k] = np.array(f[group + k])
+    return data
+
+
+class TestDensityExtractor(unittest.TestCase):
+    def setUp(self):
+        self._root = os.getcwd()
+        self._tmpdir = tempfile.mkdtemp()
+        os.chdir(self._tmpdir)
+        write_band_hdf5('band.hdf5', 'groups')
+
+    def tearDown(self):
+        os.chdir(self._root)
+        shutil.rmtree(self._tmpdir)
+
+    def run_density_extractor(self, fpitch=0.1, **kwargs):
+        DensityExtractorHDF5(
+            filename='band.hdf5',
+            fmin=-1.0,
+            fmax=12.0,
+            fpitch=fpitch,
+            is_squared=False,
+            **kwargs)
+        return load_sf_hdf5('sf.hdf5')
+
+    def test_multi_sigma(self):
+        sigmas = [0.1, 0.3]
+        data = self.run_density_extractor(sigma=sigmas)
+        with h5py.File('sf.hdf5', 'r') as f:
+            self.assertTrue(np.allclose(f['sigma'], sigmas))
+        for isigma, sigma in enumerate(sigmas):
+            data_single = self.run_density_extractor(sigma=sigma)
+            for k, v in data_single.items():
+                self.assertTrue(np.allclose(data[k][isigma], v), k)
+
+    def test_density_over_arms(self):
+        _, data = write_band_hdf5('band.hdf5', 'groups')
+        data_sf = self.run_density_extractor(sigma=0.2)
+        smearing = Smearing(sigma=0.2, xmin=-1.0, xmax=12.0, xpitch=0.1)
+        for (ipath, ip), data_dict in data.items():
+            group = '{}/{}/'.format(ipath, ip)
+            # Reference summing the contributions from the arms one by one
+            sf = np.sum([
+                smearing.run(f, w) for f, w in zip(
+                    data_dict['frequencies'], data_dict['weights_s_e'])],
+                axis=0)
+            self.assertTrue(np.allclose(data_sf[group + 'partial_sf_s_e'], sf))
+
+    def test_parallel(self):
+        data = self.run_density_extractor(sigma=0.2)
+        data_parallel = self.run_density_extractor(sigma=0.2, nprocs=2)
+        for k, v in data.items():
+            self.assertTrue(np.array_equal(data_parallel[k], v), k)
+
+    def test_text(self):
+        data = self.run_density_extractor(sigma=0.2)
+        DensityExtractorText(
+            filename='band.hdf5', fmin=-1.0, fmax=12.0, fpitch=0.1, sigma=0.2,
+            is_squared=False)
+        # Blocks for q-points are separated by blank lines.
+        data_text = np.loadtxt('sf_E2.dat').reshape(2, 3, -1, 5)
+        for ipath in range(2):
+            for ip in range(3):
+                group = '{}/{}/'.format(ipath, ip)
+                block = data_text[ipath, ip]
+                sf_e2 = np.sum(data[group + 'partial_sf_e2'], axis=1)
+                self.assertTrue(np.allclose(
+                    block[:, 2], data[group + 'total_sf'], atol=1e-6))
+                self.assertTrue(np.allclose(block[:, 3:], sf_e2, atol=1e-6))
+
+    def test_select(self):
+        data = self.run_density_extractor(sigma=0.2)
+        data_selected = self.run_density_extractor(
+            sigma=0.2, ipaths=[1], ips=slice(0, 2))
+        self.assertEqual(
+            sorted(set(k.rsplit('/', 1)[0] for k in data_selected)),
+            ['1/0', '1/1'])
+        for k, v in data_selected.items():
+            self.assertTrue(np.array_equal(data[k], v), k)
+
+    def test_incomplete(self):
+        for layout in ['groups', 'stacked']:
+            with h5py.File('band.hdf5', 'w') as f:
+                writer = create_writer(f, layout=layout, max_narms=4)
+                writer.write_header(np.random.rand(2, 3, 3))
+                for ipath, ip in [(0, 0), (0, 1), (0, 2), (1, 0)]:
+                    writer.write_point(
+                        ipath, ip, create_data_dict(ipath, ip, 2, 3))
+                # Interrupted while writing the data for 1/1/
+                data_dict = create_data_dict(1, 1, 2, 3)
+                writer.write_dataset(
+                    1, 1, 'frequencies', data_dict['frequencies'])
+            data = self.run_density_extractor(sigma=0.2)
+            self.assertEqual(
+                sorted(set(k.rsplit('/', 1)[0] for k in data)),
+                ['0/0', '0/1', '0/2', '1/0'], layout)
+
+    def test_adaptive(self):
+        data = self.run_density_extractor(sigma=0.2, fpitch=0.02)
+        data_adaptive = self.run_density_extractor(
+            sigma=0.2, fpitch_fine=0.02, adaptive_width=3.0)
+        frequencies = np.linspace(-1.0, 12.0, 651)
+        with h5py.File('sf.hdf5', 'r') as f:
+            for group in ['0/0/', '1/2/']:
+                points = np.array(f[group + 'frequencies'])
+                self.assertLess(len(points), len(frequencies))
+                indices = np.rint((points + 1.0) / 0.02).astype(int)
+                self.assertTrue(np.allclose(frequencies[indices], points))
+                for k in SF_KEYS:
+                    self.assertTrue(np.allclose(
+                        data_adaptive[group + k], data[group + k][indices]), k)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import os
+import shutil
+import tempfile
+import unittest
+import h5py
+import numpy as np
+from upho.analysis.smearing import Smearing
+from upho.phonon.dos_unfolding import DosAccumulator, TotalDosUnfolding
+
+__author__ = 'Yuji Ikeda'
+
+
+def create_data_dict(narms, pointgroup_symbol, ir_labels, seed):
+    """Create data like "Eigenstates.get_data_dict" for a q-point."""
+    nbands = 6
+    natoms_p = 1
+    nelms = 2
+    nirreps = len(ir_labels)
+    random = np.random.RandomState(seed)
+    frequencies = random.uniform(0.0, 10.0, (narms, nbands))
+    weights_s = random.uniform(0.0, 1.0, (narms, nirreps, nbands)) / narms
+    weights_t = np.sum(weights_s, axis=1)
+    fractions = random.uniform(0.0, 1.0, (narms, natoms_p, nelms, nbands))
+    fractions /= np.sum(fractions, axis=(1, 2))[:, None, None, :]
+    weights_e2 = weights_t[:, None, None, :] * fractions
+    return {
+        'pointgroup_symbol': np.array(pointgroup_symbol, dtype='S'),
+        'ir_labels': np.array(ir_labels, dtype='S'),
+        'elements': np.array(['Cu', 'Au'], dtype='S'),
+        'frequencies': frequencies,
+        'weights_t': weights_t,
+        'weights_e2': weights_e2,
+        'weights_s': weights_s,
+    }
+
+
+class FakeMesh(object):
+    """Mesh with unfolded weights at random irreducible q-points."""
+    def __init__(self, nqpoints=20, nbands=6, natoms_p=1, nelms=2):
+        random = np.random.RandomState(0)
+        self.frequencies = random.uniform(0.0, 10.0, (nqpoints, nbands))
+        self.weights = random.randint(1, 5, nqpoints)
+        self.weights_e2 = random.uniform(
+            0.0, 1.0, (nqpoints, natoms_p, nelms, nbands))
+        self.pr_weights = np.sum(self.weights_e2, axis=(1, 2))
+
+    def get_frequencies(self):
+        return self.frequencies
+
+    def get_weights(self):
+        return self.weights
+
+    def get_pr_weights(self):
+        return self.pr_weights
+
+
+class TestTotalDosUnfolding(unittest.TestCase):
+    def setUp(self):
+        self._mesh = FakeMesh()
+
+    def create_total_dos(self, **kwargs):
+        total_dos = TotalDosUnfolding(self._mesh, sigma=0.2, **kwargs)
+        total_dos.set_draw_area(-1.0, 12.0, 0.1)
+        return total_dos
+
+    def calculate_dos_at_each_freq(self, total_dos, pr_weights):
+        """Calculate the DOS at one frequency point after another."""
+        weights = self._mesh.weights
+        dos = []
+        for f in total_dos._frequency_points:
+            tmp = total_dos._smearing_function.calc(self._mesh.frequencies - f)
+            tmp *= pr_weights
+            dos.append(np.sum(np.dot(weights, tmp)) / np.sum(weights))
+        return np.array(dos)
+
+    def test_calculate_dos(self):
+        total_dos = self.create_total_dos()
+        dos = self.calculate_dos_at_each_freq(
+            total_dos, self._mesh.pr_weights)
+        self.assertTrue(np.allclose(
+            total_dos.calculate_dos(self._mesh.pr_weights), dos))
+
+        partial_dos = total_dos.calculate_dos(self._mesh.weights_e2)
+        self.assertEqual(partial_dos.shape, (131, 1, 2))
+        for ielm in range(2):
+            dos = self.calculate_dos_at_each_freq(
+                total_dos, self._mesh.weights_e2[:, 0, ielm])
+            self.assertTrue(np.allclose(partial_dos[:, 0, ielm], dos))
+
+    def test_chunks(self):
+        total_dos = self.create_total_dos()
+        dos = total_dos.calculate_dos(self._mesh.weights_e2)
+        # Three q-points per chunk
+        total_dos.max_kernel_size = 131 * 6 * 3
+        self.assertTrue(np.allclose(
+            total_dos.calculate_dos(self._mesh.weights_e2), dos))
+
+    def test_tetrahedron_method_with_sigma(self):
+        with self.assertRaises(ValueError):
+            self.create_total_dos(tetrahedron_method=True)
+
+    def test_cutoff(self):
+        dos = self.create_total_dos().calculate_dos(self._mesh.pr_weights)
+        dos_cutoff = self.create_total_dos(cutoff=10.0).calculate_dos(
+            self._mesh.pr_weights)
+        self.assertTrue(np.allclose(dos_cutoff, dos))
+
+
+class TestDosAccumulator(unittest.TestCase):
+    def setUp(self):
+        self._data_dicts = [
+            create_data_dict(1, 'm-3m', ['A1g', 'T1u'], 0),
+            create_data_dict(3, '4/mmm', ['A1g', 'Eu', 'A2u'], 1),
+            create_data_dict(2, 'm-3m', ['A1g', 'T1u'], 2),
+        ]
+        self._weights = [1, 3, 2]
+        self._parameters = {
+            'sigma': 0.2, 'fmin': -1.0, 'fmax': 12.0, 'fpitch': 0.1}
+
+    def accumulate(self, **kwargs):
+        kwargs.update(self._parameters)
+        accumulator = DosAccumulator(**kwargs)
+        for data_dict, weight in zip(self._data_dicts, self._weights):
+            accumulator.add_point(
+                accumulator.calculate_point(data_dict), weight)
+        return accumulator.get_data_dict()
+
+    def test_total_dos(self):
+        data = self.accumulate()
+        smearing = Smearing(sigma=0.2, xmin=-1.0, xmax=12.0, xpitch=0.1)
+        dos = np.zeros(len(data['frequency_points']))
+        for data_dict, weight in zip(self._data_dicts, self._weights):
+            for f, w in zip(data_dict['frequencies'], data_dict['weights_t']):
+                dos += weight * smearing.run(f, w)
+        dos /= np.sum(self._weights)
+        self.assertTrue(np.allclose(data['total_dos'], dos))
+
+    def test_partial_dos(self):
+        data = self.accumulate()
+        self.assertEqual(data['partial_dos_e2'].shape, (131, 1, 2))
+        self.assertTrue(np.allclose(
+            np.sum(data['partial_dos_e2'], axis=(1, 2)), data['total_dos']))
+        self.assertTrue(np.allclose(
+            np.sum(data['partial_dos_s'], axis=1), data['total_dos']))
+        # Irreps of the same point group are merged among the q-points.
+        keys = list(zip(data['pointgroup_symbols'].astype(str),
+                        data['ir_labels'].astype(str)))
+        self.assertEqual(keys, [
+            ('m-3m', 'A1g'), ('m-3m', 'T1u'),
+            ('4/mmm', 'A1g'), ('4/mmm', 'Eu'), ('4/mmm', 'A2u')])
+
+    def test_cutoff(self):
+        data = self.accumulate()
+        data_cutoff = self.accumulate(cutoff=10.0)
+        for k in ['total_dos', 'partial_dos_e2', 'partial_dos_s']:
+            self.assertTrue(np.allclose(data_cutoff[k], data[k]), k)
+
+    def test_write_hdf5(self):
+        root = os.getcwd()
+        tmpdir = tempfile.mkdtemp()
+        os.chdir(tmpdir)
+        try:
+            accumulator = DosAccumulator(**self._parameters)
+            for data_dict, weight in zip(self._data_dicts, self._weights):
+                accumulator.add_point(
+                    accumulator.calculate_point(data_dict), weight)
+            accumulator.write_hdf5('dos_unfolded.hdf5')
+            with h5py.File('dos_unfolded.hdf5', 'r') as f:
+                for k, v in accumulator.get_data_dict().items():
+                    self.assertTrue(np.array_equal(f[k], v), k)
+        finally:
+            os.chdir(root)
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    unittest.main()
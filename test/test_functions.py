@@ -7,7 +7,8 @@ __author__ = "Yuji Ikeda"
 
 import unittest
 import numpy as np
-from upho.analysis.functions import lorentzian_unnormalized
+from upho.analysis.functions import (
+    lorentzian_unnormalized, FittingFunctionFactory)
 
 
 class TestFunctions(unittest.TestCase):
@@ -34,7 +35,31 @@ class TestFunctions(unittest.TestCase):
                     print()
                     if not np.isnan(ratio):
                         self.assertTrue(np.abs(ratio - 1.0) < prec)
-                
+
+    def test_jacobian(self):
+        xs = np.linspace(-3.0, 5.0, 81)
+        params = np.array([0.7, 0.4, 2.0])
+        h = 1e-6
+        for name in ['gaussian', 'lorentzian']:
+            for is_normalized in [True, False]:
+                factory = FittingFunctionFactory(name, is_normalized)
+                function = factory.create()
+                jacobian = factory.create_jacobian()
+                nparams = 2 if is_normalized else 3
+                p = params[:nparams]
+                jac = jacobian(xs, *p)
+                self.assertEqual(jac.shape, (len(xs), nparams))
+                # Central differences
+                for i in range(nparams):
+                    dp = np.zeros(nparams)
+                    dp[i] = h
+                    jac_numerical = (
+                        function(xs, *(p + dp)) -
+                        function(xs, *(p - dp))) / (2.0 * h)
+                    self.assertTrue(
+                        np.allclose(jac[:, i], jac_numerical, atol=1e-6),
+                        (name, is_normalized, i))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from phonopy.interface.vasp import read_vasp
+from upho.phonon import mesh_unfolding
+from upho.phonon.eigenstates import Eigenstates
+from upho.phonon.mesh_unfolding import MeshUnfolding
+from test_band_structure import (
+    PRIMITIVE_MATRIX, StubDynamicalMatrix, StubEigenstates, load_hdf5)
+
+__author__ = 'Yuji Ikeda'
+
+DOS = {
+    'sigma': 0.2,
+    'fmin': -1.0,
+    'fmax': 12.0,
+    'fpitch': 0.1,
+}
+
+
+class TestMeshUnfolding(unittest.TestCase):
+    def setUp(self):
+        self._unitcell_ideal = read_vasp('L21_Cu3Au/POSCAR_ideal')
+        self._root = os.getcwd()
+        self._tmpdir = tempfile.mkdtemp()
+        os.chdir(self._tmpdir)
+        mesh_unfolding.Eigenstates = StubEigenstates
+
+    def tearDown(self):
+        mesh_unfolding.Eigenstates = Eigenstates
+        os.chdir(self._root)
+        shutil.rmtree(self._tmpdir)
+
+    def run_mesh_unfolding(self, **kwargs):
+        return MeshUnfolding(
+            StubDynamicalMatrix(),
+            self._unitcell_ideal,
+            PRIMITIVE_MATRIX,
+            [4, 4, 4],
+            dos=DOS,
+            **kwargs)
+
+    def test_parallel(self):
+        for layout in ['groups', 'stacked']:
+            mesh = self.run_mesh_unfolding(write_weights=True, layout=layout)
+            pr_weights = mesh.get_pr_weights()
+            data = load_hdf5('mesh_unfolding.hdf5')
+            data_dos = load_hdf5('dos_unfolded.hdf5')
+
+            mesh = self.run_mesh_unfolding(
+                write_weights=True, layout=layout, nprocs=2)
+            self.assertTrue(np.array_equal(mesh.get_pr_weights(), pr_weights))
+            for filename, expected in [('mesh_unfolding.hdf5', data),
+                                       ('dos_unfolded.hdf5', data_dos)]:
+                data_parallel = load_hdf5(filename)
+                self.assertEqual(
+                    sorted(data_parallel.keys()), sorted(expected.keys()))
+                for k, v in expected.items():
+                    self.assertTrue(np.array_equal(data_parallel[k], v), k)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import functools
+import os
+import unittest
+import numpy as np
+from upho.phonon.parallel import (
+    create_pool, create_shared_array, imap_in_workers)
+
+__author__ = 'Yuji Ikeda'
+
+_array = None
+
+
+def _init_worker(array):
+    global _array
+    _array = array
+
+
+def _sum_row(i):
+    return np.sum(_array[i])
+
+
+class Counter(object):
+    def __init__(self):
+        self._pid = None
+
+    def set_pid(self):
+        self._pid = os.getpid()
+
+    def multiply(self, factor, i):
+        return self._pid, factor * i
+
+
+class TestParallel(unittest.TestCase):
+    def test_create_shared_array(self):
+        array = np.random.rand(4, 3) + 1.0j * np.random.rand(4, 3)
+        shared_array = create_shared_array(array)
+        self.assertEqual(shared_array.dtype, array.dtype)
+        self.assertTrue(np.all(shared_array == array))
+
+        with create_pool(2, _init_worker, (shared_array, )) as pool:
+            sums = pool.map(_sum_row, range(4))
+        self.assertTrue(np.allclose(sums, np.sum(array, axis=1)))
+
+    def test_imap_in_workers(self):
+        counter = Counter()
+        function = functools.partial(counter.multiply, 3)
+        results = list(imap_in_workers(
+            2, function, [(i, ) for i in range(10)],
+            initializer=counter.set_pid))
+        pids, products = zip(*results)
+        # Results are in the order of the tasks.
+        self.assertEqual(list(products), [3 * i for i in range(10)])
+        # The initializer is called in the workers but not in the parent.
+        self.assertNotIn(None, pids)
+        self.assertNotIn(os.getpid(), pids)
+        self.assertIsNone(counter._pid)
+
+
+if __name__ == "__main__":
+    unittest.main()
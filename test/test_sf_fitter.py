@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import os
+import shutil
+import tempfile
+import unittest
+import h5py
+import numpy as np
+from upho.phonon.density_extractor import DensityExtractorHDF5
+from upho.phonon import sf_fitter
+from upho.phonon.sf_fitter import SFFitter, fit_levenberg_marquardt
+from upho.phonon.band_hdf5 import create_writer
+from test_band_hdf5 import write_band_hdf5, create_data_dict
+
+__author__ = 'Yuji Ikeda'
+
+FIT_KEYS = [
+    'peaks_s',
+    'widths_s',
+    'norms_s',
+    'fitting_errors',
+    'partial_sf_s',
+]
+
+
+def load_sf_fit_hdf5(filename):
+    data = {}
+    with h5py.File(filename, 'r') as f:
+        npaths, npoints = f['paths'].shape[:2]
+        for ipath in range(npaths):
+            for ip in range(npoints):
+                group = '{}/{}/'.format(ipath, ip)
+                if group not in f:
+                    continue
+                for k in FIT_KEYS:
+                    data[group + k] = np.array(f[group + k])
+    return data
+
+
+def write_band_hdf5_runs(filename, npaths=2, npoints=4):
+    """Write "band.hdf5" with the same irreps along each path.
+
+    Frequencies are shifted smoothly along the paths.
+    """
+    paths = np.random.rand(npaths, npoints, 3)
+    with h5py.File(filename, 'w') as f:
+        writer = create_writer(f, layout='groups', max_narms=1)
+        writer.write_header(paths)
+        for ipath in range(npaths):
+            for ip in range(npoints):
+                data_dict = create_data_dict(
+                    ipath, 0, narms=1, nirreps=2 + ipath)
+                data_dict['frequencies'] += 0.05 * ip
+                writer.write_point(ipath, ip, data_dict)
+
+
+def write_band_hdf5_single_peaks(filename, npaths=2, npoints=3,
+                                 is_split=False):
+    """Write "band.hdf5" with one peak for each irrep.
+
+    If "is_split", the first irrep has another peak with half weight.
+
+    Returns
+    -------
+    peaks : dict
+        Frequencies and weights of the peaks for each q-point.
+    """
+    paths = np.random.rand(npaths, npoints, 3)
+    peaks = {}
+    with h5py.File(filename, 'w') as f:
+        writer = create_writer(f, layout='groups', max_narms=1)
+        writer.write_header(paths)
+        for ipath in range(npaths):
+            for ip in range(npoints):
+                nirreps = 1 + (ip + ipath) % 5
+                data_dict = create_data_dict(
+                    ipath, ip, narms=1, nirreps=nirreps)
+                weights_s = np.zeros_like(data_dict['weights_s'])
+                # Same as the degeneracies of the irreps
+                norms = np.array([1.0, 2.0, 3.0, 3.0, 1.0])[:nirreps]
+                for i in range(nirreps):
+                    weights_s[0, i, i] = norms[i]
+                data_dict['weights_s'] = weights_s
+                data_dict['frequencies'] = 1.0 + 10.0 * (
+                    data_dict['frequencies'] / 10.0 * 0.8)
+                if is_split:
+                    weights_s[0, 0, -1] = 0.5
+                    data_dict['frequencies'][0, -1] = (
+                        data_dict['frequencies'][0, 0] + 1.5)
+                writer.write_point(ipath, ip, data_dict)
+                peaks[ipath, ip] = (
+                    data_dict['frequencies'][0, :nirreps], norms)
+    return peaks
+
+
+class InterruptedSFFitter(SFFitter):
+    """Fitter interrupted after writing "nwrites" q-points."""
+    nwrites = 2
+
+    def _write(self, *args, **kwargs):
+        if self.nwrites == 0:
+            raise KeyboardInterrupt
+        self.nwrites -= 1
+        super(InterruptedSFFitter, self)._write(*args, **kwargs)
+
+
+class TestSFFitter(unittest.TestCase):
+    def setUp(self):
+        self._root = os.getcwd()
+        self._tmpdir = tempfile.mkdtemp()
+        os.chdir(self._tmpdir)
+        write_band_hdf5('band.hdf5', 'groups')
+        self.run_density_extractor()
+
+    def run_density_extractor(self, **kwargs):
+        DensityExtractorHDF5(
+            filename='band.hdf5',
+            fmin=-1.0,
+            fmax=12.0,
+            fpitch=0.05,
+            sigma=0.2,
+            is_squared=False,
+            **kwargs)
+
+    def tearDown(self):
+        os.chdir(self._root)
+        shutil.rmtree(self._tmpdir)
+
+    def test_parallel(self):
+        SFFitter()
+        data = load_sf_fit_hdf5('sf_fit.hdf5')
+        SFFitter(nprocs=3)
+        data_parallel = load_sf_fit_hdf5('sf_fit.hdf5')
+        self.assertEqual(sorted(data_parallel.keys()), sorted(data.keys()))
+        for k, v in data.items():
+            self.assertTrue(np.allclose(data_parallel[k], v, equal_nan=True), k)
+
+    def test_select(self):
+        SFFitter()
+        data = load_sf_fit_hdf5('sf_fit.hdf5')
+        self.run_density_extractor(ipaths=[1])
+        for method in ['curve_fit', 'batched']:
+            SFFitter(method=method)
+            data_selected = load_sf_fit_hdf5('sf_fit.hdf5')
+            self.assertEqual(
+                sorted(set(k.rsplit('/', 1)[0] for k in data_selected)),
+                ['1/0', '1/1', '1/2'])
+            if method == 'curve_fit':
+                for k, v in data_selected.items():
+                    self.assertTrue(
+                        np.allclose(data[k], v, equal_nan=True), k)
+
+    def test_batched(self):
+        SFFitter()
+        data = load_sf_fit_hdf5('sf_fit.hdf5')
+        SFFitter(method='batched')
+        data_batched = load_sf_fit_hdf5('sf_fit.hdf5')
+        for k, v in data.items():
+            self.assertTrue(np.allclose(
+                data_batched[k], v, atol=1e-3, equal_nan=True), k)
+
+    def test_batched_failed(self):
+        SFFitter()
+        data = load_sf_fit_hdf5('sf_fit.hdf5')
+
+        def fit_failed(*args, **kwargs):
+            params, is_converged = fit_levenberg_marquardt(*args, **kwargs)
+            return params, np.zeros_like(is_converged)
+
+        # Failed fittings are redone by curve_fit.
+        sf_fitter.fit_levenberg_marquardt = fit_failed
+        try:
+            SFFitter(method='batched')
+        finally:
+            sf_fitter.fit_levenberg_marquardt = fit_levenberg_marquardt
+        data_batched = load_sf_fit_hdf5('sf_fit.hdf5')
+        for k, v in data.items():
+            self.assertTrue(np.allclose(
+                data_batched[k], v, atol=1e-6, equal_nan=True), k)
+
+    def test_levenberg_marquardt_failed(self):
+        def function(x, a, b):
+            return a * x + b
+
+        def wrong_jacobian(x, a, b):
+            # No step reduces the sum of squares with the wrong sign.
+            return -np.stack(np.broadcast_arrays(x, 1.0), axis=-1)
+
+        xs = np.linspace(0.0, 1.0, 11)
+        ys = np.stack((2.0 * xs + 1.0, -xs), axis=-1)
+        p0 = np.zeros((2, 2))
+        params, is_converged = fit_levenberg_marquardt(
+            function, wrong_jacobian, xs, ys, p0)
+        self.assertFalse(np.any(is_converged))
+
+        def jacobian(x, a, b):
+            return -wrong_jacobian(x, a, b)
+
+        params, is_converged = fit_levenberg_marquardt(
+            function, jacobian, xs, ys, p0)
+        self.assertTrue(np.all(is_converged))
+        self.assertTrue(np.allclose(params, [[2.0, 1.0], [-1.0, 0.0]]))
+
+    def test_window(self):
+        peaks = write_band_hdf5_single_peaks('band.hdf5')
+        self.run_density_extractor()
+        SFFitter(window=1e-3)
+        data = load_sf_fit_hdf5('sf_fit.hdf5')
+        for (ipath, ip), (peak_positions, norms) in peaks.items():
+            group = '{}/{}/'.format(ipath, ip)
+            self.assertTrue(np.allclose(
+                data[group + 'peaks_s'], peak_positions, atol=1e-6))
+            self.assertTrue(np.allclose(
+                data[group + 'widths_s'], 0.2 * np.sqrt(2.0 * np.log(2.0)),
+                atol=1e-6))
+            self.assertTrue(np.all(data[group + 'fitting_errors'] < 1e-6))
+
+    def test_incremental(self):
+        SFFitter()
+        data = load_sf_fit_hdf5('sf_fit.hdf5')
+        with h5py.File('sf_fit.hdf5', 'a') as f:
+            # Modified to check whether the results are reused.
+            f['0/0/peaks_s'][...] = 100.0
+        with h5py.File('sf.hdf5', 'a') as f:
+            f['1/1/partial_sf_s'][...] *= 2.0
+        SFFitter(incremental=True)
+        data_incremental = load_sf_fit_hdf5('sf_fit.hdf5')
+        self.assertTrue(np.all(data_incremental['0/0/peaks_s'] == 100.0))
+        # Only the changed q-point is fitted again.
+        for k, v in data.items():
+            if k.startswith(('0/0/', '1/1/')):
+                continue
+            self.assertTrue(np.array_equal(data_incremental[k], v), k)
+        SFFitter()
+        data = load_sf_fit_hdf5('sf_fit.hdf5')
+        for k, v in data_incremental.items():
+            if k.startswith('1/1/'):
+                self.assertTrue(np.allclose(
+                    data[k], v, equal_nan=True), k)
+
+        # Nothing is reused when the settings are changed.
+        with h5py.File('sf_fit.hdf5', 'a') as f:
+            f['0/0/peaks_s'][...] = 100.0
+        SFFitter(incremental=True, name='lorentzian')
+        SFFitter(incremental=True)
+        data_incremental = load_sf_fit_hdf5('sf_fit.hdf5')
+        for k, v in data.items():
+            self.assertTrue(np.allclose(
+                data_incremental[k], v, equal_nan=True), k)
+
+    def test_incremental_interrupted(self):
+        SFFitter(name='lorentzian')
+        data = load_sf_fit_hdf5('sf_fit.hdf5')
+        SFFitter()
+        with self.assertRaises(KeyboardInterrupt):
+            InterruptedSFFitter(incremental=True, name='lorentzian')
+        with h5py.File('sf_fit.hdf5.tmp', 'a') as f:
+            self.assertEqual(
+                [k for k in ['0/0/', '0/1/', '0/2/'] if k in f],
+                ['0/0/', '0/1/'])
+            # Modified to check whether the results are continued.
+            f['0/0/peaks_s'][...] = 100.0
+        SFFitter(incremental=True, name='lorentzian')
+        self.assertFalse(os.path.exists('sf_fit.hdf5.tmp'))
+        data_incremental = load_sf_fit_hdf5('sf_fit.hdf5')
+        self.assertTrue(np.all(data_incremental['0/0/peaks_s'] == 100.0))
+        for k, v in data.items():
+            if k.startswith('0/0/'):
+                continue
+            self.assertTrue(np.allclose(
+                data_incremental[k], v, equal_nan=True), k)
+
+    def test_warm_start(self):
+        write_band_hdf5_runs('band.hdf5')
+        self.run_density_extractor()
+        fitter = SFFitter()
+        data = load_sf_fit_hdf5('sf_fit.hdf5')
+        with h5py.File('sf.hdf5', 'r') as f:
+            frequencies = np.array(f['frequencies'])
+            for ipath in range(2):
+                for ip in range(4):
+                    group = '{}/{}/'.format(ipath, ip)
+                    sfs = np.array(f[group + 'partial_sf_s'])
+                    ir_labels = np.array(f[group + 'ir_labels'])
+                    for i, sf in enumerate(sfs.T):
+                        # Fitting without warm start
+                        peak_position, width = fitter.fit_spectral_function(
+                            frequencies, sf, ir_labels[i].decode('ascii'))[:2]
+                        self.assertAlmostEqual(
+                            data[group + 'peaks_s'][i], peak_position, places=3)
+                        self.assertGreater(width, 0.0)
+                        self.assertAlmostEqual(
+                            data[group + 'widths_s'][i], width, places=3)
+
+    def test_run_chunks(self):
+        write_band_hdf5_runs('band.hdf5', npoints=5)
+        self.run_density_extractor()
+        SFFitter()
+        data = load_sf_fit_hdf5('sf_fit.hdf5')
+
+        fitter = SFFitter(nprocs=2)
+        points = [(ipath, ip) for ipath in range(2) for ip in range(5)]
+        fitter.max_run_length = 2
+        with h5py.File('sf.hdf5', 'r') as f:
+            fitter._band_data = f
+            self.assertEqual(fitter._split_into_runs(points), [
+                [(0, 0), (0, 1)], [(0, 2), (0, 3)], [(0, 4)],
+                [(1, 0), (1, 1)], [(1, 2), (1, 3)], [(1, 4)]])
+
+        max_run_length = SFFitter.max_run_length
+        SFFitter.max_run_length = 2
+        try:
+            SFFitter(nprocs=2)
+        finally:
+            SFFitter.max_run_length = max_run_length
+        data_chunks = load_sf_fit_hdf5('sf_fit.hdf5')
+        # Each chunk is warm-started from the fit at its first q-point.
+        for k, v in data.items():
+            self.assertTrue(np.allclose(
+                data_chunks[k], v, atol=1e-3, equal_nan=True), k)
+
+    def test_moments(self):
+        peaks = write_band_hdf5_single_peaks('band.hdf5')
+        for function, prec in [('gaussian', 1e-6), ('lorentzian', 5e-2)]:
+            self.run_density_extractor(function=function)
+            SFFitter(name=function, method='moments')
+            data = load_sf_fit_hdf5('sf_fit.hdf5')
+            for (ipath, ip), (peak_positions, norms) in peaks.items():
+                group = '{}/{}/'.format(ipath, ip)
+                self.assertTrue(np.allclose(
+                    data[group + 'peaks_s'], peak_positions, atol=prec))
+                self.assertTrue(np.allclose(
+                    data[group + 'norms_s'], norms, rtol=prec))
+                # Width is HWHM.
+                width = 0.2 * (
+                    np.sqrt(2.0 * np.log(2.0)) if function == 'gaussian'
+                    else 1.0)
+                self.assertTrue(np.allclose(
+                    data[group + 'widths_s'], width, rtol=prec))
+
+    def test_multiple_peaks(self):
+        peaks = write_band_hdf5_single_peaks('band.hdf5', is_split=True)
+        self.run_density_extractor()
+        SFFitter(method='batched', npeaks=3)
+        with h5py.File('sf_fit.hdf5', 'r') as f:
+            for (ipath, ip), (peak_positions, norms) in peaks.items():
+                group = '{}/{}/'.format(ipath, ip)
+                num_peaks = np.ones(len(norms), dtype=int)
+                num_peaks[0] = 2
+                self.assertTrue(np.array_equal(
+                    f[group + 'num_peaks_s'], num_peaks))
+                # The first irrep is split.
+                peak_positions = np.column_stack((
+                    peak_positions, np.full(len(norms), np.nan)))
+                peak_positions[0, 1] = peak_positions[0, 0] + 1.5
+                norms = np.column_stack((norms, np.full(len(norms), np.nan)))
+                norms[0, 1] = 0.5
+                self.assertTrue(np.allclose(
+                    f[group + 'peaks_s'][:, :2], peak_positions,
+                    atol=1e-4, equal_nan=True))
+                self.assertTrue(np.allclose(
+                    f[group + 'norms_s'][:, :2], norms,
+                    atol=1e-4, equal_nan=True))
+                self.assertTrue(np.all(np.isnan(f[group + 'peaks_s'][:, 2])))
+
+
+if __name__ == "__main__":
+    unittest.main()
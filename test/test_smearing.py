@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import unittest
+import numpy as np
+from upho.analysis.smearing import Smearing, create_adaptive_points
+
+__author__ = 'Yuji Ikeda'
+
+
+class TestSmearing(unittest.TestCase):
+    def setUp(self):
+        self._peaks = np.random.rand(50) * 12.0 - 1.0
+        self._weights = (
+            np.random.rand(3, 2, 50) + 1.0j * np.random.rand(3, 2, 50))
+
+    def create_smearing(self, function_name, **kwargs):
+        smearing = Smearing(function_name=function_name, sigma=0.2, **kwargs)
+        smearing.build_xs(-2.0, 12.0, 0.01)
+        return smearing
+
+    def test_cutoff(self):
+        for function_name in ['gaussian', 'lorentzian']:
+            smearing = self.create_smearing(function_name)
+            smearing_cutoff = self.create_smearing(function_name, cutoff=1e6)
+            for weights in [None, self._weights[0, 0].real, self._weights]:
+                values = smearing.run(self._peaks, weights)
+                values_cutoff = smearing_cutoff.run(self._peaks, weights)
+                self.assertEqual(values.shape, values_cutoff.shape)
+                self.assertTrue(np.allclose(values, values_cutoff))
+
+    def test_cutoff_gaussian(self):
+        smearing = self.create_smearing('gaussian')
+        smearing_cutoff = self.create_smearing('gaussian', cutoff=6.0)
+        values = smearing.run(self._peaks, self._weights)
+        values_cutoff = smearing_cutoff.run(self._peaks, self._weights)
+        self.assertTrue(np.allclose(values, values_cutoff, rtol=0.0, atol=1e-6))
+
+    def test_cutoff_order(self):
+        smearing = self.create_smearing('gaussian', cutoff=6.0)
+        order = np.argsort(self._peaks, kind='mergesort')
+        kernel = smearing.create_kernel(self._peaks)
+        kernel_order = smearing.create_kernel(self._peaks, order)
+        self.assertEqual((kernel != kernel_order).nnz, 0)
+
+    def test_fft(self):
+        for function_name in ['gaussian', 'lorentzian']:
+            smearing = self.create_smearing(function_name)
+            smearing_fft = self.create_smearing(function_name, method='fft')
+            for weights in [None, self._weights[0, 0].real, self._weights]:
+                values = smearing.run(self._peaks, weights)
+                values_fft = smearing_fft.run(self._peaks, weights)
+                self.assertEqual(values.shape, values_fft.shape)
+                atol = 1e-3 * np.max(np.abs(values))
+                self.assertTrue(np.allclose(values, values_fft, rtol=0.0, atol=atol))
+
+    def test_fft_nonuniform(self):
+        smearing = self.create_smearing('gaussian')
+        xs = np.linspace(-2.0, 12.0, 141)
+        smearing.set_xs(np.sign(xs) * xs ** 2)
+        smearing_fft = self.create_smearing('gaussian', method='fft', cutoff=10.0)
+        smearing_fft.set_xs(smearing.get_xs())
+        values = smearing.run(self._peaks, self._weights)
+        values_fft = smearing_fft.run(self._peaks, self._weights)
+        atol = 1e-3 * np.max(np.abs(values))
+        self.assertTrue(np.allclose(values, values_fft, rtol=0.0, atol=atol))
+
+    def test_fft_far_peaks(self):
+        smearing_fft = self.create_smearing('gaussian', method='fft')
+        peaks = np.append(self._peaks, 1e6)
+        weights = np.append(self._weights[0, 0].real, 1.0)
+        # The grid does not depend on the range of the peaks.
+        self.assertEqual(smearing_fft.create_kernel(peaks)[2],
+                         smearing_fft.create_kernel(self._peaks)[2])
+        self.assertTrue(np.allclose(
+            smearing_fft.run(peaks, weights),
+            smearing_fft.run(self._peaks, weights[:-1])))
+
+    def test_no_peaks(self):
+        for kwargs in [{}, {'cutoff': 6.0}, {'method': 'fft'}]:
+            smearing = self.create_smearing('gaussian', **kwargs)
+            nxs = len(smearing.get_xs())
+            for weights, shape in [(None, (nxs, )),
+                                   (self._weights[:, :, :0], (nxs, 3, 2))]:
+                values = smearing.run(np.zeros(0), weights)
+                self.assertEqual(values.shape, shape)
+                self.assertTrue(np.all(values == 0.0))
+
+    def test_adaptive_points(self):
+        points = create_adaptive_points(
+            0.0, 10.0, 1.0, 0.1, lowers=[2.05, 2.5], uppers=[3.0, 3.35])
+        expected = np.concatenate((
+            np.arange(0.0, 2.5, 1.0),
+            np.arange(2.1, 3.35, 0.1),
+            np.arange(4.0, 10.5, 1.0)))
+        self.assertTrue(np.allclose(points, expected))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import unittest
+import numpy as np
+from upho.analysis.tetrahedron import (
+    create_tetrahedra, create_tetrahedron_kernel)
+
+__author__ = 'Yuji Ikeda'
+
+
+class TestTetrahedron(unittest.TestCase):
+    def setUp(self):
+        self._xs = np.linspace(-0.5, 4.5, 5001)
+        self._dx = self._xs[1] - self._xs[0]
+
+    def test_sum_rule(self):
+        random = np.random.RandomState(0)
+        energies = random.uniform(0.0, 4.0, (10, 4))
+        weights = random.uniform(0.0, 2.0, (10, 4))
+        kernel = create_tetrahedron_kernel(self._xs, energies)
+        density = kernel.dot(weights.reshape(-1))
+        self.assertAlmostEqual(
+            np.sum(density) * self._dx, np.sum(np.mean(weights, axis=1)),
+            places=6)
+
+    def test_linear_interpolation(self):
+        random = np.random.RandomState(1)
+        energies = random.uniform(0.0, 4.0, (1, 4))
+        weights = random.uniform(0.0, 2.0, 4)
+        # Uniform sampling in the tetrahedron by barycentric coordinates
+        coordinates = random.dirichlet(np.ones(4), 200000)
+        samples = np.dot(coordinates, energies[0])
+        sample_weights = np.dot(coordinates, weights)
+
+        kernel = create_tetrahedron_kernel(self._xs, energies)
+        integrated = np.cumsum(kernel.dot(weights)) * self._dx
+        for x in np.sort(energies[0]) + 0.2:
+            i = np.searchsorted(self._xs, x)
+            reference = np.sum(sample_weights[samples < self._xs[i]])
+            reference /= len(samples)
+            self.assertAlmostEqual(integrated[i], reference, places=2)
+
+    def test_degenerate(self):
+        energies = np.array([[1.0, 1.0, 2.0, 2.0], [3.0, 3.0, 3.0, 3.0]])
+        kernel = create_tetrahedron_kernel(self._xs, energies)
+        density = kernel.dot(np.ones(8))
+        self.assertTrue(np.all(np.isfinite(density)))
+        self.assertAlmostEqual(np.sum(density) * self._dx, 1.0, places=2)
+
+    def test_create_tetrahedra(self):
+        mesh = np.array([3, 4, 2])
+        grid_address = np.array(
+            [[i, j, k] for k in range(2) for j in range(4) for i in range(3)])
+        microzone_lattice = np.array(
+            [[1.0, 0.5, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 2.0]]) / mesh
+        tetrahedra = create_tetrahedra(grid_address, mesh, microzone_lattice)
+        self.assertEqual(tetrahedra.shape, (6 * 24, 4))
+        # Each grid point is shared by 24 tetrahedra.
+        self.assertTrue(np.all(np.bincount(tetrahedra.ravel()) == 24))
+        # Tetrahedra fill the microzones without overlapping.
+        edges = grid_address[tetrahedra[:, 1:]] - grid_address[tetrahedra[:, :1]]
+        edges = edges - mesh * np.rint(edges / mesh)
+        volumes = np.abs(np.linalg.det(edges)) / 6.0
+        self.assertTrue(np.allclose(volumes, 1.0 / 6.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
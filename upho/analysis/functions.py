@@ -20,6 +20,32 @@ def lorentzian_unnormalized(x, position, width, norm):
     return norm * lorentzian(x, position, width)
 
 
+def lorentzian_jacobian(x, position, width):
+    """Derivatives of lorentzian w.r.t. position and width.
+
+    Returns
+    -------
+    jacobian : (len(x), 2) array
+    """
+    dx = x - position
+    denominator = np.pi * (width ** 2 + dx ** 2) ** 2
+    d_position = 2.0 * width * dx / denominator
+    d_width = (dx ** 2 - width ** 2) / denominator
+    return np.stack((d_position, d_width), axis=-1)
+
+
+def lorentzian_unnormalized_jacobian(x, position, width, norm):
+    """Derivatives of lorentzian_unnormalized w.r.t. position, width, and norm.
+
+    Returns
+    -------
+    jacobian : (len(x), 3) array
+    """
+    return np.concatenate((
+        np.asarray(norm)[..., None] * lorentzian_jacobian(x, position, width),
+        lorentzian(x, position, width)[..., None]), axis=-1)
+
+
 def gaussian(x, position, width):
     sigma = width / np.sqrt(2.0 * np.log(2.0))
     tmp = np.exp(- (x - position) ** 2 / (2.0 * sigma ** 2))
@@ -30,6 +56,33 @@ def gaussian_unnormalized(x, position, width, norm):
     return norm * gaussian(x, position, width)
 
 
+def gaussian_jacobian(x, position, width):
+    """Derivatives of gaussian w.r.t. position and width.
+
+    Returns
+    -------
+    jacobian : (len(x), 2) array
+    """
+    sigma = width / np.sqrt(2.0 * np.log(2.0))
+    dx = x - position
+    values = gaussian(x, position, width)
+    d_position = values * dx / sigma ** 2
+    d_width = values * (dx ** 2 / sigma ** 2 - 1.0) / width
+    return np.stack((d_position, d_width), axis=-1)
+
+
+def gaussian_unnormalized_jacobian(x, position, width, norm):
+    """Derivatives of gaussian_unnormalized w.r.t. position, width, and norm.
+
+    Returns
+    -------
+    jacobian : (len(x), 3) array
+    """
+    return np.concatenate((
+        np.asarray(norm)[..., None] * gaussian_jacobian(x, position, width),
+        gaussian(x, position, width)[..., None]), axis=-1)
+
+
 class FittingFunctionFactory(object):
     def __init__(self, name, is_normalized):
         """
@@ -57,3 +110,24 @@ class FittingFunctionFactory(object):
                 return gaussian_unnormalized
         else:
             raise ValueError('Unknown name', name)
+
+    def create_jacobian(self):
+        """Create the Jacobian of the function from "create".
+
+        The Jacobian takes the same arguments as the function and returns
+        the derivatives w.r.t. the parameters following "x".
+        """
+        name = self._name
+        is_normalized = self._is_normalized
+        if name == 'lorentzian':
+            if is_normalized:
+                return lorentzian_jacobian
+            else:
+                return lorentzian_unnormalized_jacobian
+        elif name == 'gaussian':
+            if is_normalized:
+                return gaussian_jacobian
+            else:
+                return gaussian_unnormalized_jacobian
+        else:
+            raise ValueError('Unknown name', name)
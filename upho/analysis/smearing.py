@@ -5,6 +5,8 @@ from __future__ import absolute_import, division, print_function
 __author__ = "Yuji Ikeda"
 
 import numpy as np
+from scipy.fft import next_fast_len
+from scipy.sparse import csr_matrix
 from .functions import lorentzian
 
 
@@ -44,17 +46,78 @@ def create_points(xmin, xmax, xpitch):
     return points
 
 
+def create_adaptive_points(xmin, xmax, xpitch, xpitch_fine, lowers, uppers):
+    """Create points refined within the given intervals.
+
+    Parameters
+    ----------
+    xpitch : float
+        Pitch outside the intervals.
+    xpitch_fine : float
+        Pitch inside the intervals.
+    lowers, uppers : (nintervals) array
+        Lower and upper bounds of the intervals to be refined.
+
+    Returns
+    -------
+    points : array
+        Sorted union of the points with "xpitch" and those with
+        "xpitch_fine" within the intervals. Both are aligned to "xmin".
+    """
+    points_coarse = create_points(xmin, xmax, xpitch)
+    points_fine = create_points(xmin, xmax, xpitch_fine)
+
+    # Count the intervals covering each fine point.
+    lower_indices = np.searchsorted(points_fine, lowers, side='left')
+    upper_indices = np.searchsorted(points_fine, uppers, side='right')
+    counts = np.zeros(len(points_fine) + 1, dtype=int)
+    np.add.at(counts, lower_indices, 1)
+    np.add.at(counts, upper_indices, -1)
+    is_refined = np.cumsum(counts[:-1]) > 0
+
+    points = np.sort(np.concatenate((points_coarse, points_fine[is_refined])))
+    # Remove points duplicated in the coarse and the fine grids.
+    is_unique = np.ones(len(points), dtype=bool)
+    is_unique[1:] = np.diff(points) > xpitch_fine * 1e-6
+    return points[is_unique]
+
+
 class Smearing(object):
+    # Number of grid points per sigma at least for method="fft"
+    fft_oversampling = 20
+    # Cutoff in units of sigma for method="fft" if not given
+    fft_default_cutoff = 10.0
+
     def __init__(self,
                  function_name="gaussian",
                  sigma=0.1,
                  xmin=None,
                  xmax=None,
-                 xpitch=None):
+                 xpitch=None,
+                 cutoff=None,
+                 method="direct"):
+        """
+
+        Args:
+            cutoff:
+                If given, values of the smearing function are evaluated only
+                where the distance from the peak is within cutoff * sigma.
+                Otherwise they are evaluated for all the pairs of xs and peaks.
+            method:
+                "direct": The smearing function is evaluated for the peaks.
+                "fft": Weights of the peaks are deposited on a uniform grid
+                    by linear interpolation and then convolved with the
+                    smearing function using FFT. For "fft", peaks farther
+                    than the cutoff from xs are ignored, and the cutoff is
+                    "fft_default_cutoff" if not given.
+        """
 
         self._function_name = function_name
         self.set_smearing_function(function_name)
         self.set_sigma(sigma)
+        self.set_cutoff(cutoff)
+        self.set_method(method)
+        self._kernel_fft_cache = {}
         if xmin is not None and xmax is not None and xpitch is not None:
             self.build_xs(xmin, xmax, xpitch)
         elif not (xmin is None and xmax is None and xpitch is None):
@@ -87,6 +150,20 @@ class Smearing(object):
     def get_sigma(self):
         return self._sigma
 
+    def set_cutoff(self, cutoff):
+        self._cutoff = cutoff
+
+    def get_cutoff(self):
+        return self._cutoff
+
+    def set_method(self, method):
+        if method not in ("direct", "fft"):
+            raise ValueError("Invalid smearing method name.")
+        self._method = method
+
+    def get_method(self):
+        return self._method
+
     def get_function_name(self):
         return self._function_name
 
@@ -100,14 +177,185 @@ class Smearing(object):
                 Now this can be one-dimeansional and multi-dimensional arrays.
                 The last dimension must have the same order as the "peaks".
         """
-        smearing_function = self._smearing_function
-        xs = self._xs
-        sigma = self._sigma
+        return self.apply_kernel(self.create_kernel(peaks), weights)
+
+    def create_kernel(self, peaks, order=None):
+        """Create the kernel for the peaks.
+
+        The kernel depends only on the peaks and xs, and therefore can be
+        shared among the weights for the same peaks using "apply_kernel".
+
+        Args:
+            order:
+                Indices sorting the peaks stably, used with the cutoff for
+                method="direct". If None, the peaks are sorted here. This
+                can be shared among the smearings for the same peaks.
+        """
+        if self._method == "fft":
+            return self._create_fft_kernel(peaks)
+        if self._cutoff is not None:
+            return self._create_sparse_kernel(peaks, order)
+        return self._smearing_function(
+            self._xs[:, None], peaks[None, :], self._sigma)
+
+    def apply_kernel(self, kernel, weights=None):
+        """Get smeared values for the weights using the kernel.
 
-        tmp = smearing_function(xs[:, None], peaks[None, :], sigma)
+        Args:
+            kernel:
+                Kernel created by "create_kernel" for the peaks.
+            weights:
+                Weight factors for the peaks. See "run".
+        """
+        if self._method == "fft":
+            return self._apply_fft_kernel(kernel, weights)
+        if self._cutoff is not None:
+            return self._apply_sparse_kernel(kernel, weights)
         if weights is not None:
-            values = np.inner(tmp, weights)
+            values = np.inner(kernel, weights)
         else:
-            values = np.sum(tmp, axis=1)
-
+            values = np.sum(kernel, axis=1)
         return values
+
+    def _apply_sparse_kernel(self, kernel, weights=None):
+        if weights is None:
+            return np.asarray(kernel.sum(axis=1)).ravel()
+        weights = np.asarray(weights)
+        if weights.shape[-1] == 0:
+            return self._create_zeros(weights)
+        values = kernel.dot(weights.reshape(-1, weights.shape[-1]).T)
+        return values.reshape(self._xs.shape + weights.shape[:-1])
+
+    def _create_sparse_kernel(self, peaks, order=None):
+        """Create the values of the smearing function within the cutoff.
+
+        Peaks are sorted, and the ones within the cutoff from each x are
+        found by bisection.
+
+        Returns
+        -------
+        kernel : (nxs, npeaks) csr_matrix
+        """
+        xs = self._xs
+        sigma = self._sigma
+        width = self._cutoff * sigma
+
+        if order is None:
+            order = np.argsort(peaks, kind='mergesort')
+        sorted_peaks = peaks[order]
+        lower = np.searchsorted(sorted_peaks, xs - width, side='left')
+        upper = np.searchsorted(sorted_peaks, xs + width, side='right')
+        counts = upper - lower
+
+        indptr = np.zeros(len(xs) + 1, dtype=int)
+        indptr[1:] = np.cumsum(counts)
+        rows = np.repeat(np.arange(len(xs)), counts)
+        # Positions in "sorted_peaks" for the nonzero elements
+        positions = np.arange(indptr[-1]) - np.repeat(indptr[:-1] - lower, counts)
+        indices = order[positions]
+
+        data = self._smearing_function(xs[rows], peaks[indices], sigma)
+        return csr_matrix(
+            (data, indices, indptr), shape=(len(xs), len(peaks)))
+
+    def _create_fft_kernel(self, peaks):
+        """Create the grid and the deposition of the peaks on it.
+
+        Returns
+        -------
+        grid_min, dx, ngrid :
+            Minimum, pitch, and number of the grid points.
+        deposition : (npeaks, ngrid) csr_matrix
+            Linear interpolation of the peaks on the grid.
+        """
+        grid_min, dx, ngrid = self._create_fft_grid(peaks)
+
+        positions = (peaks - grid_min) / dx
+        is_inside = (positions >= 0.0) & (positions <= ngrid - 1)
+        indices = np.minimum(np.floor(positions), ngrid - 2).astype(int)
+        fractions = positions - indices
+        columns = np.arange(len(peaks))[is_inside]
+        deposition = csr_matrix(
+            (np.concatenate((1.0 - fractions[is_inside], fractions[is_inside])),
+             (np.concatenate((columns, columns)),
+              np.concatenate((indices[is_inside], indices[is_inside] + 1)))),
+            shape=(len(peaks), ngrid))
+        return grid_min, dx, ngrid, deposition
+
+    def _apply_fft_kernel(self, kernel, weights=None):
+        grid_min, dx, ngrid, deposition = kernel
+        xs = self._xs
+        if weights is None:
+            weights = np.ones(deposition.shape[0])
+        weights = np.asarray(weights)
+        if weights.shape[-1] == 0:
+            return self._create_zeros(weights)
+        # (nchannels, npeaks)
+        weights_2d = weights.reshape(-1, weights.shape[-1])
+
+        is_complex = np.iscomplexobj(weights_2d)
+        if is_complex:
+            # Real and imaginary parts are convolved separately by real FFTs.
+            weights_2d = np.vstack((weights_2d.real, weights_2d.imag))
+
+        # Deposit weights on the grid by linear interpolation.
+        # (nchannels, ngrid)
+        grid_weights = np.asarray(deposition.T.dot(weights_2d.T).T, order='C')
+
+        # Linear convolution with the smearing function
+        nfft, kernel_fft = self._get_kernel_fft(dx, ngrid)
+        tmp = np.fft.irfft(
+            np.fft.rfft(grid_weights, nfft, axis=-1) * kernel_fft, nfft, axis=-1)
+        grid_values = tmp[:, ngrid - 1:2 * ngrid - 1]
+
+        # Linear interpolation from the grid to xs
+        positions = (xs - grid_min) / dx
+        indices = np.clip(np.floor(positions).astype(int), 0, ngrid - 2)
+        fractions = positions - indices
+        values = ((1.0 - fractions) * grid_values[:, indices] +
+                  fractions * grid_values[:, indices + 1])
+
+        if is_complex:
+            nchannels = values.shape[0] // 2
+            values = values[:nchannels] + 1.0j * values[nchannels:]
+        return values.T.reshape(xs.shape + weights.shape[:-1])
+
+    def _create_zeros(self, weights):
+        """Get the smeared values when there are no peaks."""
+        return np.zeros(self._xs.shape + weights.shape[:-1],
+                        dtype=np.result_type(weights, float))
+
+    def _create_fft_grid(self, peaks):
+        """Create the uniform grid for the FFT method.
+
+        The pitch is the smallest interval of xs, but not larger than
+        sigma / fft_oversampling so that the smearing function is sampled
+        finely enough. The grid covers xs and the peaks within the cutoff
+        from xs, and therefore its size does not depend on the range of
+        the peaks.
+        """
+        xs = self._xs
+        dx = min(np.min(np.diff(xs)), self._sigma / self.fft_oversampling)
+        cutoff = self._cutoff
+        if cutoff is None:
+            cutoff = self.fft_default_cutoff
+        xmin = xs[0] - cutoff * self._sigma
+        xmax = xs[-1] + cutoff * self._sigma
+        nlower = int(np.ceil((xs[0] - xmin) / dx))
+        nupper = int(np.ceil((xmax - xs[0]) / dx))
+        grid_min = xs[0] - nlower * dx
+        ngrid = max(nlower + nupper + 1, 2)
+        return grid_min, dx, ngrid
+
+    def _get_kernel_fft(self, dx, ngrid):
+        """Get the FFT of the smearing function sampled on the grid.
+
+        This depends only on the grid and is therefore reused.
+        """
+        key = (dx, ngrid, self._sigma, self._function_name)
+        if key not in self._kernel_fft_cache:
+            nfft = next_fast_len(3 * ngrid - 2)
+            offsets = np.arange(-(ngrid - 1), ngrid) * dx
+            kernel = self._smearing_function(offsets, 0.0, self._sigma)
+            self._kernel_fft_cache = {key: (nfft, np.fft.rfft(kernel, nfft))}
+        return self._kernel_fft_cache[key]
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function
+
+__author__ = "Yuji Ikeda"
+
+import itertools
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+def get_tetrahedra_relative_addresses(microzone_lattice):
+    """Get the tetrahedra dividing a microzone.
+
+    The six tetrahedra share the shortest main diagonal of the microzone.
+
+    Parameters
+    ----------
+    microzone_lattice : (3, 3) array
+        Reciprocal basis vectors divided by the mesh numbers
+        as column vectors.
+
+    Returns
+    -------
+    relative_addresses : (6, 4, 3) array
+        Grid addresses of the vertices relative to the microzone.
+    """
+    starts = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1]])
+    directions = 1 - 2 * starts
+    lengths = np.linalg.norm(
+        np.dot(directions, np.transpose(microzone_lattice)), axis=1)
+    i = np.argmin(lengths)
+    start, direction = starts[i], directions[i]
+
+    relative_addresses = []
+    for axes in itertools.permutations(range(3)):
+        vertices = [start]
+        for axis in axes:
+            vertex = vertices[-1].copy()
+            vertex[axis] += direction[axis]
+            vertices.append(vertex)
+        relative_addresses.append(vertices)
+    return np.array(relative_addresses)
+
+
+def create_tetrahedra(grid_address, mesh, microzone_lattice):
+    """Create the tetrahedra filling the Brillouin zone.
+
+    Parameters
+    ----------
+    grid_address : (ngrid_points, 3) array
+        Grid addresses of all the grid points.
+    mesh : (3) array
+    microzone_lattice : (3, 3) array
+        See "get_tetrahedra_relative_addresses".
+
+    Returns
+    -------
+    tetrahedra : (6 * ngrid_points, 4) array
+        Indices of the grid points for the vertices.
+    """
+    mesh = np.asarray(mesh)
+    grid_address = np.asarray(grid_address)
+    relative_addresses = get_tetrahedra_relative_addresses(microzone_lattice)
+
+    lookup = np.zeros(np.prod(mesh), dtype=int)
+    lookup[_get_flat_indices(grid_address, mesh)] = np.arange(len(grid_address))
+
+    addresses = grid_address[:, None, None, :] + relative_addresses[None]
+    return lookup[_get_flat_indices(addresses, mesh)].reshape(-1, 4)
+
+
+def _get_flat_indices(addresses, mesh):
+    addresses = np.mod(addresses, mesh)
+    return addresses[..., 0] + mesh[0] * (
+        addresses[..., 1] + mesh[1] * addresses[..., 2])
+
+
+def create_tetrahedron_kernel(xs, energies):
+    """Create the integration weights of the delta function for the vertices.
+
+    Within each tetrahedron, energies and weights are interpolated linearly.
+    The density at x is then the sum of the weights at the vertices
+    multiplied by the kernel.
+
+    Parameters
+    ----------
+    xs : (nxs) array
+        Sorted points where the density is evaluated.
+    energies : (ntetrahedra, 4) array
+        Energies at the vertices.
+
+    Returns
+    -------
+    kernel : (nxs, ntetrahedra * 4) csr_matrix
+        Each tetrahedron is normalized so that the density integrates to
+        the average of the weights at the vertices.
+    """
+    energies = np.asarray(energies)
+    order = np.argsort(energies, axis=1)
+    sorted_energies = np.take_along_axis(energies, order, axis=1)
+
+    # Only xs within [e0, e3) are nonzero for each tetrahedron.
+    lower = np.searchsorted(xs, sorted_energies[:, 0], side='left')
+    upper = np.searchsorted(xs, sorted_energies[:, 3], side='left')
+    counts = upper - lower
+    indices = np.repeat(np.arange(len(energies)), counts)
+    offsets = np.cumsum(counts) - counts
+    rows = np.arange(np.sum(counts)) - np.repeat(offsets - lower, counts)
+
+    data = calculate_vertex_weights(xs[rows], sorted_energies[indices])
+    columns = 4 * indices[:, None] + order[indices]
+    return csr_matrix(
+        (data.ravel(), (np.repeat(rows, 4), columns.ravel())),
+        shape=(len(xs), 4 * len(energies)))
+
+
+def calculate_vertex_weights(xs, energies):
+    """Calculate the integration weights of the delta function.
+
+    Parameters
+    ----------
+    xs : (n) array
+        Points within [e0, e3).
+    energies : (n, 4) array
+        Sorted energies e0 <= e1 <= e2 <= e3 at the vertices.
+
+    Returns
+    -------
+    vertex_weights : (n, 4) array
+        Density of states of the tetrahedron at xs multiplied by
+        the coefficients of the vertices in the average over the
+        cross section at xs.
+    """
+    e0, e1, e2, e3 = np.transpose(energies)
+    vertex_weights = np.zeros((len(xs), 4))
+
+    # e0 <= x < e1: Triangle cut from the edges from the vertex 0
+    m = xs < e1
+    d = xs[m] - e0[m]
+    ts = d[:, None] / (energies[m, 1:] - e0[m, None])
+    dos = 3.0 * d ** 2 / np.prod(energies[m, 1:] - e0[m, None], axis=1)
+    vertex_weights[m, 0] = dos * (3.0 - np.sum(ts, axis=1)) / 3.0
+    vertex_weights[m, 1:] = dos[:, None] * ts / 3.0
+
+    # e2 <= x < e3: Triangle cut from the edges to the vertex 3
+    m = xs >= e2
+    d = e3[m] - xs[m]
+    ts = d[:, None] / (e3[m, None] - energies[m, :3])
+    dos = 3.0 * d ** 2 / np.prod(e3[m, None] - energies[m, :3], axis=1)
+    vertex_weights[m, 3] = dos * (3.0 - np.sum(ts, axis=1)) / 3.0
+    vertex_weights[m, :3] = dos[:, None] * ts / 3.0
+
+    # e1 <= x < e2: Quadrilateral divided into two triangles
+    m = (xs >= e1) & (xs < e2)
+    x = xs[m]
+    e0, e1, e2, e3 = np.transpose(energies[m])
+    # Barycentric coordinates of the vertices of the quadrilateral
+    p02 = _interpolate_on_edge(x, e0, e2, 0, 2)
+    p03 = _interpolate_on_edge(x, e0, e3, 0, 3)
+    p13 = _interpolate_on_edge(x, e1, e3, 1, 3)
+    p12 = _interpolate_on_edge(x, e1, e2, 1, 2)
+    # Affine maps keep the ratio of the areas on the cross section.
+    area_0 = _calculate_area(p02, p03, p13)
+    area_1 = _calculate_area(p02, p13, p12)
+    area = area_0 + area_1
+    area = np.where(area > 0.0, area, 1.0)
+    coefficients = (
+        area_0[:, None] * (p02 + p03 + p13) +
+        area_1[:, None] * (p02 + p13 + p12)) / (3.0 * area[:, None])
+    d = x - e1
+    dos = (3.0 * (e1 - e0) + 6.0 * d -
+           3.0 * (e2 - e0 + e3 - e1) * d ** 2 / ((e2 - e1) * (e3 - e1)))
+    dos /= (e2 - e0) * (e3 - e0)
+    vertex_weights[m] = dos[:, None] * coefficients
+
+    return vertex_weights
+
+
+def _interpolate_on_edge(x, ei, ej, i, j):
+    """Get the barycentric coordinates of the point at x on the edge i-j."""
+    t = (x - ei) / (ej - ei)
+    coordinates = np.zeros((len(x), 4))
+    coordinates[:, i] = 1.0 - t
+    coordinates[:, j] = t
+    return coordinates
+
+
+def _calculate_area(p0, p1, p2):
+    u = p1 - p0
+    v = p2 - p0
+    uu = np.sum(u * u, axis=1)
+    vv = np.sum(v * v, axis=1)
+    uv = np.sum(u * v, axis=1)
+    return 0.5 * np.sqrt(np.maximum(uu * vv - uv ** 2, 0.0))
@@ -129,7 +129,14 @@ class PhonopyUnfolding(Phonopy):
     def set_band_structure(self,
                            bands,
                            is_eigenvectors=False,
-                           is_band_connection=False):
+                           is_band_connection=False,
+                           layout="groups",
+                           compression=None,
+                           resume=False,
+                           write_queue_size=0,
+                           nprocs=1,
+                           spectral_functions=None,
+                           write_weights=True):
         if self._dynamical_matrix is None:
             print("Warning: Dynamical matrix has not yet built.")
             self._band_structure = None
@@ -146,6 +153,13 @@ class PhonopyUnfolding(Phonopy):
             factor=self._factor,
             star=self._star,
             mode=self._mode,
+            layout=layout,
+            compression=compression,
+            resume=resume,
+            write_queue_size=write_queue_size,
+            nprocs=nprocs,
+            spectral_functions=spectral_functions,
+            write_weights=write_weights,
             verbose=True)
         return True
 
@@ -156,7 +170,12 @@ class PhonopyUnfolding(Phonopy):
                  is_time_reversal=True,
                  is_mesh_symmetry=True,
                  is_eigenvectors=False,
-                 is_gamma_center=False):
+                 is_gamma_center=False,
+                 nprocs=1,
+                 dos=None,
+                 write_weights=False,
+                 layout="groups",
+                 compression=None):
         if self._dynamical_matrix is None:
             print("Warning: Dynamical matrix has not yet built.")
             self._mesh = None
@@ -178,7 +197,12 @@ class PhonopyUnfolding(Phonopy):
             rotations=self._primitive_symmetry.get_pointgroup_operations(),
             factor=self._factor,
             use_lapack_solver=self._use_lapack_solver,
-            mode=self._mode)
+            mode=self._mode,
+            nprocs=nprocs,
+            dos=dos,
+            write_weights=write_weights,
+            layout=layout,
+            compression=compression)
         return True
 
     # DOS
@@ -187,7 +211,8 @@ class PhonopyUnfolding(Phonopy):
                       freq_min=None,
                       freq_max=None,
                       freq_pitch=None,
-                      tetrahedron_method=False):
+                      tetrahedron_method=False,
+                      cutoff=None):
 
         if self._mesh is None:
             print("Warning: \'set_mesh\' has to finish correctly "
@@ -198,7 +223,8 @@ class PhonopyUnfolding(Phonopy):
         total_dos = TotalDosUnfolding(
             self._mesh,
             sigma=sigma,
-            tetrahedron_method=tetrahedron_method)
+            tetrahedron_method=tetrahedron_method,
+            cutoff=cutoff)
         total_dos.set_draw_area(freq_min, freq_max, freq_pitch)
         total_dos.run()
         self._total_dos = total_dos
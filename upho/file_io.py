@@ -30,12 +30,32 @@ def read_band_yaml(yaml_file="band.yaml"):
     return distance, frequency, weight, nsep
 
 
-def read_band_hdf5(hdf5_file="band.hdf5"):
+def read_band_hdf5(hdf5_file="band.hdf5", keys=None):
+    """Read band.hdf5 written in either of the layouts.
+
+    Parameters
+    ----------
+    hdf5_file : str
+        Filename.
+    keys : list of str
+        Names of the quantities to be read. If None, all are read.
+
+    Returns
+    -------
+    band_data : dict
+        "paths" and the quantities stacked as (npaths, npoints, ...) arrays,
+        where ragged axes are padded with zeros.
+    """
     import h5py
+    from upho.phonon.band_hdf5 import BandHDF5Reader
     band_data = {}
     with h5py.File(hdf5_file, "r") as f:
-        for key in f.keys():
-            band_data[key] = np.array(f[key])
+        reader = BandHDF5Reader(f)
+        band_data['paths'] = reader.get_paths()
+        if keys is None:
+            keys = reader.get_keys()
+        for key in keys:
+            band_data[key] = reader.load_stacked(key)
     return band_data
 
 
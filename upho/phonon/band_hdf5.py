@@ -0,0 +1,535 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Layouts of the HDF5 files storing data on q-points.
+
+Two layouts are supported.
+
+Format version 1 ("groups")
+    One HDF5 group "ipath/ip/" per q-point, containing one dataset per
+    quantity.
+Format version 2 ("stacked")
+    One dataset per quantity with the shape of (npaths, npoints, ...).
+    Axes whose lengths depend on the q-point (arms of the star and irreps)
+    are padded with zeros up to their maximum lengths, and the actual
+    lengths are stored in "num_arms" and "num_irreps".
+    Datasets are chunked so that one chunk corresponds to one q-point.
+
+The format version is stored as the attribute "format_version" of the root
+group. Files without this attribute are regarded as version 1.
+
+The data for a q-point are marked as completed after all of them are
+written; the attribute "is_completed" of the group in version 1 and the
+dataset "is_completed" in version 2. Runs can be resumed by reopening the
+file and computing only the q-points which are not completed.
+
+Both layouts have the small dataset "index" with one record per q-point,
+(path, point, distance, offset), where "offset" is the position of the
+q-point in the flattened (npaths, npoints) axes. It is used to select
+q-points without reading their groups. Distances of q-points not yet
+written are NaN.
+"""
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import numpy as np
+from upho.irreps.character_tables import MAX_IRREPS
+
+__author__ = 'Yuji Ikeda'
+
+FORMAT_VERSION_GROUPS = 1
+FORMAT_VERSION_STACKED = 2
+
+STRING_DTYPE = 'S16'
+
+# Leading axes of the quantities whose lengths depend on the q-point.
+RAGGED_AXES = {
+    'q_star'     : ('arms', ),
+    'frequencies': ('arms', ),
+    'weights_t'  : ('arms', ),
+    'weights_e'  : ('arms', ),
+    'weights_e2' : ('arms', ),
+    'weights_s'  : ('arms', 'irreps'),
+    'weights_s_e': ('arms', 'irreps'),
+    'ir_labels'  : ('irreps', ),
+}
+
+COUNT_KEYS = {
+    'arms'  : 'num_arms',
+    'irreps': 'num_irreps',
+}
+
+# Datasets in the stacked layout not corresponding to quantities.
+HEADER_KEYS = ('paths', 'is_completed', 'index')
+
+INDEX_DTYPE = np.dtype([
+    ('path', 'i4'),
+    ('point', 'i4'),
+    ('distance', 'f8'),
+    ('offset', 'i8'),
+])
+
+
+def get_format_version(hdf5_file):
+    return int(hdf5_file.attrs.get('format_version', FORMAT_VERSION_GROUPS))
+
+
+def create_group_name(ipath, ip):
+    return '{}/{}/'.format(ipath, ip)
+
+
+def parse_group_name(group):
+    ipath, ip = (int(x) for x in group.strip('/').split('/'))
+    return ipath, ip
+
+
+def mark_completed(hdf5_file, group=''):
+    hdf5_file[group or '/'].attrs['is_completed'] = True
+
+
+def is_completed(hdf5_file, group=''):
+    if group and group not in hdf5_file:
+        return False
+    return bool(hdf5_file[group or '/'].attrs.get('is_completed', False))
+
+
+def create_index(npaths, npoints):
+    index = np.zeros(npaths * npoints, dtype=INDEX_DTYPE)
+    index['path'] = np.repeat(np.arange(npaths), npoints)
+    index['point'] = np.tile(np.arange(npoints), npaths)
+    index['distance'] = np.nan
+    index['offset'] = np.arange(npaths * npoints)
+    return index
+
+
+def _load_header_value(dataset):
+    value = dataset[()]
+    if isinstance(value, bytes):
+        value = value.decode('ascii')
+    return value
+
+
+def write_header_dataset(hdf5_file, key, data):
+    """Write a dataset for the header.
+
+    If the dataset already exists, e.g. when resuming, it is checked to be
+    equal to "data" instead.
+    """
+    if key not in hdf5_file:
+        hdf5_file.create_dataset(key, data=data)
+        return
+    value = _load_header_value(hdf5_file[key])
+    if not np.array_equal(value, data):
+        raise ValueError(
+            '"{}" in {} is inconsistent with the present settings.'.format(
+                key, hdf5_file.filename))
+
+
+def write_header_attribute(hdf5_file, key, value):
+    """Write an attribute of the root group for the header.
+
+    If the attribute already exists, e.g. when resuming, it is checked to be
+    equal to "value" instead.
+    """
+    if key not in hdf5_file.attrs:
+        hdf5_file.attrs[key] = value
+        return
+    stored = np.array(hdf5_file.attrs[key])
+    if stored.dtype.kind in ('S', 'O'):
+        stored = stored.astype(str)
+    if not np.array_equal(stored, np.array(value)):
+        raise ValueError(
+            '"{}" in {} is {} but the present setting is {}.'.format(
+                key, hdf5_file.filename, stored, value))
+
+
+def create_padded_shape(key, shape, max_lengths):
+    """
+
+    Parameters
+    ----------
+    key : str
+        Name of the quantity.
+    shape : tuple
+        Shape of the quantity for one q-point.
+    max_lengths : dict
+        Maximum lengths of the ragged axes.
+    """
+    padded_shape = list(shape)
+    for i, axis in enumerate(RAGGED_AXES.get(key, ())):
+        padded_shape[i] = max_lengths[axis]
+    return tuple(padded_shape)
+
+
+def pad_array(array, padded_shape):
+    array = np.asarray(array)
+    if array.shape == padded_shape:
+        return array
+    padded_array = np.zeros(padded_shape, dtype=array.dtype)
+    padded_array[tuple(slice(0, n) for n in array.shape)] = array
+    return padded_array
+
+
+def create_writer(hdf5_file, layout='groups', **kwargs):
+    if layout == 'groups':
+        return BandHDF5Writer(hdf5_file, **kwargs)
+    elif layout == 'stacked':
+        return StackedBandHDF5Writer(hdf5_file, **kwargs)
+    else:
+        raise ValueError('Unknown layout', layout)
+
+
+class BandHDF5Writer(object):
+    """Writer for the layout with one group per q-point (version 1)."""
+    format_version = FORMAT_VERSION_GROUPS
+
+    def __init__(self,
+                 hdf5_file,
+                 compression=None,
+                 compression_opts=None,
+                 max_narms=None):
+        """
+
+        Parameters
+        ----------
+        hdf5_file : HDF5 file object
+        compression : str
+            Compression filter for non-scalar datasets ("gzip" or "lzf").
+        compression_opts :
+            Options for the compression filter.
+        max_narms : int
+            Maximum number of the arms of the star. Unused in this layout.
+        """
+        self._hdf5_file = hdf5_file
+        self._compression = compression
+        self._compression_opts = compression_opts
+
+    def get_hdf5_file(self):
+        return self._hdf5_file
+
+    def write_header(self, paths):
+        hdf5_file = self._hdf5_file
+        if 'paths' in hdf5_file:
+            if get_format_version(hdf5_file) != self.format_version:
+                raise ValueError(
+                    'Layout of {} is different.'.format(hdf5_file.filename))
+        hdf5_file.attrs['format_version'] = self.format_version
+        write_header_dataset(hdf5_file, 'paths', np.asarray(paths))
+        if 'index' not in hdf5_file:
+            hdf5_file.create_dataset(
+                'index', data=create_index(*np.asarray(paths).shape[:2]))
+
+    def is_completed(self, ipath, ip):
+        return is_completed(self._hdf5_file, create_group_name(ipath, ip))
+
+    def write_point(self, ipath, ip, data_dict):
+        self.clear_point(ipath, ip)
+        for k, v in data_dict.items():
+            self.write_dataset(ipath, ip, k, v)
+        self.mark_completed(ipath, ip)
+
+    def clear_point(self, ipath, ip):
+        """Remove remnants of an interrupted run."""
+        group = create_group_name(ipath, ip)
+        if group in self._hdf5_file:
+            del self._hdf5_file[group]
+
+    def write_dataset(self, ipath, ip, key, value):
+        value = np.asarray(value)
+        self._hdf5_file.create_dataset(
+            create_group_name(ipath, ip) + key,
+            data=value,
+            **self._create_filter_kwargs(value))
+        if key == 'distance':
+            self._update_index(ipath, ip, value)
+
+    def _update_index(self, ipath, ip, distance):
+        hdf5_file = self._hdf5_file
+        if 'index' not in hdf5_file:  # Files created by older versions
+            return
+        offset = ipath * hdf5_file['paths'].shape[1] + ip
+        record = hdf5_file['index'][offset]
+        record['distance'] = distance
+        hdf5_file['index'][offset] = record
+
+    def mark_completed(self, ipath, ip):
+        mark_completed(self._hdf5_file, create_group_name(ipath, ip))
+
+    def _create_filter_kwargs(self, array):
+        if self._compression is None or array.ndim == 0:
+            return {}
+        return {
+            'compression': self._compression,
+            'compression_opts': self._compression_opts,
+        }
+
+
+class StackedBandHDF5Writer(BandHDF5Writer):
+    """Writer for the layout with stacked datasets (version 2)."""
+    format_version = FORMAT_VERSION_STACKED
+
+    def __init__(self,
+                 hdf5_file,
+                 compression=None,
+                 compression_opts=None,
+                 max_narms=1):
+        super(StackedBandHDF5Writer, self).__init__(
+            hdf5_file,
+            compression=compression,
+            compression_opts=compression_opts)
+        self._max_lengths = {
+            'arms': max_narms,
+            'irreps': MAX_IRREPS,
+        }
+
+    def write_header(self, paths):
+        super(StackedBandHDF5Writer, self).write_header(paths)
+        self._npaths_npoints = np.asarray(paths).shape[:2]
+        if 'is_completed' not in self._hdf5_file:
+            self._hdf5_file.create_dataset(
+                'is_completed', shape=self._npaths_npoints, dtype=bool)
+
+    def is_completed(self, ipath, ip):
+        return bool(self._hdf5_file['is_completed'][ipath, ip])
+
+    def clear_point(self, ipath, ip):
+        pass  # Data are overwritten.
+
+    def write_dataset(self, ipath, ip, key, value):
+        hdf5_file = self._hdf5_file
+        value = np.asarray(value)
+        padded_shape = create_padded_shape(key, value.shape, self._max_lengths)
+        if key not in hdf5_file:
+            self._create_dataset(key, padded_shape, value.dtype)
+        hdf5_file[key][ipath, ip] = pad_array(value, padded_shape)
+        if key == 'distance':
+            self._update_index(ipath, ip, value)
+
+    def mark_completed(self, ipath, ip):
+        self._hdf5_file['is_completed'][ipath, ip] = True
+
+    def _create_dataset(self, key, padded_shape, dtype):
+        if dtype.kind == 'S':
+            dtype = np.dtype(STRING_DTYPE)
+        shape = tuple(self._npaths_npoints) + padded_shape
+        kwargs = {}
+        if len(padded_shape) > 0:
+            # One chunk per q-point.
+            kwargs['chunks'] = (1, 1) + padded_shape
+            kwargs.update(self._create_filter_kwargs(np.empty(padded_shape)))
+        self._hdf5_file.create_dataset(key, shape=shape, dtype=dtype, **kwargs)
+
+
+class BackgroundWriter(object):
+    """Write q-point data in a background thread.
+
+    Data passed to "write_point" are put into a bounded queue and written by
+    the wrapped writer in a dedicated thread, so that the calculation for
+    the next q-point can proceed while the present one is written.
+    When the queue is full, "write_point" blocks until a slot is freed,
+    which limits the number of q-points held in memory.
+
+    The data must not be modified after being passed to "write_point".
+    Errors in the thread are raised in the calling thread at the next call
+    of "write_point" or "close".
+    """
+    _sentinel = None
+
+    def __init__(self, writer, maxsize=2):
+        """
+
+        Parameters
+        ----------
+        writer : BandHDF5Writer
+        maxsize : int
+            Maximum number of q-points waiting to be written.
+        """
+        self._writer = writer
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Pending data are still written for a possible resumption.
+        self.close(is_raised=(exc_type is None))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is self._sentinel:
+                return
+            if self._error is not None:
+                continue  # Discard data to keep the queue flowing.
+            try:
+                self._writer.write_point(*item)
+            except Exception as e:
+                self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def get_hdf5_file(self):
+        return self._writer.get_hdf5_file()
+
+    def is_completed(self, ipath, ip):
+        return self._writer.is_completed(ipath, ip)
+
+    def write_point(self, ipath, ip, data_dict):
+        self._raise_error()
+        self._queue.put((ipath, ip, data_dict))
+
+    def close(self, is_raised=True):
+        if self._thread.is_alive():
+            self._queue.put(self._sentinel)
+            self._thread.join()
+        if is_raised:
+            self._raise_error()
+
+
+class BandHDF5Reader(object):
+    """Reader of q-point data supporting both layouts."""
+    def __init__(self, hdf5_file):
+        self._hdf5_file = hdf5_file
+        self._format_version = get_format_version(hdf5_file)
+
+    def get_hdf5_file(self):
+        return self._hdf5_file
+
+    def get_format_version(self):
+        return self._format_version
+
+    def get_paths(self):
+        return np.array(self._hdf5_file['paths'])
+
+    def get_npaths_npoints(self):
+        return self._hdf5_file['paths'].shape[:2]
+
+    def get_keys(self):
+        """Get names of the quantities stored for each q-point."""
+        hdf5_file = self._hdf5_file
+        if self._format_version == FORMAT_VERSION_STACKED:
+            return [k for k in hdf5_file.keys() if k not in HEADER_KEYS]
+        return list(hdf5_file[create_group_name(0, 0)].keys())
+
+    def get_index(self):
+        """Get (path, point, distance, offset) for all the q-points.
+
+        For files without "index", it is created from the distances.
+        """
+        hdf5_file = self._hdf5_file
+        if 'index' in hdf5_file:
+            return np.array(hdf5_file['index'])
+
+        npaths, npoints = self.get_npaths_npoints()
+        index = create_index(npaths, npoints)
+        for i, (ipath, ip) in enumerate(zip(index['path'], index['point'])):
+            group = create_group_name(ipath, ip)
+            if self._format_version == FORMAT_VERSION_STACKED:
+                if not self.is_completed(group):
+                    continue
+            elif group not in hdf5_file:
+                continue
+            index['distance'][i] = self.load(group, 'distance')
+        return index
+
+    def select(self, ipaths=None, ips=None, distance_range=None):
+        """Select q-points using the index.
+
+        Parameters
+        ----------
+        ipaths : list of int
+            Indices of the paths.
+        ips : slice or list of int
+            Indices of the points on each path.
+        distance_range : (2) array
+            Minimum and maximum of the distances (inclusive).
+
+        Returns
+        -------
+        groups : list of str
+            "ipath/ip/" for the selected q-points in the order of "offset".
+        """
+        npoints = self.get_npaths_npoints()[1]
+        index = self.get_index()
+        mask = np.ones(len(index), dtype=bool)
+        if ipaths is not None:
+            mask &= np.isin(index['path'], ipaths)
+        if ips is not None:
+            mask &= np.isin(index['point'], np.arange(npoints)[ips])
+        if distance_range is not None:
+            dmin, dmax = distance_range
+            distances = index['distance']
+            mask &= (distances >= dmin) & (distances <= dmax)
+        return [create_group_name(ipath, ip)
+                for ipath, ip in zip(index['path'][mask], index['point'][mask])]
+
+    def is_completed(self, group):
+        if self._format_version == FORMAT_VERSION_STACKED:
+            ipath, ip = parse_group_name(group)
+            return bool(self._hdf5_file['is_completed'][ipath, ip])
+        return is_completed(self._hdf5_file, group)
+
+    def contains(self, group, key):
+        if self._format_version == FORMAT_VERSION_STACKED:
+            return key in self._hdf5_file
+        return group + key in self._hdf5_file
+
+    def load(self, group, key):
+        """Load the data for one q-point.
+
+        Parameters
+        ----------
+        group : str
+            "ipath/ip/" for the q-point.
+        key : str
+            Name of the quantity.
+
+        Returns
+        -------
+        Array without padding.
+        """
+        hdf5_file = self._hdf5_file
+        if self._format_version != FORMAT_VERSION_STACKED:
+            return np.array(hdf5_file[group + key])
+
+        ipath, ip = parse_group_name(group)
+        slices = tuple(
+            slice(0, int(hdf5_file[COUNT_KEYS[axis]][ipath, ip]))
+            for axis in RAGGED_AXES.get(key, ()))
+        return np.array(hdf5_file[key][(ipath, ip) + slices])
+
+    def load_stacked(self, key):
+        """Load the data for all the q-points.
+
+        Returns
+        -------
+        (npaths, npoints, ...) array.
+            Ragged axes are padded with zeros.
+        """
+        hdf5_file = self._hdf5_file
+        if self._format_version == FORMAT_VERSION_STACKED:
+            return np.array(hdf5_file[key])
+
+        npaths, npoints = self.get_npaths_npoints()
+        arrays = [
+            [self.load(create_group_name(ipath, ip), key)
+             for ip in range(npoints)]
+            for ipath in range(npaths)
+        ]
+        shapes = [a.shape for row in arrays for a in row]
+        padded_shape = tuple(np.max(shapes, axis=0)) if shapes[0] else ()
+        dtype = np.result_type(*[a.dtype for row in arrays for a in row])
+        stacked = np.zeros((npaths, npoints) + padded_shape, dtype=dtype)
+        for ipath in range(npaths):
+            for ip in range(npoints):
+                stacked[ipath, ip] = pad_array(arrays[ipath][ip], padded_shape)
+        return stacked
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import os
+import h5py
+import numpy as np
+from upho.phonon.band_hdf5 import (
+    create_writer, create_group_name, is_completed)
+
+__author__ = 'Yuji Ikeda'
+
+
+class BandMerger(object):
+    """Consolidate q-point shards into one band.hdf5.
+
+    The input is the "band.hdf5" created by "separation", whose groups
+    "ipath/ip/" are external links to "ipath/ip/point.hdf5" written by
+    "SinglePoint". The data of the shards are copied physically into the
+    output file, so that the shards are not needed any more.
+
+    Shards are copied one dataset at a time, so that the memory usage is
+    bounded by the largest dataset for one q-point.
+    """
+    # Quantities which must be the same for all the q-points.
+    consistent_keys = ['natoms_primitive', 'elements']
+
+    # Quantities written by "SinglePoint" for each q-point.
+    band_keys = [
+        'point',
+        'q_star',
+        'distance',
+        'natoms_primitive',
+        'elements',
+        'num_arms',
+        'pointgroup_symbol',
+        'num_irreps',
+        'ir_labels',
+        'frequencies',
+        'weights_t',
+        'weights_e',
+        'weights_s',
+        'weights_s_e',
+        'weights_e2',
+    ]
+
+    def __init__(self,
+                 filename='band.hdf5',
+                 filename_out=None,
+                 layout='groups',
+                 compression=None,
+                 prec=1e-6,
+                 accepts_legacy=False):
+        """
+
+        Parameters
+        ----------
+        filename : str
+            "band.hdf5" with external links to the shards.
+        filename_out : str
+            Output filename. If None, "filename" is replaced.
+        layout : str
+            Layout of the output file, "groups" or "stacked".
+        compression : str
+            Compression filter of the output file, "gzip" or "lzf".
+        prec : float
+            Tolerance to check q-points in the shards against "paths".
+        accepts_legacy : bool
+            If True, shards without the completion marker, i.e., those
+            written by older versions, are regarded as completed when they
+            have all of "band_keys".
+        """
+        if filename_out is None:
+            filename_out = filename
+        self._filename = filename
+        self._filename_out = filename_out
+        self._layout = layout
+        self._compression = compression
+        self._prec = prec
+        self._accepts_legacy = accepts_legacy
+
+    def run(self):
+        with h5py.File(self._filename, 'r') as f:
+            self._paths = np.array(f['paths'])
+            self._shards = self._find_shards(f)
+
+        self._validate_shards()
+
+        # A temporary file is used since the input may be overwritten.
+        filename_tmp = self._filename_out + '.tmp'
+        with h5py.File(filename_tmp, 'w') as f:
+            writer = create_writer(
+                f,
+                layout=self._layout,
+                compression=self._compression,
+                max_narms=self._max_narms)
+            writer.write_header(self._paths)
+            for (ipath, ip), shard in sorted(self._shards.items()):
+                print(ipath, ip)
+                self._copy_shard(writer, ipath, ip, shard)
+        os.rename(filename_tmp, self._filename_out)
+
+    def _find_shards(self, hdf5_file):
+        """Find the file and the group storing the data for each q-point.
+
+        Returns
+        -------
+        shards : dict
+            Keys are (ipath, ip), and values are (filename, group).
+        """
+        dirname = os.path.dirname(os.path.abspath(self._filename))
+        npaths, npoints = self._paths.shape[:2]
+        shards = {}
+        missing = []
+        for ipath in range(npaths):
+            for ip in range(npoints):
+                group = create_group_name(ipath, ip).rstrip('/')
+                link = hdf5_file.get(group, getlink=True)
+                if isinstance(link, h5py.ExternalLink):
+                    filename = os.path.join(dirname, link.filename)
+                    shard = (filename, link.path)
+                elif link is not None:
+                    shard = (os.path.abspath(self._filename), group)
+                else:
+                    shard = None
+                if shard is None or not os.path.isfile(shard[0]):
+                    missing.append(group)
+                    continue
+                shards[ipath, ip] = shard
+        if missing:
+            raise ValueError('Shards are missing for {}'.format(missing))
+        return shards
+
+    def _validate_shards(self):
+        """Check completeness and consistency of the shards."""
+        reference = None
+        max_narms = 1
+        for (ipath, ip), (filename, group) in sorted(self._shards.items()):
+            with h5py.File(filename, 'r') as f:
+                point_data = f[group]
+                if not self._is_shard_completed(f, group):
+                    raise ValueError(
+                        'Shard for {}/{}/ is not completed: {}'.format(
+                            ipath, ip, filename))
+                metadata = {
+                    k: np.array(point_data[k]) for k in self.consistent_keys}
+                metadata['keys'] = sorted(point_data.keys())
+                metadata['nbands'] = point_data['frequencies'].shape[-1]
+                if reference is None:
+                    reference = metadata
+                for k, v in metadata.items():
+                    if not np.array_equal(v, reference[k]):
+                        raise ValueError(
+                            'Inconsistent "{}" in {}'.format(k, filename))
+                point = np.array(point_data['point'])
+                if np.any(np.abs(point - self._paths[ipath, ip]) > self._prec):
+                    raise ValueError(
+                        'q-point in {} differs from "paths"'.format(filename))
+                max_narms = max(max_narms, int(np.array(point_data['num_arms'])))
+        self._max_narms = max_narms
+
+    def _is_shard_completed(self, hdf5_file, group):
+        if is_completed(hdf5_file, group):
+            return True
+        if not self._accepts_legacy:
+            return False
+        return all(k in hdf5_file[group] for k in self.band_keys)
+
+    def _copy_shard(self, writer, ipath, ip, shard):
+        filename, group = shard
+        with h5py.File(filename, 'r') as f:
+            point_data = f[group]
+            for k in point_data.keys():
+                writer.write_dataset(ipath, ip, k, point_data[k][()])
+        writer.mark_completed(ipath, ip)
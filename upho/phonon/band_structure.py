@@ -2,11 +2,16 @@
 # -*- coding: utf-8 -*-
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
+import functools
 import h5py
 import numpy as np
 from phonopy.units import VaspToTHz
 from phonopy.structure.cells import get_primitive
 from upho.phonon.eigenstates import Eigenstates
+from upho.phonon.band_hdf5 import (
+    create_writer, write_header_attribute, BandHDF5Writer, BackgroundWriter)
+from upho.phonon.density_extractor import DensityExtractorHDF5
+from upho.phonon.parallel import imap_in_workers, share_force_constants
 
 __author__ = 'Yuji Ikeda'
 
@@ -23,6 +28,13 @@ class BandStructure(object):
                  factor=VaspToTHz,
                  star="none",
                  mode="eigenvector",
+                 layout="groups",
+                 compression=None,
+                 resume=False,
+                 write_queue_size=0,
+                 nprocs=1,
+                 spectral_functions=None,
+                 write_weights=True,
                  verbose=False):
         """
 
@@ -31,6 +43,28 @@ class BandStructure(object):
                 Dynamical matrix for the (disordered) supercell.
             primitive_ideal_wrt_unitcell:
                 Primitive cell w.r.t. the unitcell (not the supercell).
+            layout:
+                Layout of "band.hdf5", "groups" or "stacked".
+                See "upho.phonon.band_hdf5".
+            compression:
+                Compression filter for "band.hdf5", "gzip" or "lzf".
+            resume:
+                If True, the existing "band.hdf5" is reopened and only
+                q-points not yet completed are calculated.
+            write_queue_size:
+                If positive, "band.hdf5" is written in a background thread
+                with a queue of this size, overlapping output with the
+                calculation of the following q-points.
+            nprocs:
+                Number of processes among which q-points are distributed.
+            spectral_functions:
+                If given, spectral functions are calculated on the fly
+                and written to "sf.hdf5". This is a dict of the parameters
+                for "DensityExtractor", e.g. "function", "sigma", "fmin",
+                "fmax", "fpitch", "is_squared", "cutoff", and "method".
+            write_weights:
+                If False, "band.hdf5" is not written. This is useful with
+                "spectral_functions" to avoid storing the large weights.
         """
         # ._dynamical_matrix must be assigned for calculating DOS
         # using the tetrahedron method.
@@ -59,6 +93,7 @@ class BandStructure(object):
 
         self._star = star
         self._mode = mode
+        self._nprocs = nprocs
 
         self._eigenstates = Eigenstates(
             dynamical_matrix,
@@ -68,13 +103,75 @@ class BandStructure(object):
             star=star,
             verbose=verbose)
 
-        with h5py.File('band.hdf5', 'w') as f:
-            self._hdf5_file = f
+        self._write_weights = write_weights
+        self._extractor = None
+        if spectral_functions is not None:
+            self._extractor = DensityExtractorHDF5(**spectral_functions)
+        elif not write_weights:
+            raise ValueError('Nothing is written without weights and '
+                             'spectral functions.')
+
+        # Writers are in the same order as the data from "solve_dm_on_point".
+        self._filenames = []
+        if write_weights:
+            self._filenames.append('band.hdf5')
+        if self._extractor is not None:
+            self._filenames.append('sf.hdf5')
+        files = []
+        self._writers = []
+        try:
+            if write_weights:
+                files.append(h5py.File('band.hdf5', 'a' if resume else 'w'))
+                self._writers.append(create_writer(
+                    files[-1],
+                    layout=layout,
+                    compression=compression,
+                    max_narms=self._eigenstates.get_max_narms()))
+            if self._extractor is not None:
+                files.append(h5py.File('sf.hdf5', 'a' if resume else 'w'))
+                self._writers.append(BandHDF5Writer(files[-1]))
             self._write_hdf5_header()
-            self._set_band(verbose=verbose)
+            if write_queue_size > 0:
+                self._writers = [BackgroundWriter(writer, write_queue_size)
+                                 for writer in self._writers]
+                try:
+                    self._set_band(verbose=verbose)
+                finally:
+                    # Pending data are still written for a possible resumption.
+                    for writer in self._writers:
+                        writer.close(is_raised=False)
+                # Errors in the writing threads are raised.
+                for writer in self._writers:
+                    writer.close()
+            else:
+                self._set_band(verbose=verbose)
+        finally:
+            for f in files:
+                f.close()
 
     def _write_hdf5_header(self):
-        self._hdf5_file.create_dataset('paths', data=self._paths)
+        """Write the header.
+
+        When resuming, the settings are checked to be the same as those
+        for the existing files.
+        """
+        for writer in self._writers:
+            hdf5_file = writer.get_hdf5_file()
+            write_header_attribute(hdf5_file, 'star', self._star)
+            write_header_attribute(hdf5_file, 'mode', self._mode)
+            write_header_attribute(hdf5_file, 'outputs', self._filenames)
+        writers = list(self._writers)
+        if self._extractor is not None:
+            self._extractor.print_header(writers.pop(), self._paths)
+        for writer in writers:
+            writer.write_header(self._paths)
+
+    def _is_completed(self, ipath, ip):
+        return all(w.is_completed(ipath, ip) for w in self._writers)
+
+    def _write_point(self, ipath, ip, data_dicts):
+        for writer, data_dict in zip(self._writers, data_dicts):
+            writer.write_point(ipath, ip, data_dict)
 
     def _set_initial_point(self, qpoint):
         self._lastq = qpoint.copy()
@@ -86,28 +183,41 @@ class BandStructure(object):
         self._lastq = qpoint.copy()
 
     def _set_band(self, verbose=False):
+        if self._dynamical_matrix.is_nac():
+            raise ValueError('NAC is not implemented yet for unfolding')
+
+        tasks = self._create_tasks()
+
+        if self._nprocs > 1:
+            self._solve_dm_in_parallel(tasks)
+        else:
+            for task in tasks:
+                self._write_point(*solve_dm_on_point(
+                    self._eigenstates, self._extractor, self._write_weights,
+                    *task))
+
+    def _create_tasks(self):
+        """Create (ipath, ip, q, distance) for q-points to be calculated."""
+        tasks = []
         for ipath, path in enumerate(self._paths):
             self._set_initial_point(path[0])
-            self._solve_dm_on_path(ipath, path, verbose)
+            for ip, q in enumerate(path):
+                self._shift_point(q)
+                if self._is_completed(ipath, ip):
+                    print('Skip completed q-point:', ipath, ip)
+                    continue
+                tasks.append((ipath, ip, q, self._distance))
 
             self._special_point.append(self._distance)
+        return tasks
 
-    def _solve_dm_on_path(self, ipath, path, verbose):
-        eigenstates = self._eigenstates
-
-        is_nac = self._dynamical_matrix.is_nac()
-
-        for ip, q in enumerate(path):
-            self._shift_point(q)
-
-            if is_nac:
-                raise ValueError('NAC is not implemented yet for unfolding')
-
-            eigenstates.set_distance(self._distance)
-            eigenstates.extract_eigenstates(q)
-
-            group = '{}/{}/'.format(ipath, ip)
-            eigenstates.write_hdf5(self._hdf5_file, group=group)
+    def _solve_dm_in_parallel(self, tasks):
+        share_force_constants(self._dynamical_matrix)
+        function = functools.partial(
+            solve_dm_on_point,
+            self._eigenstates, self._extractor, self._write_weights)
+        for result in imap_in_workers(self._nprocs, function, tasks):
+            self._write_point(*result)
 
     def get_unitcell_orig(self):
         unitcell_orig = self._dynamical_matrix.get_primitive()
@@ -118,3 +228,25 @@ class BandStructure(object):
         elements = unitcell_orig.get_chemical_symbols()
         reduced_elements = sorted(set(elements), key=elements.index)
         return reduced_elements
+
+
+def solve_dm_on_point(eigenstates, extractor, write_weights,
+                      ipath, ip, q, distance):
+    """Solve the dynamical matrix at a q-point.
+
+    Returns
+    -------
+    ipath, ip : int
+    data_dicts : list
+        Data for "band.hdf5" if "write_weights" and then that for "sf.hdf5"
+        if "extractor" is not None.
+    """
+    eigenstates.set_distance(distance)
+    eigenstates.extract_eigenstates(q)
+    data_dict = eigenstates.get_data_dict()
+    data_dicts = []
+    if write_weights:
+        data_dicts.append(data_dict)
+    if extractor is not None:
+        data_dicts.append(extractor.create_sf_data_dict(data_dict))
+    return ipath, ip, data_dicts
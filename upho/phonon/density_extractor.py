@@ -3,7 +3,11 @@
 from __future__ import absolute_import, print_function, unicode_literals
 import h5py
 import numpy as np
-from upho.analysis.smearing import Smearing, create_points
+from upho.analysis.smearing import (
+    Smearing, create_points, create_adaptive_points)
+from upho.phonon.band_hdf5 import (
+    BandHDF5Reader, BandHDF5Writer, parse_group_name, write_header_dataset)
+from upho.phonon.parallel import imap_in_workers
 
 
 __author__ = "Yuji Ikeda"
@@ -14,7 +18,72 @@ def square_frequencies(frequencies):
     return frequencies_2
 
 
+def unsquare_frequencies(frequencies_2):
+    frequencies = np.sign(frequencies_2) * np.sqrt(np.abs(frequencies_2))
+    return frequencies
+
+
+def extract_weights(point_data):
+    """Extract weights from the data for one q-point in "band.hdf5"."""
+    weights = {}
+    weights['total'] = point_data['weights_t'  ]
+    weights['E1'   ] = point_data['weights_e'  ]
+    weights['SR'   ] = point_data['weights_s'  ]
+    weights['SR_E1'] = point_data['weights_s_e']
+    if 'weights_e2' in point_data:
+        weights['E2'   ] = point_data['weights_e2' ]
+    return weights
+
+
+class PeakContext(object):
+    """Smearing kernels for the peaks at one q-point.
+
+    The kernels depend only on the peak positions, and therefore they are
+    created once and applied to all the weight channels ("total", "SR",
+    "E1", "SR_E1", and "E2"). Only the contraction with the weights
+    differs among the channels.
+    """
+    def __init__(self, smearings, energies):
+        """
+
+        Parameters
+        ----------
+        smearings : list of Smearing
+            One for each sigma.
+        energies : (num_arms, nbands) array
+            Peak positions (THz or THz^2).
+        """
+        self._smearings = smearings
+        # Arms are flattened into the axis of peaks
+        # since they contribute to the same spectral function.
+        self._peaks = np.asarray(energies).reshape(-1)
+        # The peaks are sorted once for all the sigmas.
+        order = np.argsort(self._peaks, kind='mergesort')
+        self._kernels = [
+            s.create_kernel(self._peaks, order) for s in smearings]
+
+    def calculate_density(self, weights):
+        """
+
+        Parameters
+        ----------
+        weights : (num_arms, ... , nbands) array
+
+        Returns
+        -------
+        density_data : list of (nfreqs, ...) arrays
+            One for each sigma.
+        """
+        weights = np.moveaxis(np.asarray(weights), 0, -2)
+        weights = weights.reshape(weights.shape[:-2] + (-1, ))
+        return [s.apply_kernel(k, weights)
+                for s, k in zip(self._smearings, self._kernels)]
+
+
 class DensityExtractor(object):
+    # Peaks with smaller total weights are ignored to refine the grid.
+    adaptive_threshold = 1e-3
+
     def __init__(self,
                  filename=None,
                  function="gaussian",
@@ -23,27 +92,85 @@ class DensityExtractor(object):
                  fpitch=0.05,
                  sigma=1.0,
                  is_squared=True,
-                 group=None):
+                 group=None,
+                 resume=False,
+                 cutoff=None,
+                 method="direct",
+                 nprocs=1,
+                 ipaths=None,
+                 ips=None,
+                 distance_range=None,
+                 fpitch_fine=None,
+                 adaptive_width=5.0):
+        """
+
+        Parameters
+        ----------
+        filename : str
+            Filename of the weights data, e.g. "band.hdf5".
+            If None, nothing is read, and the object is used to calculate
+            spectral functions for the data given directly.
+        sigma : float or list of float
+            Parameter(s) for the smearing function.
+            For a list, spectral functions are calculated for all the
+            values in one pass over the data, and an extra axis for sigma
+            is prepended to the spectral functions.
+        group : str
+            "ipath/ip/" of the only q-point to be calculated.
+        nprocs : int
+            Number of processes among which q-points are distributed.
+            Only for the HDF5 format.
+        ipaths : list of int
+            Indices of the paths to be calculated.
+        ips : slice or list of int
+            Indices of the points on each path to be calculated.
+        distance_range : (2) array
+            Minimum and maximum of the distances to be calculated.
+        fpitch_fine : float
+            If given, the frequency grid is adaptive for each q-point;
+            the pitch is refined to "fpitch_fine" within "adaptive_width"
+            times sigma from the peaks with non-negligible weights, and is
+            "fpitch" elsewhere. The grid is stored for each q-point.
+        adaptive_width : float
+            Half width of the refined intervals in units of sigma.
+        """
 
+        self._filename = filename
+        self._nprocs = nprocs
         self._is_squared = is_squared
         self._group = group
+        self._selection = {
+            'ipaths': ipaths,
+            'ips': ips,
+            'distance_range': distance_range,
+        }
+        self._resume = resume
+
+        self._is_multi_sigma = (np.ndim(sigma) > 0)
+        self._smearings = [
+            Smearing(
+                function_name=function,
+                sigma=s,
+                cutoff=cutoff,
+                method=method,
+            ) for s in np.atleast_1d(sigma)
+        ]
+        self._smearing = self._smearings[0]
 
-        self._smearing = Smearing(
-            function_name=function,
-            sigma=sigma,
-        )
+        self._fmin = fmin
+        self._fmax = fmax
+        self._fpitch = fpitch
+        self._fpitch_fine = fpitch_fine
+        self._adaptive_width = adaptive_width
 
         frequencies = create_points(fmin, fmax, fpitch)
         self.set_evaluated_energies(frequencies)
+        self._set_points(frequencies)
 
-        if is_squared:
-            energies = square_frequencies(frequencies)
-        else:
-            energies = frequencies
-        self._smearing.set_xs(energies)
-
+        if filename is None:
+            return
         with h5py.File(filename, 'r') as f:
-            self._band_data = f
+            self._band_data = BandHDF5Reader(f)
             self._run()
 
     def set_evaluated_energies(self, evaluated_energies):
@@ -52,35 +179,115 @@ class DensityExtractor(object):
     def get_evaluated_energies(self):
         return np.copy(self._evaluated_energies)
 
+    def get_sigma(self):
+        """Get sigma as given, i.e., a float or an array for multi-sigma."""
+        sigmas = np.array([s.get_sigma() for s in self._smearings])
+        return sigmas if self._is_multi_sigma else sigmas[0]
+
+    def is_adaptive(self):
+        return self._fpitch_fine is not None
+
+    def _set_points(self, frequencies):
+        if self._is_squared:
+            energies = square_frequencies(frequencies)
+        else:
+            energies = frequencies
+        for smearing in self._smearings:
+            smearing.set_xs(energies)
+
+    def _create_adaptive_points(self, energies, weights_total):
+        """Create the frequency grid refined around the peaks.
+
+        Parameters
+        ----------
+        energies : (num_arms, nbands) array
+            Peak positions (THz or THz^2).
+        weights_total : (num_arms, nbands) array
+        """
+        sigma = min(s.get_sigma() for s in self._smearings)
+        width = self._adaptive_width * sigma
+        peaks = energies[weights_total > self.adaptive_threshold]
+        lowers = peaks - width
+        uppers = peaks + width
+        if self._is_squared:
+            lowers = unsquare_frequencies(lowers)
+            uppers = unsquare_frequencies(uppers)
+        return create_adaptive_points(
+            self._fmin, self._fmax, self._fpitch, self._fpitch_fine,
+            lowers, uppers)
+
+    def calculate_spectral_functions_on_points(self, energies, weights):
+        """Calculate spectral functions on the grid for the q-point.
+
+        Returns
+        -------
+        frequencies : array
+            Frequency grid. This depends on the q-point if adaptive.
+        spectral_functions : dict
+        """
+        if self.is_adaptive():
+            frequencies = self._create_adaptive_points(
+                energies, np.asarray(weights['total']))
+            self._set_points(frequencies)
+        else:
+            frequencies = self._evaluated_energies
+        spectral_functions = self.calculate_spectral_functions(energies, weights)
+        return frequencies, spectral_functions
+
     def _run(self):
         raise NotImplementedError
 
+    def _select_groups(self):
+        """Select q-points to be calculated using the index.
+
+        Files with "index" mark completed q-points, and the others, e.g.
+        those left by an interrupted run, are skipped. Files without "index"
+        are written by older versions, where all the existing q-points are
+        used.
+        """
+        if self._group is not None:
+            return [self._group]
+        band_data = self._band_data
+        is_marked = 'index' in band_data.get_hdf5_file()
+        groups = []
+        for group in band_data.select(**self._selection):
+            if is_marked:
+                if not band_data.is_completed(group):
+                    print('Skip incomplete q-point:', *parse_group_name(group))
+                    continue
+            elif group not in band_data.get_hdf5_file():
+                continue
+            groups.append(group)
+        return groups
+
     def _load_weights(self, group):
         band_data = self._band_data
-        weights = {}
-        weights['total'] = band_data[group + 'weights_t'  ]
-        weights['E1'   ] = band_data[group + 'weights_e'  ]
-        weights['SR'   ] = band_data[group + 'weights_s'  ]
-        weights['SR_E1'] = band_data[group + 'weights_s_e']
-        if group + 'weights_e2' in band_data:
-            weights['E2'   ] = band_data[group + 'weights_e2' ]
-        return weights
+        keys = ['weights_t', 'weights_e', 'weights_s', 'weights_s_e',
+                'weights_e2']
+        point_data = {}
+        for k in keys:
+            if band_data.contains(group, k):
+                point_data[k] = band_data.load(group, k)
+        return extract_weights(point_data)
 
     def _load_distance(self, group):
-        distance = self._band_data[group + 'distance']
-        distance = float(np.array(distance))
+        distance = self._band_data.load(group, 'distance')
+        distance = float(distance)
         return distance
 
     def _load_frequencies(self, group):
-        frequencies = self._band_data[group + 'frequencies']
+        frequencies = self._band_data.load(group, 'frequencies')
         return frequencies
 
     def calculate_spectral_functions(self, frequencies, weights, is_SR_E1=True):
+        # Kernels are created once and shared among the weights.
+        context = PeakContext(self._smearings, frequencies)
         spectral_functions = {}
         for k, v in weights.items():
             if k == 'SR_E1' and not is_SR_E1:
                 continue
-            spectral_functions[k] = self.calculate_density(frequencies, v)
+            spectral_functions[k] = self._stack_sigmas(
+                context.calculate_density(v))
         return spectral_functions
 
     def calculate_density(self, frequencies, weights):
@@ -90,12 +297,18 @@ class DensityExtractor(object):
         ----------
         frequencies : (num_arms, nbands) array
         weights : (num_arms, ... , nbands) array
+
+        Returns
+        -------
+        density_data : (nfreqs, ...) or (nsigmas, nfreqs, ...) array
         """
-        density_data = []
-        for f, w in zip(frequencies, weights):
-            density_data.append(self._smearing.run(f, w))
-        density_data = np.sum(density_data, axis=0)  # Sum over arms
-        return density_data
+        context = PeakContext(self._smearings, frequencies)
+        return self._stack_sigmas(context.calculate_density(weights))
+
+    def _stack_sigmas(self, density_data):
+        if self._is_multi_sigma:
+            return np.array(density_data)
+        return density_data[0]
 
     def _create_atom_weights(self, weights, vectors, ndim=3):
         """
@@ -131,56 +344,100 @@ class DensityExtractor(object):
 
 
 class DensityExtractorHDF5(DensityExtractor):
+    # Quantities copied from the weights data
+    point_keys = [
+        'natoms_primitive',
+        'elements',
+        'distance',
+        'pointgroup_symbol',
+        'num_irreps',
+        'ir_labels',
+    ]
+
     def _run(self):
         band_data = self._band_data
 
-        npaths, npoints = band_data['paths'].shape[:2]
         filename_sf = 'sf.hdf5'
-        with h5py.File(filename_sf, 'w') as f:
-            self._print_header(f)
-            for ipath in range(npaths):
-                for ip in range(npoints):
-                    print(ipath, ip)
-                    group = '{}/{}/'.format(ipath, ip)
-
-                    frequencies = self._load_frequencies(group)
-                    frequencies = np.array(frequencies)
-                    if self._is_squared:
-                        energies = square_frequencies(frequencies)
-                    else:
-                        energies = frequencies
-
-                    weights = self._load_weights(group)
-
-                    spectral_functions = self.calculate_spectral_functions(energies, weights)
-
-                    self._write(f, group, spectral_functions)
-
-    def _write(self, file_out, group, spectral_functions):
-
-        keys = [
-            'natoms_primitive',
-            'elements',
-            'distance',
-            'pointgroup_symbol',
-            'num_irreps',
-            'ir_labels',
-        ]
+        with h5py.File(filename_sf, 'a' if self._resume else 'w') as f:
+            writer = BandHDF5Writer(f)
+            self.print_header(writer, band_data.get_paths())
+            tasks = []
+            for group in self._select_groups():
+                ipath, ip = parse_group_name(group)
+                if writer.is_completed(ipath, ip):
+                    print('Skip completed q-point:', ipath, ip)
+                    continue
+                tasks.append((ipath, ip))
+
+            if self._nprocs > 1:
+                results = self._run_in_parallel(tasks)
+            else:
+                results = (self.calculate_point(*task) for task in tasks)
+            for ipath, ip, data_dict in results:
+                print(ipath, ip)
+                writer.write_point(ipath, ip, data_dict)
 
-        for k in keys:
-            file_out.create_dataset(
-                group + k, data=np.array(self._band_data[group + k])
-            )
-        file_out.create_dataset(group + 'total_sf'      , data=spectral_functions['total'])
-        file_out.create_dataset(group + 'partial_sf_e'  , data=spectral_functions['E1'   ])
-        file_out.create_dataset(group + 'partial_sf_s'  , data=spectral_functions['SR'   ])
-        file_out.create_dataset(group + 'partial_sf_s_e', data=spectral_functions['SR_E1'])
+    def _run_in_parallel(self, tasks):
+        """Calculate spectral functions for q-points in worker processes.
+
+        Each worker opens the weights data by itself in the read-only mode.
+        """
+        return imap_in_workers(
+            self._nprocs, self.calculate_point, tasks,
+            initializer=self._reopen_band_data)
+
+    def _reopen_band_data(self):
+        # The file opened in the parent process must not be used after forking.
+        # It is kept open until the worker exits.
+        self._band_data = BandHDF5Reader(h5py.File(self._filename, 'r'))
+
+    def calculate_point(self, ipath, ip):
+        group = '{}/{}/'.format(ipath, ip)
+
+        frequencies = self._load_frequencies(group)
+        weights = self._load_weights(group)
+
+        data_dict = {}
+        for k in self.point_keys:
+            data_dict[k] = self._band_data.load(group, k)
+
+        return ipath, ip, self._create_data_dict(frequencies, weights, data_dict)
+
+    def create_sf_data_dict(self, point_data):
+        """Create the data of spectral functions for one q-point.
+
+        Parameters
+        ----------
+        point_data : dict
+            Data for one q-point with the same keys as "band.hdf5",
+            e.g. from "Eigenstates.get_data_dict".
+        """
+        data_dict = {k: point_data[k] for k in self.point_keys}
+        return self._create_data_dict(
+            point_data['frequencies'], extract_weights(point_data), data_dict)
+
+    def _create_data_dict(self, frequencies, weights, data_dict):
+        if self._is_squared:
+            energies = square_frequencies(frequencies)
+        else:
+            energies = frequencies
+
+        frequencies, spectral_functions = (
+            self.calculate_spectral_functions_on_points(energies, weights))
+
+        if self.is_adaptive():
+            data_dict['frequencies'] = frequencies
+        data_dict['total_sf'      ] = spectral_functions['total']
+        data_dict['partial_sf_e'  ] = spectral_functions['E1'   ]
+        data_dict['partial_sf_s'  ] = spectral_functions['SR'   ]
+        data_dict['partial_sf_s_e'] = spectral_functions['SR_E1']
         if 'E2' in spectral_functions:
-            file_out.create_dataset(group + 'partial_sf_e2' , data=spectral_functions['E2'   ])
+            data_dict['partial_sf_e2' ] = spectral_functions['E2'   ]
+        return data_dict
 
-    def _print_header(self, file_output):
+    def print_header(self, writer, paths):
         function_name = self._smearing.get_function_name()
-        sigma         = self._smearing.get_sigma()
+        sigma         = self.get_sigma()
         is_squared = self._is_squared
         if is_squared:
             unit = 'THz^2'
@@ -188,17 +445,28 @@ class DensityExtractorHDF5(DensityExtractor):
             unit = 'THz'
         frequencies = self._evaluated_energies
 
-        file_output.create_dataset('function', data=function_name)
-        file_output.create_dataset('sigma', data=sigma)  # For THz^2 or THz
-        file_output.create_dataset('is_squared', data=is_squared)
-        file_output.create_dataset('frequencies', data=frequencies)
-        file_output.create_dataset('paths', data=self._band_data['paths'])
+        file_output = writer.get_hdf5_file()
+        write_header_dataset(file_output, 'function', function_name)
+        write_header_dataset(file_output, 'sigma', sigma)  # For THz^2 or THz
+        write_header_dataset(file_output, 'is_squared', is_squared)
+        write_header_dataset(file_output, 'frequencies', frequencies)
+        if self.is_adaptive():
+            write_header_dataset(file_output, 'fpitch_fine', self._fpitch_fine)
+            write_header_dataset(
+                file_output, 'adaptive_width', self._adaptive_width)
+        writer.write_header(paths)
 
 
 class DensityExtractorText(DensityExtractor):
     def _run(self):
-        band_data = self._band_data
-        npaths, npoints = band_data['paths'].shape[:2]
+        if self._resume:
+            raise ValueError('Resuming is not supported for the text format.')
+        if self._nprocs > 1:
+            raise ValueError(
+                'Parallelization is not supported for the text format.')
+        if self._is_multi_sigma:
+            raise ValueError(
+                'Multiple sigmas are not supported for the text format.')
         fn_irreps = 'sf_SR.dat'
         fn_e1     = 'sf_E1.dat'
         fn_e2     = 'sf_E2.dat'
@@ -206,35 +474,30 @@ class DensityExtractorText(DensityExtractor):
             self._print_header(fi)
             self._print_header(fe)
             self._print_header(fe2)
-            if self._group is None:
-                for ipath in range(npaths):
-                    for ip in range(npoints):
-                        print(ipath, ip)
-                        group = '{}/{}/'.format(ipath, ip)
-                        self._run_point(group, fi, fe, fe2)
-            else:
-                self._run_point(self._group, fi, fe, fe2)
+            for group in self._select_groups():
+                print(group)
+                self._run_point(group, fi, fe, fe2)
 
     def _run_point(self, group, fi, fe, fe2):
         distance    = self._load_distance   (group)
         frequencies = self._load_frequencies(group)
         weights     = self._load_weights    (group)
 
-        frequencies = np.array(frequencies)
         if self._is_squared:
             energies = square_frequencies(frequencies)
         else:
             energies = frequencies
 
-        spectral_functions = self.calculate_spectral_functions(
-            energies, weights)
+        points, spectral_functions = (
+            self.calculate_spectral_functions_on_points(energies, weights))
 
-        self._write_irreps(fi , group, distance, spectral_functions)
-        self._write_e1    (fe , group, distance, spectral_functions)
-        self._write_e2    (fe2, group, distance, spectral_functions)
+        self._write_irreps(fi , group, distance, points, spectral_functions)
+        self._write_e1    (fe , group, distance, points, spectral_functions)
+        self._write_e2    (fe2, group, distance, points, spectral_functions)
 
-    def _write_irreps(self, file_out, group, distance, sf):
-        ir_labels = [x.decode('ascii') for x in self._band_data[group + 'ir_labels']]
+    def _write_irreps(self, file_out, group, distance, points, sf):
+        ir_labels = [
+            x.decode('ascii') for x in self._band_data.load(group, 'ir_labels')]
 
         file_out.write('# {:10s}'.format('Dist.'))
         file_out.write('{:12s}'.format('Freq. (THz)'))
@@ -243,20 +506,9 @@ class DensityExtractorText(DensityExtractor):
             file_out.write('{:12s}'.format(ir_label))
         file_out.write('\n')
 
-        frequencies = self._evaluated_energies
-        sf_total   = sf['total']
-        sf_partial = sf['SR']
-
-        for i, frequency in enumerate(frequencies):
-            file_out.write('{:12.6f}'.format(distance))
-            file_out.write('{:12.6f}'.format(frequency))
-            file_out.write('{:12.6f}'.format(sf_total[i]))
-            for v in sf_partial[i, :]:
-                file_out.write('{:12.6f}'.format(v))
-            file_out.write('\n')
-        file_out.write('\n')
+        self._write_block(file_out, distance, points, sf['total'], sf['SR'])
 
-    def _write_e1(self, file_out, group, distance, sf):
+    def _write_e1(self, file_out, group, distance, points, sf):
         elements = self._get_elements(group)
         ne = len(elements)
 
@@ -269,28 +521,21 @@ class DensityExtractorText(DensityExtractor):
                 file_out.write('{:12s}'.format(label))
         file_out.write('\n')
 
-        frequencies = self._evaluated_energies
-        sf_total   = sf['total']
-        sf_partial = sf['E1']
-
-        for i, frequency in enumerate(frequencies):
-            file_out.write('{:12.6f}'.format(distance))
-            file_out.write('{:12.6f}'.format(frequency))
-            file_out.write('{:12.6f}'.format(sf_total[i]))
-            for ie in range(ne):
-                for je in range(ie, ne):
-                    if ie == je:
-                        v = np.real(np.sum(sf_partial[i, :, ie, :, je]))
-                    else:
-                        v = np.real(
-                            np.sum(sf_partial[i, :, ie, :, je]) +
-                            np.sum(sf_partial[i, :, je, :, ie])
-                        )
-                    file_out.write('{:12.6f}'.format(float(v)))
-            file_out.write('\n')
-        file_out.write('\n')
+        # Sum over atoms for all the frequencies at once
+        sf_elements = np.sum(sf['E1'], axis=(1, 3))
+        sf_partial = []
+        for ie in range(ne):
+            for je in range(ie, ne):
+                if ie == je:
+                    v = sf_elements[:, ie, je]
+                else:
+                    v = sf_elements[:, ie, je] + sf_elements[:, je, ie]
+                sf_partial.append(np.real(v))
+        sf_partial = np.array(sf_partial).T
+
+        self._write_block(file_out, distance, points, sf['total'], sf_partial)
 
-    def _write_e2(self, file_out, group, distance, sf):
+    def _write_e2(self, file_out, group, distance, points, sf):
         elements = self._get_elements(group)
         ne = len(elements)
 
@@ -302,18 +547,27 @@ class DensityExtractorText(DensityExtractor):
             file_out.write('{:12s}'.format(label))
         file_out.write('\n')
 
-        frequencies = self._evaluated_energies
-        sf_total   = sf['total']
-        sf_partial = sf['E2']
-
-        for i, frequency in enumerate(frequencies):
-            file_out.write('{:12.6f}'.format(distance))
-            file_out.write('{:12.6f}'.format(frequency))
-            file_out.write('{:12.6f}'.format(sf_total[i]))
-            for ie in range(ne):
-                v = np.sum(sf_partial[i, :, ie])
-                file_out.write('{:12.6f}'.format(float(v)))
-            file_out.write('\n')
+        sf_partial = np.sum(sf['E2'], axis=1)  # Sum over atoms
+
+        self._write_block(file_out, distance, points, sf['total'], sf_partial)
+
+    def _write_block(self, file_out, distance, points, sf_total, sf_partial):
+        """Write the rows for all the frequencies at once.
+
+        Parameters
+        ----------
+        points : (nfreqs) array
+            Frequencies where the spectral functions are evaluated.
+        sf_total : (nfreqs) array
+        sf_partial : (nfreqs, ncolumns) array
+        """
+        data = np.column_stack((
+            np.full(points.shape, distance),
+            points,
+            sf_total,
+            sf_partial,
+        ))
+        np.savetxt(file_out, data, fmt='%12.6f', delimiter='')
         file_out.write('\n')
 
     def _print_header(self, file_output):
@@ -327,4 +581,5 @@ class DensityExtractorText(DensityExtractor):
         file_output.write('#\n')
 
     def _get_elements(self, group):
-        return [x.decode('ascii') for x in self._band_data[group + 'elements']]
+        return [
+            x.decode('ascii') for x in self._band_data.load(group, 'elements')]
@@ -4,20 +4,260 @@ from __future__ import absolute_import, division, print_function
 
 __author__ = "Yuji Ikeda"
 
+from collections import OrderedDict
+import h5py
 import numpy as np
 from phonopy.phonon.dos import TotalDos
+from upho.analysis.smearing import Smearing
+from upho.analysis.tetrahedron import create_tetrahedron_kernel
 
 
 class TotalDosUnfolding(TotalDos):
-    def __init__(self, mesh_object, sigma=None, tetrahedron_method=False):
-        TotalDos.__init__(
-            self,
-            mesh_object,
-            sigma=sigma,
-            tetrahedron_method=tetrahedron_method)
+    # Maximum number of elements of the smearing kernel created at once
+    max_kernel_size = 2 ** 22
+    # Number of tetrahedra processed at once for the tetrahedron method
+    tetrahedra_chunk_size = 1000
+
+    def __init__(self,
+                 mesh_object,
+                 sigma=None,
+                 tetrahedron_method=False,
+                 cutoff=None):
+        """
+
+        Args:
+            tetrahedron_method:
+                If True, the linear tetrahedron method on the mesh for the
+                ideal primitive cell is used, where unfolded weights are
+                also interpolated linearly within the tetrahedra.
+                Since no smearing is applied, sigma must not be given.
+            cutoff:
+                If given, the smearing function is evaluated only within
+                cutoff * sigma from each peak. See "Smearing".
+        """
+        if tetrahedron_method and sigma is not None:
+            raise ValueError(
+                'sigma cannot be given with the tetrahedron method.')
+        self._cutoff = cutoff
+        # The tetrahedron method of phonopy is for the primitive cell of
+        # the dynamical matrix and therefore not used.
+        TotalDos.__init__(self, mesh_object, sigma=sigma)
         self._pr_weights = mesh_object.get_pr_weights()
+        self._tetrahedra = None
+        if tetrahedron_method:
+            self._tetrahedra = mesh_object.get_tetrahedra()
+
+    def set_smearing_function(self, function_name):
+        TotalDos.set_smearing_function(self, function_name)
+        if function_name == 'Cauchy':
+            self._function_name = 'lorentzian'
+        else:
+            self._function_name = 'gaussian'
+
+    def run(self):
+        self._dos = self.calculate_dos(self._pr_weights)
+
+    def calculate_dos(self, pr_weights):
+        """Calculate the DOS weighted by unfolded weights.
+
+        The DOS is calculated at all the frequency points at once instead
+        of one frequency point after another.
+
+        Args:
+            pr_weights:
+                Unfolded weights with the shape of (nqpoints, ..., nbands),
+                e.g., "weights_t" for the total DOS and "weights_e2" for the
+                element-resolved partial DOS. The irreps differ among the
+                q-points, and therefore the irrep-resolved partial DOS is
+                accumulated by "DosAccumulator" instead.
+
+        Returns:
+            dos:
+                DOS with the shape of (nfreqs, ...).
+        """
+        if self._tetrahedra is not None:
+            return self._calculate_dos_by_tetrahedra(pr_weights)
+
+        smearing = Smearing(
+            function_name=self._function_name,
+            sigma=self._sigma,
+            cutoff=self._cutoff)
+        smearing.set_xs(self._frequency_points)
+
+        pr_weights = np.asarray(pr_weights)
+        nqpoints, nbands = self._frequencies.shape
+        # Weights of the irreducible q-points
+        weights_q = self._weights.reshape(
+            (-1, ) + (1, ) * (pr_weights.ndim - 1))
+
+        # Peaks for the q-points in each chunk are contracted at once.
+        # The chunks keep the kernel within "max_kernel_size".
+        chunk_size = max(
+            1, self.max_kernel_size // (len(self._frequency_points) * nbands))
+        dos = 0.0
+        for i in range(0, nqpoints, chunk_size):
+            chunk = slice(i, i + chunk_size)
+            weights = np.moveaxis(pr_weights[chunk] * weights_q[chunk], 0, -2)
+            weights = weights.reshape(weights.shape[:-2] + (-1, ))
+            dos += smearing.run(self._frequencies[chunk].reshape(-1), weights)
+        return dos / np.sum(self._weights)
+
+    def _calculate_dos_by_tetrahedra(self, pr_weights):
+        pr_weights = np.asarray(pr_weights)
+        nqpoints, nbands = self._frequencies.shape
+        shape = pr_weights.shape[1:-1]
+        # (nqpoints, nbands, nchannels)
+        weights = np.moveaxis(pr_weights, -1, 1).reshape(nqpoints, nbands, -1)
+
+        tetrahedra = self._tetrahedra
+        dos = np.zeros((len(self._frequency_points), weights.shape[-1]))
+        for i in range(0, len(tetrahedra), self.tetrahedra_chunk_size):
+            chunk = tetrahedra[i:i + self.tetrahedra_chunk_size]
+            # (ntetrahedra, nbands, 4)
+            energies = np.moveaxis(self._frequencies[chunk], 1, -1)
+            # (ntetrahedra, nbands, 4, nchannels)
+            vertex_weights = np.moveaxis(weights[chunk], 1, 2)
+            kernel = create_tetrahedron_kernel(
+                self._frequency_points, energies.reshape(-1, 4))
+            dos += kernel.dot(
+                vertex_weights.reshape(-1, vertex_weights.shape[-1]))
+        dos /= len(tetrahedra)
+        return dos.reshape(dos.shape[:1] + shape)
+
+
+class DosAccumulator(object):
+    """Accumulate the unfolded DOS and partial DOS q-point by q-point.
+
+    Only the contributions smeared on the frequency points are kept, and
+    therefore the memory usage does not depend on the number of q-points.
+    """
+    def __init__(self,
+                 sigma,
+                 fmin,
+                 fmax,
+                 fpitch,
+                 function='gaussian',
+                 cutoff=None,
+                 method='direct'):
+        """
+
+        Args:
+            function, sigma, cutoff, method:
+                Parameters of the smearing function. See "Smearing".
+        """
+        self._smearing = Smearing(
+            function_name=function,
+            sigma=sigma,
+            xmin=fmin,
+            xmax=fmax,
+            xpitch=fpitch,
+            cutoff=cutoff,
+            method=method)
+
+        nfreqs = len(self._smearing.get_xs())
+        self._sum_weights = 0.0
+        self._total_dos = np.zeros(nfreqs)
+        self._partial_dos_e2 = None
+        self._elements = None
+        # Irrep-resolved partial DOS for (pointgroup_symbol, ir_label)
+        self._partial_dos_s = OrderedDict()
+
+    def get_frequency_points(self):
+        return self._smearing.get_xs()
+
+    def calculate_point(self, data_dict):
+        """Calculate the DOS at a q-point.
+
+        The kernel of the smearing function is shared among the weights.
+
+        Args:
+            data_dict:
+                Data from "Eigenstates.get_data_dict".
+
+        Returns:
+            dos_dict:
+                'total_dos'        : (nfreqs)
+                'partial_dos_e2'   : (nfreqs, natoms_p, nelms)
+                'partial_dos_s'    : (nfreqs, nirreps)
+                'pointgroup_symbol', 'ir_labels', 'elements'
+        """
+        frequencies = np.asarray(data_dict['frequencies'])
+        nirreps = len(data_dict['ir_labels'])
+
+        kernel = self._smearing.create_kernel(frequencies.reshape(-1))
+
+        dos_dict = {
+            'pointgroup_symbol': data_dict['pointgroup_symbol'],
+            'ir_labels': data_dict['ir_labels'],
+            'elements': data_dict['elements'],
+        }
+        # The axes for the arms are moved next to those for the bands.
+        for key, key_weights in [('total_dos', 'weights_t'),
+                                 ('partial_dos_e2', 'weights_e2'),
+                                 ('partial_dos_s', 'weights_s')]:
+            weights = np.moveaxis(np.asarray(data_dict[key_weights]), 0, -2)
+            weights = weights.reshape(weights.shape[:-2] + (-1, ))
+            if key == 'partial_dos_s':
+                weights = weights[:nirreps]
+            dos_dict[key] = self._smearing.apply_kernel(kernel, weights)
+        return dos_dict
+
+    def add_point(self, dos_dict, weight=1.0):
+        """Add the DOS at a q-point with the weight of the q-point."""
+        self._sum_weights += weight
+        self._total_dos += weight * dos_dict['total_dos']
+
+        if self._partial_dos_e2 is None:
+            self._partial_dos_e2 = np.zeros_like(dos_dict['partial_dos_e2'])
+            self._elements = dos_dict['elements']
+        self._partial_dos_e2 += weight * dos_dict['partial_dos_e2']
+
+        pointgroup_symbol = np.asarray(dos_dict['pointgroup_symbol']).astype(str)
+        ir_labels = np.asarray(dos_dict['ir_labels']).astype(str)
+        for i, ir_label in enumerate(ir_labels):
+            key = (str(pointgroup_symbol), ir_label)
+            if key not in self._partial_dos_s:
+                self._partial_dos_s[key] = np.zeros_like(self._total_dos)
+            self._partial_dos_s[key] += weight * dos_dict['partial_dos_s'][:, i]
+
+    def get_data_dict(self):
+        """Get the DOS normalized by the sum of the weights of the q-points.
+
+        Returns:
+            data_dict:
+                'frequency_points'  : (nfreqs)
+                'total_dos'         : (nfreqs)
+                'partial_dos_e2'    : (nfreqs, natoms_p, nelms)
+                'elements'          : (nelms)
+                'partial_dos_s'     : (nfreqs, nkeys)
+                'pointgroup_symbols': (nkeys)
+                'ir_labels'         : (nkeys)
+        """
+        keys = list(self._partial_dos_s.keys())
+        partial_dos_s = np.zeros((len(self._total_dos), len(keys)))
+        for i, key in enumerate(keys):
+            partial_dos_s[:, i] = self._partial_dos_s[key]
+
+        data_dict = {
+            'frequency_points': self.get_frequency_points(),
+            'total_dos': self._total_dos,
+            'partial_dos_e2': self._partial_dos_e2,
+            'elements': self._elements,
+            'partial_dos_s': partial_dos_s,
+            'pointgroup_symbols': np.array([k[0] for k in keys], dtype='S'),
+            'ir_labels': np.array([k[1] for k in keys], dtype='S'),
+        }
+        for k in ['total_dos', 'partial_dos_e2', 'partial_dos_s']:
+            if data_dict[k] is not None and self._sum_weights > 0.0:
+                data_dict[k] = data_dict[k] / self._sum_weights
+        return data_dict
 
-    def _get_density_of_states_at_freq(self, f):
-        tmp = self._smearing_function.calc(self._frequencies - f)
-        tmp *= self._pr_weights
-        return np.sum(np.dot(self._weights, tmp)) / np.sum(self._weights)
+    def write_hdf5(self, filename='dos_unfolded.hdf5'):
+        with h5py.File(filename, 'w') as f:
+            for k, v in self.get_data_dict().items():
+                if v is not None:
+                    f.create_dataset(k, data=v)
+            f.create_dataset('sigma', data=self._smearing.get_sigma())
+            f.create_dataset(
+                'function', data=np.array(self._smearing.get_function_name(),
+                                          dtype='S'))
@@ -137,11 +137,11 @@ class Eigenstates(object):
         for k in weights_keys:
             weights_arms[k] = []
 
-        for i_star, (q, transformation_matrix) in enumerate(zip(q_star, transformation_matrices)):
+        for i_star, (q_arm, transformation_matrix) in enumerate(zip(q_star, transformation_matrices)):
             print("i_star:", i_star)
-            print("q_pc:", q)
+            print("q_pc:", q_arm)
             eigvals, eigvecs, weights = self._extract_eigenstates_for_q(
-                q, transformation_matrix)
+                q_arm, transformation_matrix)
 
             eigvals_arms.append(eigvals)
             for k in weights_keys:
@@ -378,15 +378,11 @@ class Eigenstates(object):
         return np.array(
             self._element_weights_calculator.get_reduced_elements(), dtype='S')
 
-    def write_hdf5(self, hdf5_file, group=''):
-        """
+    def get_max_narms(self):
+        return self._nopr
 
-        Parameters
-        ----------
-        hdf5_file : HDF5 file object
-        group : String
-            Indices for the present q-point.
-        """
+    def get_data_dict(self):
+        """Get the data for the present q-point to be stored."""
         natoms_primitive = self._cell.get_number_of_atoms()
 
         data_dict = {
@@ -406,8 +402,18 @@ class Eigenstates(object):
             'weights_s_e'      : self._weights_arms['SR_E1'],
             'weights_e2'       : self._weights_arms['E2'   ],
         }
+        return data_dict
 
-        for k, v in data_dict.items():
+    def write_hdf5(self, hdf5_file, group=''):
+        """
+
+        Parameters
+        ----------
+        hdf5_file : HDF5 file object
+        group : String
+            Indices for the present q-point.
+        """
+        for k, v in self.get_data_dict().items():
             hdf5_file.create_dataset(group + k, data=v)
 
 def calculate_frequencies(eigenvalues, factor):
@@ -4,12 +4,18 @@ from __future__ import absolute_import, division, print_function
 
 __author__ = "Yuji Ikeda"
 
+import functools
+import h5py
 import numpy as np
 from phonopy.units import VaspToTHz
 from phonopy.structure.grid_points import GridPoints
 from phonopy.phonon.mesh import Mesh
 from phonopy.structure.cells import get_primitive
 from upho.phonon.eigenstates import Eigenstates
+from upho.phonon.band_hdf5 import create_writer, write_header_dataset
+from upho.phonon.dos_unfolding import DosAccumulator
+from upho.phonon.parallel import imap_in_workers, share_force_constants
+from upho.analysis.tetrahedron import create_tetrahedra
 
 
 class MeshUnfolding(Mesh):
@@ -28,7 +34,43 @@ class MeshUnfolding(Mesh):
                  rotations=None, # Point group operations in real space
                  factor=VaspToTHz,
                  use_lapack_solver=False,
-                 mode="eigenvector"):
+                 mode="eigenvector",
+                 nprocs=1,
+                 dos=None,
+                 write_weights=False,
+                 layout="groups",
+                 compression=None):
+        """
+
+        Args:
+            nprocs:
+                Number of processes among which irreducible q-points are
+                distributed.
+            dos:
+                If given, the unfolded DOS and partial DOS are accumulated
+                on the fly and written to "dos_unfolded.hdf5". This is a dict
+                of the parameters for "DosAccumulator", e.g. "sigma", "fmin",
+                "fmax", "fpitch", "function", "cutoff", and "method".
+            write_weights:
+                If True, the weights at each irreducible q-point are written
+                to "mesh_unfolding.hdf5" in the format of "band.hdf5" with
+                one path.
+            layout:
+                Layout of "mesh_unfolding.hdf5", "groups" or "stacked".
+                See "upho.phonon.band_hdf5".
+            compression:
+                Compression filter for "mesh_unfolding.hdf5".
+
+        Eigenvectors are not stored. Frequencies and total weights are
+        stored with the shape of (nqpoints, max_narms * nbands), where the
+        arms of the star are flattened into the bands and padded with zero
+        weights.
+        """
+        if is_eigenvectors:
+            raise ValueError('Eigenvectors are not stored for unfolding.')
+        if use_lapack_solver:
+            raise ValueError(
+                '"use_lapack_solver" is not considered for unfolding.')
 
         self._mesh = np.array(mesh, dtype='intc')
         self._is_eigenvectors = is_eigenvectors
@@ -38,13 +80,10 @@ class MeshUnfolding(Mesh):
             get_primitive(unitcell_ideal, primitive_matrix_ideal))
         self._cell = primitive_ideal_wrt_unitcell
 
-        # ._dynamical_matrix must be assigned for calculating DOS
-        # using the tetrahedron method.
         # In the "DOS", this is used to get "primitive".
-        # In the "TetrahedronMesh", this is used just as the "Atoms".
-        # Currently, we must not use the tetrahedron method,
+        # The tetrahedron method of phonopy must not be used,
         # because now we do not give the primitive but the unitcell for the
-        # self._dynamical_matrix.
+        # self._dynamical_matrix. Use "get_tetrahedra" instead.
         self._dynamical_matrix = dynamical_matrix
         self._use_lapack_solver = use_lapack_solver
 
@@ -60,6 +99,7 @@ class MeshUnfolding(Mesh):
         self._weights = self._gp.get_ir_grid_weights()
 
         self._star = star
+        self._nprocs = nprocs
 
         self._eigenstates_unfolding = Eigenstates(
             dynamical_matrix,
@@ -68,11 +108,34 @@ class MeshUnfolding(Mesh):
             mode=mode,
             star=star,
             verbose=False)
+        # Distances are meaningless for the mesh.
+        self._eigenstates_unfolding.set_distance(0.0)
+
+        self._accumulator = None
+        if dos is not None:
+            self._accumulator = DosAccumulator(**dos)
 
         self._frequencies = None
         self._eigenvalues = None
         self._eigenvectors = None
-        self._set_phonon()
+        self._pr_weights = None
+
+        self._writer = None
+        if write_weights:
+            with h5py.File('mesh_unfolding.hdf5', 'w') as f:
+                self._writer = create_writer(
+                    f,
+                    layout=layout,
+                    compression=compression,
+                    max_narms=self._eigenstates_unfolding.get_max_narms())
+                self._write_hdf5_header()
+                self._set_phonon()
+            self._writer = None
+        else:
+            self._set_phonon()
+
+        if self._accumulator is not None:
+            self._accumulator.write_hdf5('dos_unfolded.hdf5')
 
         self._group_velocities = None
         if group_velocity is not None:
@@ -81,9 +144,45 @@ class MeshUnfolding(Mesh):
     def get_pr_weights(self):
         return self._pr_weights
 
+    def get_dos_accumulator(self):
+        return self._accumulator
+
+    def get_tetrahedra(self):
+        """Get the tetrahedra on the mesh for the ideal primitive cell.
+
+        Returns
+        -------
+        tetrahedra : (ntetrahedra, 4) array
+            Indices of the irreducible q-points for the vertices.
+
+        Notes
+        -----
+        Bands are connected among the q-points by their indices.
+        For star="sym", the number of the arms of the star changes among
+        the q-points, and therefore the bands cannot be connected.
+        """
+        if self._star == 'sym':
+            raise ValueError(
+                'Tetrahedron method is not available for star="sym".')
+        microzone_lattice = np.linalg.inv(self._cell.get_cell()) / self._mesh
+        tetrahedra = create_tetrahedra(
+            self._gp.get_grid_address(), self._mesh, microzone_lattice)
+
+        ir_grid_points = self._gp.get_ir_grid_points()
+        mapping_table = self._gp.get_grid_mapping_table()
+        ir_indices = np.zeros(len(mapping_table), dtype=int)
+        ir_indices[ir_grid_points] = np.arange(len(ir_grid_points))
+        return ir_indices[mapping_table[tetrahedra]]
+
+    def _write_hdf5_header(self):
+        f = self._writer.get_hdf5_file()
+        # Irreducible q-points are stored as one path.
+        self._writer.write_header(self._qpoints[None])
+        write_header_dataset(f, 'mesh', self._mesh)
+        write_header_dataset(f, 'weights', self._weights)
+
     def write_yaml(self):
         w = open('mesh.yaml', 'w')
-        eigenvalues = self._eigenvalues
         natom = self._cell.get_number_of_atoms()
         lattice = np.linalg.inv(self._cell.get_cell()) # column vectors
         w.write("mesh: [ %5d, %5d, %5d ]\n" % tuple(self._mesh))
@@ -109,44 +208,70 @@ class MeshUnfolding(Mesh):
                     w.write("    group_velocity: ")
                     w.write("[ %13.7f, %13.7f, %13.7f ]\n" %
                             tuple(self._group_velocities[i, j]))
-
-                if self._is_eigenvectors:
-                    w.write("    eigenvector:\n")
-                    for k in range(natom):
-                        w.write("    - # atom %d\n" % (k+1))
-                        for l in (0,1,2):
-                            w.write("      - [ %17.14f, %17.14f ]\n" %
-                                    (self._eigenvectors[i,k*3+l,j].real,
-                                     self._eigenvectors[i,k*3+l,j].imag))
             w.write("\n")
 
     def _set_phonon(self):
+        if self._dynamical_matrix.is_nac():
+            raise ValueError('NAC is not implemented yet for unfolding')
+
         # For the unfolding method.
-        # num_band = self._cell.get_number_of_atoms() * 3
         cell = self._dynamical_matrix.get_primitive()
         num_band = cell.get_number_of_atoms() * 3
         num_qpoints = len(self._qpoints)
+        max_narms = self._eigenstates_unfolding.get_max_narms()
+
+        self._frequencies = np.zeros(
+            (num_qpoints, max_narms * num_band), dtype='double')
+        self._pr_weights = np.zeros_like(self._frequencies)
 
-        self._eigenvalues = np.zeros((num_qpoints, num_band), dtype='double')
-        self._frequencies = np.zeros_like(self._eigenvalues)
-        # TODO(ikeda): the folling is very bad if we turn on is_star
-        self._pr_weights  = np.zeros_like(self._eigenvalues)
-        if self._is_eigenvectors or self._use_lapack_solver:
-            self._eigenvectors = np.zeros(
-                (num_qpoints, num_band, num_band,), dtype='complex128')
-
-        if self._use_lapack_solver:
-            print("ERROR: _use_lapack_solver is not considered for this script.")
-            raise ValueError
+        tasks = list(enumerate(self._qpoints))
+        if self._nprocs > 1:
+            self._solve_dm_in_parallel(tasks)
         else:
-            for i, q in enumerate(self._qpoints):
-                eigvals, eigvecs, self._pr_weights[i], nstar = (
-                    self._eigenstates_unfolding.extract_eigenstates(q)
-                )
-                self._eigenvalues[i] = eigvals.real
-                if self._is_eigenvectors:
-                    self._eigenvectors[i] = eigvecs
-            self._frequencies = np.array(np.sqrt(abs(self._eigenvalues)) *
-                                         np.sign(self._eigenvalues),
-                                         dtype='double',
-                                         order='C') * self._factor
+            for task in tasks:
+                self._set_point(*solve_dm_on_mesh_point(
+                    self._eigenstates_unfolding, self._accumulator,
+                    self._writer is not None, *task))
+
+    def _solve_dm_in_parallel(self, tasks):
+        share_force_constants(self._dynamical_matrix)
+        function = functools.partial(
+            solve_dm_on_mesh_point,
+            self._eigenstates_unfolding,
+            self._accumulator,
+            self._writer is not None)
+        # The DOS is summed up in the same order as in serial.
+        for result in imap_in_workers(self._nprocs, function, tasks):
+            self._set_point(*result)
+
+    def _set_point(self, iq, data_dict, dos_dict):
+        frequencies = np.asarray(data_dict['frequencies']).reshape(-1)
+        n = len(frequencies)
+        self._frequencies[iq, :n] = frequencies
+        self._pr_weights[iq, :n] = np.asarray(data_dict['weights_t']).reshape(-1)
+        if self._writer is not None:
+            self._writer.write_point(0, iq, data_dict)
+        if dos_dict is not None:
+            self._accumulator.add_point(dos_dict, self._weights[iq])
+
+
+def solve_dm_on_mesh_point(eigenstates, accumulator, write_weights, iq, q):
+    """Solve the dynamical matrix at an irreducible q-point.
+
+    Returns
+    -------
+    iq : int
+    data_dict : dict
+        Data from "Eigenstates". Only "frequencies" and "weights_t" are
+        included unless "write_weights".
+    dos_dict : dict
+        DOS at the q-point if "accumulator" is not None.
+    """
+    eigenstates.extract_eigenstates(q)
+    data_dict = eigenstates.get_data_dict()
+    dos_dict = None
+    if accumulator is not None:
+        dos_dict = accumulator.calculate_point(data_dict)
+    if not write_weights:
+        data_dict = {k: data_dict[k] for k in ['frequencies', 'weights_t']}
+    return iq, data_dict, dos_dict
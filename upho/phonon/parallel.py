@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import multiprocessing
+import numpy as np
+
+__author__ = 'Yuji Ikeda'
+
+
+def create_pool(nprocs, initializer=None, initargs=()):
+    """Create a pool of worker processes.
+
+    Workers are forked so that they inherit the objects of the parent
+    process, e.g. dynamical matrices, without pickling them.
+
+    Parameters
+    ----------
+    nprocs : int
+        Number of worker processes.
+    initializer : function
+        Called with "initargs" in each worker at its start.
+    """
+    context = multiprocessing.get_context('fork')
+    return context.Pool(nprocs, initializer=initializer, initargs=initargs)
+
+
+def create_shared_array(array):
+    """Copy an array to the memory shared among processes.
+
+    Forked workers map the same physical memory for the returned array
+    instead of their own copies.
+
+    Returns
+    -------
+    shared_array : ndarray
+        Array with the same contents, dtype, and shape as "array".
+    """
+    array = np.ascontiguousarray(array)
+    buffer = multiprocessing.RawArray('b', max(array.nbytes, 1))
+    shared_array = np.frombuffer(
+        buffer, dtype=array.dtype, count=array.size).reshape(array.shape)
+    shared_array[...] = array
+    return shared_array
+
+
+def share_force_constants(dynamical_matrix):
+    """Move the force constants of the dynamical matrix to shared memory.
+
+    The force constants are read-only in the workers, and therefore they
+    do not have to be copied for each worker.
+    """
+    dynamical_matrix._force_constants = create_shared_array(
+        dynamical_matrix._force_constants)
+
+
+def imap_in_workers(nprocs, function, tasks, initializer=None):
+    """Call a function for each task in worker processes.
+
+    The function, typically a bound method or a "functools.partial" object,
+    is inherited by the forked workers without pickling. Only the tasks
+    and the results are sent between the processes.
+
+    Parameters
+    ----------
+    nprocs : int
+        Number of worker processes.
+    function : callable
+        Called as "function(*task)".
+    tasks : iterable
+        Tuples of arguments.
+    initializer : callable
+        Called without arguments in each worker at its start, e.g., to
+        reopen files that must not be shared after forking.
+
+    Yields
+    ------
+    result
+        Results in the order of the tasks, and therefore the output does
+        not depend on the number of the processes.
+    """
+    with create_pool(nprocs,
+                     initializer=_init_worker,
+                     initargs=(function, initializer)) as pool:
+        for result in pool.imap(_call_in_worker, tasks):
+            yield result
+
+
+# Function inherited by the worker processes
+_function = None
+
+
+def _init_worker(function, initializer):
+    global _function
+    _function = function
+    if initializer is not None:
+        initializer()
+
+
+def _call_in_worker(task):
+    return _function(*task)
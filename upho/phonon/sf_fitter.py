@@ -2,18 +2,93 @@
 # -*- coding: utf-8 -*-
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
+import hashlib
+import itertools
+import os
 import h5py
 import numpy as np
 from scipy.optimize import curve_fit
 from upho.analysis.functions import FittingFunctionFactory
 from upho.irreps.irreps import extract_degeneracy_from_ir_label
+from upho.phonon.band_hdf5 import (
+    BandHDF5Reader, BandHDF5Writer, HEADER_KEYS, is_completed,
+    parse_group_name, write_header_dataset)
+from upho.phonon.parallel import imap_in_workers
 
 __author__ = 'Yuji Ikeda'
 
 
 class SFFitter(object):
-    def __init__(self, filename='sf.hdf5', name='gaussian'):
+    # A model with one more peak is selected only if it reduces the fitting
+    # error by this ratio.
+    multi_peak_threshold = 0.5
+
+    # Maximum number of q-points in a run for the warm start. Longer runs
+    # are split so that the fittings are distributed among the processes.
+    max_run_length = 16
+
+    def __init__(self,
+                 filename='sf.hdf5',
+                 name='gaussian',
+                 resume=False,
+                 isigma=None,
+                 nprocs=1,
+                 method='curve_fit',
+                 npeaks=1,
+                 window=None,
+                 incremental=False):
+        """
+
+        Parameters
+        ----------
+        filename : str
+            Filename of the spectral functions.
+        name : str
+            Name of the fitting function.
+        resume : bool
+            If True, the existing "sf_fit.hdf5" is reopened and only
+            q-points not yet completed are fitted.
+        isigma : int
+            Index of sigma to be fitted when the spectral functions are
+            calculated for multiple sigmas.
+        nprocs : int
+            Number of processes among which the fittings for q-points and
+            irreps are distributed.
+        method : str
+            "curve_fit": Parameters are fitted by nonlinear least squares.
+            "moments": Parameters are estimated from the moments of the
+                spectral functions without nonlinear optimization.
+            "batched": Parameters are fitted by nonlinear least squares
+                simultaneously for all the irreps and q-points on the same
+                frequency grid using "fit_levenberg_marquardt".
+        npeaks : int
+            Maximum number of peaks for each irrep (only for "batched").
+            The number of peaks is selected by the fitting errors.
+        window : float
+            If given, each fitting by "curve_fit" uses only the frequencies
+            around where the spectral function exceeds this fraction of
+            its maximum. Otherwise the whole frequencies are used.
+        incremental : bool
+            If True, results in the existing "sf_fit.hdf5" are reused for
+            q-points whose input data and fitting settings are unchanged,
+            and only the other q-points are fitted.
+        """
+        if method not in ('curve_fit', 'moments', 'batched'):
+            raise ValueError('Unknown method', method)
+        if npeaks > 1 and method != 'batched':
+            raise ValueError('Multiple peaks are fitted only by "batched".')
+        if window is not None and method != 'curve_fit':
+            raise ValueError('Windows are used only by "curve_fit".')
+        if resume and incremental:
+            raise ValueError('"resume" and "incremental" are exclusive.')
+        self._method = method
+        self._npeaks = npeaks
+        self._window = window
         self._name = name
+        self._resume = resume
+        self._isigma = isigma
+        self._nprocs = nprocs
+        self._incremental = incremental
 
         with h5py.File(filename, 'r') as f:
             self._band_data = f
@@ -22,87 +97,605 @@ class SFFitter(object):
     def _run(self):
         band_data = self._band_data
 
-        npaths, npoints = band_data['paths'].shape[:2]
         frequencies = band_data['frequencies']
         frequencies = np.array(frequencies)
+        self._frequencies = frequencies
         self._is_squared = np.array(band_data['is_squared'])
+        self._sigma = self._select_sigma(np.array(band_data['sigma']))
+
+        self._settings_hash = self._calculate_settings_hash()
 
         filename_sf = 'sf_fit.hdf5'
-        with h5py.File(filename_sf, 'w') as f:
-            self.print_header(f)
-            for ipath in range(npaths):
-                for ip in range(npoints):
-                    print(ipath, ip)
-                    group = '{}/{}/'.format(ipath, ip)
-
-                    peak_positions, widths, norms, fiterrs, sf_fittings = (
-                        self._fit_spectral_functions(
-                            frequencies,
-                            point_data=band_data[group],
-                        )
-                    )
-
-                    self._write(f, group, peak_positions, widths, norms, fiterrs, sf_fittings)
-
-    def _fit_spectral_functions(self, frequencies, point_data, prec=1e-6):
-        partial_sf_s = point_data['partial_sf_s']
-        num_irreps = np.array(point_data['num_irreps'])
-        dfreq = frequencies[1] - frequencies[0]
+        if self._incremental and os.path.isfile(filename_sf):
+            # A temporary file is used since the previous results are read.
+            # The temporary file left by an interrupted run is continued if
+            # the settings are the same.
+            filename_tmp = filename_sf + '.tmp'
+            mode = 'a' if self._is_continuable(filename_tmp) else 'w'
+            with h5py.File(filename_sf, 'r') as f_previous:
+                with h5py.File(filename_tmp, mode) as f:
+                    f.attrs['settings_hash'] = self._settings_hash
+                    self._write_results(f, f_previous)
+            os.rename(filename_tmp, filename_sf)
+        else:
+            with h5py.File(filename_sf, 'a' if self._resume else 'w') as f:
+                self._write_results(f)
 
-        fitting_function = FittingFunctionFactory(
-            name=self._name,
-            is_normalized=False).create()
-
-        peak_positions = []
-        widths         = []
-        norms          = []
-        fiterrs = []
-        sf_fittings = []
-        for i in range(num_irreps):
-            sf = partial_sf_s[:, i]
-            if np.sum(sf) < prec:
-                peak_position = np.nan
-                width         = np.nan
-                norm          = np.nan
-                fiterr = np.nan
-                sf_fitting = np.full(frequencies.shape, np.nan)
+    def _write_results(self, hdf5_file, hdf5_file_previous=None):
+        """Fit the spectral functions and write the results.
+
+        Parameters
+        ----------
+        hdf5_file_previous : HDF5 file object
+            Previous "sf_fit.hdf5" whose results are reused if possible.
+        """
+        writer = BandHDF5Writer(hdf5_file)
+        self.print_header(writer)
+        points = []
+        for ipath, ip in self._select_input_points():
+            if writer.is_completed(ipath, ip):
+                # Results in the temporary file are checked for "incremental".
+                if (hdf5_file_previous is None or self._has_same_input(
+                        hdf5_file, '{}/{}/'.format(ipath, ip))):
+                    print('Skip completed q-point:', ipath, ip)
+                    continue
+            if hdf5_file_previous is not None and self._reuse_point(
+                    writer, hdf5_file_previous, ipath, ip):
+                print('Reuse unchanged q-point:', ipath, ip)
+                continue
+            points.append((ipath, ip))
+
+        if self._method == 'curve_fit':
+            self._run_curve_fit(writer, points)
+        else:
+            self._run_blocks(writer, points)
+
+    def _select_input_points(self):
+        """Select the q-points whose spectral functions are available.
+
+        Spectral functions may be calculated only for selected q-points.
+        Files with "index" mark completed q-points, and the others are
+        regarded as interrupted. Files without "index" are written by older
+        versions, where all the existing q-points are used.
+
+        Returns
+        -------
+        points : list of (ipath, ip)
+        """
+        band_data = self._band_data
+        is_marked = 'index' in band_data
+        points = []
+        for group in BandHDF5Reader(band_data).select():
+            if group not in band_data:
+                continue
+            if is_marked and not is_completed(band_data, group):
+                print('Skip incomplete q-point:', *parse_group_name(group))
+                continue
+            points.append(parse_group_name(group))
+        return points
+
+    def _calculate_settings_hash(self):
+        """Hash the fitting settings and the header of the input file."""
+        sha = hashlib.sha1()
+        settings = (self._name, self._method, self._npeaks, self._window,
+                    self._isigma, self.multi_peak_threshold)
+        sha.update(repr(settings).encode('ascii'))
+        for k, v in sorted(self._band_data.items()):
+            if isinstance(v, h5py.Dataset) and k not in HEADER_KEYS:
+                update_hash(sha, k, v[()])
+        return sha.hexdigest()
+
+    def _calculate_input_hash(self, group):
+        """Hash the input data for the q-point and the settings."""
+        sha = hashlib.sha1()
+        sha.update(self._settings_hash.encode('ascii'))
+        for k, v in sorted(self._band_data[group].items()):
+            update_hash(sha, k, v[()])
+        return sha.hexdigest()
+
+    def _reuse_point(self, writer, hdf5_file_previous, ipath, ip):
+        """Copy the previous results if the input hash is the same.
+
+        Returns
+        -------
+        is_reused : bool
+        """
+        group = '{}/{}/'.format(ipath, ip)
+        if not self._has_same_input(hdf5_file_previous, group):
+            return False
+        point_data = hdf5_file_previous[group]
+        writer.write_point(
+            ipath, ip, {k: v[()] for k, v in point_data.items()})
+        return True
+
+    def _has_same_input(self, hdf5_file, group):
+        """Check if the results in the file are for the same input."""
+        if not is_completed(hdf5_file, group):
+            return False
+        point_data = hdf5_file[group]
+        if 'input_hash' not in point_data:
+            return False
+        input_hash = point_data['input_hash'][()].decode('ascii')
+        return input_hash == self._calculate_input_hash(group)
+
+    def _is_continuable(self, filename):
+        """Check if the file is left by an interrupted run continued now."""
+        if not os.path.isfile(filename):
+            return False
+        try:
+            with h5py.File(filename, 'r') as f:
+                settings_hash = f.attrs.get('settings_hash')
+        except (IOError, OSError):
+            return False
+        if isinstance(settings_hash, bytes):
+            settings_hash = settings_hash.decode('ascii')
+        return settings_hash == self._settings_hash
+
+    def _run_curve_fit(self, writer, points):
+        runs = self._split_into_runs(points)
+        tasks = self._create_tasks(runs)
+        if self._nprocs > 1:
+            results = self._fit_in_parallel(tasks)
+        else:
+            results = (self.fit_spectral_functions_on_run(*task)
+                       for task in tasks)
+
+        for run in runs:
+            group = '{}/{}/'.format(*run[0])
+            num_irreps = int(np.array(self._band_data[group + 'num_irreps']))
+            # Results for the irreps over the q-points of this run
+            fits_run = [next(results) for _ in range(num_irreps)]
+            for (ipath, ip), fits in zip(run, zip(*fits_run)):
+                print(ipath, ip)
+                group = '{}/{}/'.format(ipath, ip)
+                peak_positions, widths, norms, fiterrs, sf_fittings = (
+                    np.array(x) for x in zip(*fits))
+                self._write(writer, ipath, ip,
+                            peak_positions, widths, norms, fiterrs, sf_fittings,
+                            frequencies=self._load_point_frequencies(group))
+
+    def _run_blocks(self, writer, points):
+        """Obtain the parameters block by block for vectorized methods.
+
+        Spectral functions on the same frequency grid, i.e., those on the
+        same path unless the grids are adaptive, are processed at once.
+        """
+        for _, block in itertools.groupby(points, key=self._get_block_key):
+            block = list(block)
+            frequencies = None
+            partial_sf_s_block = []
+            ir_labels = []
+            for ipath, ip in block:
+                group = '{}/{}/'.format(ipath, ip)
+                frequencies = self._load_point_frequencies(group)
+                partial_sf_s = self._band_data[group + 'partial_sf_s']
+                if self._isigma is not None:
+                    partial_sf_s = partial_sf_s[self._isigma]
+                partial_sf_s_block.append(np.array(partial_sf_s))
+                ir_labels.extend(
+                    x.decode('ascii')
+                    for x in np.array(self._band_data[group + 'ir_labels']))
+            if frequencies is None:
+                frequencies = self._frequencies
+
+            # Irreps of all the q-points are concatenated.
+            sfs = np.concatenate(partial_sf_s_block, axis=1)
+            if self._method == 'moments':
+                results = self.fit_spectral_functions_by_moments(
+                    frequencies, sfs)
             else:
-                peak_position = self._create_initial_peak_position(frequencies, sf)
-                width         = self._create_initial_width()
+                results = self.fit_spectral_functions_batched(
+                    frequencies, sfs, ir_labels)
+            indices = np.cumsum([x.shape[1] for x in partial_sf_s_block])[:-1]
+            results = [np.split(x, indices) for x in results]
+            for i, (ipath, ip) in enumerate(block):
+                print(ipath, ip)
+                group = '{}/{}/'.format(ipath, ip)
+                self._write(writer, ipath, ip, *[x[i] for x in results],
+                            frequencies=self._load_point_frequencies(group))
+
+    def _get_block_key(self, point):
+        ipath, ip = point
+        if 'frequencies' in self._band_data['{}/{}/'.format(ipath, ip)]:
+            # Adaptive grids differ among q-points.
+            return ipath, ip
+        return ipath, None
+
+    def _select_sigma(self, sigma):
+        if sigma.ndim == 0:
+            if self._isigma is not None:
+                raise ValueError(
+                    'isigma is given but the spectral functions are '
+                    'calculated for only one sigma.')
+            return sigma
+        if self._isigma is None:
+            raise ValueError(
+                'isigma must be given since the spectral functions are '
+                'calculated for multiple sigmas {}.'.format(sigma))
+        return sigma[self._isigma]
+
+    def _fit_in_parallel(self, tasks):
+        """Fit spectral functions in worker processes."""
+        return imap_in_workers(
+            self._nprocs, self.fit_spectral_functions_on_run, tasks,
+            initializer=self._detach_band_data)
+
+    def _detach_band_data(self):
+        # The file opened in the parent process must not be used after forking.
+        self._band_data = None
 
-                if self._is_squared:
-                    norm = self._create_initial_norm(frequencies, sf)
-                else:
-                    ir_label = str(point_data['ir_labels'][i], encoding='ascii')
-                    norm = float(extract_degeneracy_from_ir_label(ir_label))
+    def _load_point_frequencies(self, group):
+        """Load the frequency grid stored for the q-point if adaptive."""
+        point_data = self._band_data[group]
+        if 'frequencies' in point_data:
+            return np.array(point_data['frequencies'])
+        return None
 
-                def f(x, p, w):
-                    return fitting_function(x, p, w, norm)
+    def _split_into_runs(self, points):
+        """Split q-points into runs along which fittings are warm-started.
 
-                p0 = [peak_position, width]
-                maxfev = create_maxfev(p0)
+        A run consists of consecutive q-points on the same path having
+        the same irreps, i.e., the same little group. Runs are split
+        into chunks of at most "max_run_length" q-points, each of which
+        is warm-started from its own first q-point.
+
+        Returns
+        -------
+        runs : list of lists of (ipath, ip)
+        """
+        runs = []
+        ir_labels_last = None
+        for ipath, ip in points:
+            group = '{}/{}/'.format(ipath, ip)
+            ir_labels = np.array(self._band_data[group + 'ir_labels'])
+            if (runs and runs[-1][-1] == (ipath, ip - 1) and
+                    len(runs[-1]) < self.max_run_length and
+                    np.array_equal(ir_labels, ir_labels_last)):
+                runs[-1].append((ipath, ip))
+            else:
+                runs.append([(ipath, ip)])
+            ir_labels_last = ir_labels
+        return runs
+
+    def _create_tasks(self, runs):
+        """Create the arguments of "fit_spectral_functions_on_run".
+
+        Tasks are created lazily one run after another, in the order of
+        runs and then irreps.
+        """
+        for run in runs:
+            frequencies_run = []
+            partial_sf_s_run = []
+            for ipath, ip in run:
+                group = '{}/{}/'.format(ipath, ip)
+                # Adaptive grids are stored for each q-point.
+                frequencies = self._load_point_frequencies(group)
+                if frequencies is None:
+                    frequencies = self._frequencies
+                partial_sf_s = self._band_data[group + 'partial_sf_s']
+                if self._isigma is not None:
+                    partial_sf_s = partial_sf_s[self._isigma]
+                frequencies_run.append(frequencies)
+                partial_sf_s_run.append(np.array(partial_sf_s))
+            group = '{}/{}/'.format(*run[0])
+            ir_labels = np.array(self._band_data[group + 'ir_labels'])
+            num_irreps = int(np.array(self._band_data[group + 'num_irreps']))
+            for i in range(num_irreps):
+                ir_label = str(ir_labels[i], encoding='ascii')
+                sfs = [partial_sf_s[:, i] for partial_sf_s in partial_sf_s_run]
+                yield frequencies_run, sfs, ir_label
+
+    def fit_spectral_functions_on_run(self, frequencies_run, sfs, ir_label):
+        """Fit the spectral functions for one irrep along a run of q-points.
+
+        Each fitting starts from the converged parameters at the previous
+        q-point, which follows the peak continuously along the path.
+
+        Returns
+        -------
+        fits : list
+            Results of "fit_spectral_function" for the q-points.
+        """
+        fits = []
+        initial_params = None
+        for frequencies, sf in zip(frequencies_run, sfs):
+            fit = self.fit_spectral_function(
+                frequencies, sf, ir_label, initial_params=initial_params)
+            if not np.isnan(fit[0]):
+                initial_params = fit[:2]
+            fits.append(fit)
+        return fits
+
+    def fit_spectral_function(self, frequencies, sf, ir_label,
+                              initial_params=None, prec=1e-6):
+        """Fit the spectral function for one irrep.
+
+        Parameters
+        ----------
+        initial_params : (peak_position, width)
+            Initial guess, e.g. converged parameters at the neighboring
+            q-point. If None or if the fitting from it fails, the initial
+            guess is created from "sf".
+
+        Returns
+        -------
+        peak_position, width, norm, fiterr : float
+        sf_fitting : array
+            Fitted spectral function.
+        """
+        if np.sum(sf) < prec:
+            return (np.nan, np.nan, np.nan, np.nan,
+                    np.full(frequencies.shape, np.nan))
+
+        # Intervals of the frequencies, which may be non-uniform.
+        dfreqs = np.gradient(frequencies)
+
+        factory = FittingFunctionFactory(name=self._name, is_normalized=False)
+        fitting_function = factory.create()
+        fitting_jacobian = factory.create_jacobian()
+
+        if self._is_squared:
+            norm = self._create_initial_norm(frequencies, sf)
+        else:
+            norm = float(extract_degeneracy_from_ir_label(ir_label))
+
+        def f(x, p, w):
+            return fitting_function(x, p, w, norm)
+
+        def jac(x, p, w):
+            # Only the peak position and the width are fitted.
+            return fitting_jacobian(x, p, w, norm)[:, :2]
+
+        # Only the model in the window is evaluated in the fitting.
+        window = self._create_window(sf)
+        frequencies_window = frequencies[window]
+        sf_window = sf[window]
+
+        p0_cold = [
+            self._create_initial_peak_position(frequencies, sf),
+            self._create_initial_width(),
+        ]
+        p0s = [p0_cold]
+        if initial_params is not None:
+            p0s.insert(0, list(initial_params))
+        for i, p0 in enumerate(p0s):
+            maxfev = create_maxfev(p0)
+            try:
                 fit_params, pcov = curve_fit(
-                    f, frequencies, sf, p0=p0, maxfev=maxfev)
-                fiterr = np.sqrt(np.sum((f(frequencies, *fit_params) - sf) ** 2)) * dfreq
+                    f, frequencies_window, sf_window,
+                    p0=p0, jac=jac, maxfev=maxfev)
+                break
+            except RuntimeError:
+                # The cold start is tried if the warm start fails.
+                if i == len(p0s) - 1:
+                    raise
+
+        sf_fitting = f(frequencies, *fit_params)
+        fiterr = np.sqrt(np.sum(((sf_fitting - sf) * dfreqs) ** 2))
 
-                peak_position = fit_params[0]
-                width         = fit_params[1]
-                norm          = fit_params[2] if len(fit_params) == 3 else norm
-                sf_fitting = f(frequencies, *fit_params)
+        peak_position = fit_params[0]
+        width         = fit_params[1]
+        norm          = fit_params[2] if len(fit_params) == 3 else norm
+        width, norm = make_widths_positive(width, norm)
+
+        return peak_position, width, norm, fiterr, sf_fitting
+
+    def fit_spectral_functions_by_moments(self, frequencies, sfs, prec=1e-6):
+        """Estimate the parameters from the moments of the spectral functions.
+
+        The norm is the integral.
+        For Gaussian, the peak position and the width are obtained from the
+        mean and the standard deviation.
+        For Lorentzian, whose moments diverge, they are obtained from the
+        median and the quartiles, which are at (peak position +/- width).
+
+        Parameters
+        ----------
+        frequencies : (nfreqs) array
+        sfs : (nfreqs, n) array
+            Spectral functions, e.g., for irreps.
+
+        Returns
+        -------
+        peak_positions, widths, norms, fiterrs : (n) arrays
+        sf_fittings : (n, nfreqs) array
+            Spectral functions with the estimated parameters.
+        """
+        sfs = np.asarray(sfs)
+        # Intervals of the frequencies, which may be non-uniform.
+        dfreqs = np.gradient(frequencies)
+        fitting_function = FittingFunctionFactory(
+            name=self._name, is_normalized=False).create()
 
-            peak_positions.append(peak_position)
-            widths        .append(width)
-            norms         .append(norm)
-            fiterrs.append(fiterr)
-            sf_fittings.append(sf_fitting)
+        is_valid = np.sum(sfs, axis=0) >= prec
+        densities = sfs * dfreqs[:, None]
+        norms = np.sum(densities, axis=0)
+        norms_tmp = np.where(is_valid, norms, 1.0)
+        if self._name == 'lorentzian':
+            cdfs = np.cumsum(densities, axis=0) / norms_tmp
+            peak_positions = interpolate_quantiles(frequencies, cdfs, 0.5)
+            widths = 0.5 * (
+                interpolate_quantiles(frequencies, cdfs, 0.75) -
+                interpolate_quantiles(frequencies, cdfs, 0.25))
+        else:
+            peak_positions = np.dot(frequencies, densities) / norms_tmp
+            variances = np.sum(
+                (frequencies[:, None] - peak_positions) ** 2 * densities,
+                axis=0) / norms_tmp
+            # Width is HWHM.
+            widths = np.sqrt(2.0 * np.log(2.0) * variances)
+        widths = np.where(is_valid, widths, 1.0)
 
-        peak_positions = np.array(peak_positions)
-        widths         = np.array(widths)
-        norms          = np.array(norms)
-        fiterrs = np.asarray(fiterrs)
-        sf_fittings = np.asarray(sf_fittings)
+        sf_fittings = fitting_function(
+            frequencies[:, None], peak_positions, widths, norms)
+        fiterrs = np.sqrt(np.sum(
+            ((sf_fittings - sfs) * dfreqs[:, None]) ** 2, axis=0))
 
-        return peak_positions, widths, norms, fiterrs, sf_fittings
+        results = [peak_positions, widths, norms, fiterrs, sf_fittings.T]
+        for x in results:
+            x[~is_valid] = np.nan
+        return results
+
+    def fit_spectral_functions_batched(self, frequencies, sfs, ir_labels,
+                                       prec=1e-6):
+        """Fit the spectral functions simultaneously.
+
+        The initial guess and the norms are the same as those of
+        "fit_spectral_function" without warm start. The spectral functions
+        for which the fittings fail are fitted by "fit_spectral_function".
+
+        Parameters
+        ----------
+        frequencies : (nfreqs) array
+        sfs : (nfreqs, n) array
+        ir_labels : (n) list of str
+            Labels of the irreps for "sfs".
+
+        Returns
+        -------
+        peak_positions, widths, norms, fiterrs : (n) arrays
+        sf_fittings : (n, nfreqs) array
+            Fitted spectral functions.
+        """
+        sfs = np.asarray(sfs)
+        dfreqs = np.gradient(frequencies)
+        factory = FittingFunctionFactory(name=self._name, is_normalized=False)
+        fitting_function = factory.create()
+        fitting_jacobian = factory.create_jacobian()
+
+        is_valid = np.sum(sfs, axis=0) >= prec
+        if self._is_squared:
+            norms = np.sum(sfs * dfreqs[:, None], axis=0)
+        else:
+            norms = np.array([
+                float(extract_degeneracy_from_ir_label(x)) for x in ir_labels])
+
+        peak_positions = frequencies[np.argmax(sfs, axis=0)]
+        # See "_create_initial_peak_position".
+        peak_positions[np.abs(peak_positions) < 1e-12] = 0.0
+        widths = np.full(len(norms), self._create_initial_width())
+
+        def jacobian(x, p, w, norm):
+            # Only the peak position and the width are fitted.
+            return fitting_jacobian(x, p, w, norm)[..., :2]
+
+        params = np.stack((peak_positions, widths), axis=-1)
+        params[is_valid], is_converged = fit_levenberg_marquardt(
+            fitting_function, jacobian, frequencies, sfs[:, is_valid],
+            params[is_valid], args=(norms[is_valid], ))
+        peak_positions, widths = params.T
+        widths, norms = make_widths_positive(widths, norms)
+
+        sf_fittings = fitting_function(
+            frequencies[:, None], peak_positions, widths, norms)
+        fiterrs = np.sqrt(np.sum(
+            ((sf_fittings - sfs) * dfreqs[:, None]) ** 2, axis=0))
+
+        results = [peak_positions, widths, norms, fiterrs, sf_fittings.T]
+        for x in results:
+            x[~is_valid] = np.nan
+
+        # Failed fittings are redone one by one as without "batched".
+        failed = np.flatnonzero(is_valid)[~is_converged]
+        if len(failed) > 0:
+            print('Warning: {} fittings did not converge and are redone by '
+                  'curve_fit.'.format(len(failed)))
+        for i in failed:
+            fit = self.fit_spectral_function(frequencies, sfs[:, i], ir_labels[i])
+            for x, y in zip(results, fit):
+                x[i] = y
+
+        if self._npeaks > 1:
+            results = self._add_peaks(frequencies, sfs, results)
+        return results
+
+    def _add_peaks(self, frequencies, sfs, results, prec=1e-6):
+        """Add peaks to the single-peak fittings.
+
+        A peak is added at the maximum of the residual, and then all the
+        peaks are fitted jointly with their own norms. This is repeated
+        while the fitting error is reduced by "multi_peak_threshold" and
+        the reduction is larger than "prec" times the integral.
+
+        Parameters
+        ----------
+        results : list
+            Results of the single-peak fittings.
+
+        Returns
+        -------
+        peak_positions, widths, norms : (n, npeaks) arrays
+            Sorted by the peak positions and padded with NaN.
+        fiterrs : (n) array
+        sf_fittings : (n, nfreqs) array
+        """
+        peak_positions, widths, norms, fiterrs, sf_fittings = results
+        dfreqs = np.gradient(frequencies)
+        factory = FittingFunctionFactory(name=self._name, is_normalized=False)
+        fitting_function = factory.create()
+        fitting_jacobian = factory.create_jacobian()
+
+        # (n, npeaks, 3) array of peak positions, widths, and norms
+        params = np.full((len(fiterrs), self._npeaks, 3), np.nan)
+        params[:, 0] = np.stack((peak_positions, widths, norms), axis=-1)
+        width = self._create_initial_width()
+        height = fitting_function(0.0, 0.0, width, 1.0)
+
+        active = np.flatnonzero(~np.isnan(fiterrs))
+        for npeaks in range(2, self._npeaks + 1):
+            if len(active) == 0:
+                break
+            residuals = sfs[:, active] - sf_fittings[active].T
+            indices = np.argmax(residuals, axis=0)
+            params_new = np.stack((
+                frequencies[indices],
+                np.full(len(active), width),
+                residuals[indices, np.arange(len(active))] / height,
+            ), axis=-1)
+            p0 = np.concatenate((
+                params[active, :npeaks - 1].reshape(len(active), -1),
+                params_new), axis=1)
+
+            function, jacobian = create_multi_peak_functions(
+                fitting_function, fitting_jacobian, npeaks)
+            params_fit, is_converged = fit_levenberg_marquardt(
+                function, jacobian, frequencies, sfs[:, active], p0)
+            sf_fittings_tmp = function(frequencies[:, None], *params_fit.T)
+            fiterrs_tmp = np.sqrt(np.sum(
+                ((sf_fittings_tmp - sfs[:, active]) * dfreqs[:, None]) ** 2,
+                axis=0))
+
+            integrals = np.sum(np.abs(sfs[:, active]) * dfreqs[:, None], axis=0)
+            is_selected = (
+                is_converged &
+                (fiterrs_tmp <
+                 (1.0 - self.multi_peak_threshold) * fiterrs[active]) &
+                (fiterrs[active] - fiterrs_tmp > prec * integrals))
+            selected = active[is_selected]
+            params[selected, :npeaks] = (
+                params_fit[is_selected].reshape(-1, npeaks, 3))
+            fiterrs[selected] = fiterrs_tmp[is_selected]
+            sf_fittings[selected] = sf_fittings_tmp[:, is_selected].T
+            active = selected
+
+        params[..., 1], params[..., 2] = make_widths_positive(
+            params[..., 1], params[..., 2])
+        # NaN are sorted to the end.
+        order = np.argsort(params[..., 0], axis=1)
+        params = params[np.arange(len(params))[:, None], order]
+        return [params[..., 0], params[..., 1], params[..., 2],
+                fiterrs, sf_fittings]
+
+    def _create_window(self, sf):
+        """Create the slice of the frequencies used for the fitting.
+
+        The window covers the frequencies where "sf" exceeds the fraction
+        "window" of its maximum, and one more point on each side.
+        """
+        if self._window is None:
+            return slice(None)
+        indices = np.flatnonzero(sf > self._window * np.max(sf))
+        return slice(max(indices[0] - 1, 0), indices[-1] + 2)
 
     def _create_initial_peak_position(self, frequencies, sf, prec=1e-12):
         position = frequencies[np.argmax(sf)]
@@ -118,18 +711,23 @@ class SFFitter(object):
         return width
 
     def _create_initial_norm(self, frequencies, sf):
-        dfreq = frequencies[1] - frequencies[0]
-        norm = np.sum(sf) * dfreq
+        norm = np.sum(sf * np.gradient(frequencies))
         return norm
 
-    def print_header(self, file_output):
-        file_output.create_dataset('function'  , data=self._name)
-        file_output.create_dataset('is_squared', data=self._is_squared)
-        file_output.create_dataset('paths'     , data=self._band_data['paths'])
-        file_output['frequencies'] = self._band_data['frequencies'][...]
+    def print_header(self, writer):
+        file_output = writer.get_hdf5_file()
+        write_header_dataset(file_output, 'function'  , self._name)
+        write_header_dataset(file_output, 'method', self._method)
+        write_header_dataset(file_output, 'npeaks', self._npeaks)
+        write_header_dataset(file_output, 'is_squared', self._is_squared)
+        write_header_dataset(file_output, 'sigma', self._sigma)
+        write_header_dataset(file_output, 'frequencies',
+                             self._band_data['frequencies'][...])
+        writer.write_header(self._band_data['paths'][...])
 
-    def _write(self, file_out, group_name, peak_positions_s, widths_s, norms_s, fiterrs, sf_fittings):
-        group = file_out.create_group(group_name)
+    def _write(self, writer, ipath, ip, peak_positions_s, widths_s, norms_s, fiterrs, sf_fittings,
+               frequencies=None):
+        group_name = '{}/{}/'.format(ipath, ip)
 
         keys = [
             'natoms_primitive',
@@ -140,18 +738,174 @@ class SFFitter(object):
             'ir_labels',
         ]
 
+        data_dict = {}
         for k in keys:
-            file_out.create_dataset(
-                group_name + k, data=np.array(self._band_data[group_name + k])
-            )
-        group.create_dataset('peaks_s', data=peak_positions_s)
-        group.create_dataset('widths_s', data=widths_s)
-        group.create_dataset('norms_s', data=norms_s)
-        group['fitting_errors'] = fiterrs
-        group['partial_sf_s'] = sf_fittings
-        group['total_sf'] = np.nansum(sf_fittings, axis=0)
+            data_dict[k] = np.array(self._band_data[group_name + k])
+        data_dict['peaks_s'] = peak_positions_s
+        if peak_positions_s.ndim == 2:
+            # Multiple peaks are padded with NaN.
+            data_dict['num_peaks_s'] = np.sum(
+                ~np.isnan(peak_positions_s), axis=1)
+        data_dict['widths_s'] = widths_s
+        data_dict['norms_s'] = norms_s
+        data_dict['fitting_errors'] = fiterrs
+        data_dict['partial_sf_s'] = sf_fittings
+        data_dict['total_sf'] = np.nansum(sf_fittings, axis=0)
+        if frequencies is not None:
+            data_dict['frequencies'] = frequencies
+        data_dict['input_hash'] = np.array(
+            self._calculate_input_hash(group_name), dtype='S')
+
+        writer.write_point(ipath, ip, data_dict)
+
+
+def interpolate_quantiles(xs, cdfs, q):
+    """Find the points where the cumulative distributions reach q.
+
+    Parameters
+    ----------
+    xs : (nxs) array
+    cdfs : (nxs, n) array
+        Nondecreasing cumulative distributions.
+
+    Returns
+    -------
+    quantiles : (n) array
+    """
+    n = cdfs.shape[1]
+    upper = np.clip(np.argmax(cdfs >= q, axis=0), 1, len(xs) - 1)
+    columns = np.arange(n)
+    c0 = cdfs[upper - 1, columns]
+    c1 = cdfs[upper, columns]
+    dc = np.where(c1 > c0, c1 - c0, 1.0)
+    fractions = np.clip((q - c0) / dc, 0.0, 1.0)
+    return xs[upper - 1] + fractions * (xs[upper] - xs[upper - 1])
+
+
+def fit_levenberg_marquardt(function, jacobian, xs, ys, p0, args=(),
+                            xtol=1.49012e-08, ftol=1.49012e-08,
+                            max_iterations=1000):
+    """Solve independent least-squares problems simultaneously.
+
+    Each problem has its own damping parameter and is removed from the
+    iterations once converged or once the damping parameter blows up,
+    i.e., no step reduces the sum of squares.
+
+    Parameters
+    ----------
+    function : callable
+        function(xs, *params, *args) gives (nxs, n) values when xs is
+        (nxs, 1) and params and args are (n) arrays.
+    jacobian : callable
+        Takes the same arguments as "function" and gives the derivatives
+        w.r.t. params as (nxs, n, nparams) array.
+    xs : (nxs) array
+    ys : (nxs, n) array
+    p0 : (n, nparams) array
+        Initial guess.
+    args : tuple of (n) arrays
+        Fixed parameters.
+    xtol, ftol : float
+        Tolerances for the relative changes of params and of the sum of
+        squares. The defaults are the same as "curve_fit".
+
+    Returns
+    -------
+    params : (n, nparams) array
+    is_converged : (n) array of bool
+        False if not converged within "max_iterations" or if failed.
+    """
+    xs = np.asarray(xs)[:, None]
+    params = np.array(p0, dtype=float)
+    n, nparams = params.shape
+    dampings = np.full(n, 1e-3)
+    is_converged = np.zeros(n, dtype=bool)
+    active = np.arange(n)
+
+    def calculate_residuals(indices, p):
+        arguments = tuple(p.T) + tuple(a[indices] for a in args)
+        return function(xs, *arguments) - ys[:, indices], arguments
+
+    for _ in range(max_iterations):
+        if len(active) == 0:
+            break
+        p = params[active]
+        residuals, arguments = calculate_residuals(active, p)
+        costs = np.sum(residuals ** 2, axis=0)
+        jac = jacobian(xs, *arguments)
+        # Normal equations with the damping scaled by the diagonal
+        a = np.einsum('xni,xnj->nij', jac, jac)
+        g = np.einsum('xni,xn->ni', jac, residuals)
+        diagonal = np.diagonal(a, axis1=1, axis2=2)
+        diagonal = np.where(diagonal > 0.0, diagonal, 1.0)
+        a_damped = a + dampings[active, None, None] * (
+            diagonal[:, :, None] * np.eye(nparams))
+        deltas = np.linalg.solve(a_damped, -g[..., None])[..., 0]
+
+        p_trial = p + deltas
+        residuals_trial = calculate_residuals(active, p_trial)[0]
+        costs_trial = np.sum(residuals_trial ** 2, axis=0)
+
+        is_accepted = costs_trial < costs
+        params[active[is_accepted]] = p_trial[is_accepted]
+        dampings[active] = np.where(
+            is_accepted, dampings[active] * 0.1, dampings[active] * 10.0)
+
+        is_done = is_accepted & (
+            (np.linalg.norm(deltas, axis=1) <=
+             xtol * (xtol + np.linalg.norm(p, axis=1))) |
+            (costs - costs_trial <= ftol * costs))
+        is_converged[active[is_done]] = True
+        # The fitting has failed since no further improvement is possible.
+        is_failed = dampings[active] > 1e16
+        active = active[~(is_done | is_failed)]
+
+    return params, is_converged
+
+
+def create_multi_peak_functions(function, jacobian, npeaks):
+    """Create the sum of peaks and its Jacobian.
+
+    Parameters
+    ----------
+    function, jacobian : callable
+        Unnormalized fitting function and its Jacobian for one peak.
+
+    Returns
+    -------
+    multi_peak_function, multi_peak_jacobian : callable
+        These take (position, width, norm) of the peaks one after another.
+    """
+    def multi_peak_function(x, *params):
+        return sum(function(x, *params[3 * i:3 * i + 3])
+                   for i in range(npeaks))
+
+    def multi_peak_jacobian(x, *params):
+        return np.concatenate([jacobian(x, *params[3 * i:3 * i + 3])
+                               for i in range(npeaks)], axis=-1)
+
+    return multi_peak_function, multi_peak_jacobian
+
+
+def make_widths_positive(widths, norms):
+    """Make the widths positive without changing the fitting functions.
+
+    The fitting functions are odd with respect to both the width and the
+    norm, and are therefore unchanged when both signs are flipped.
+    """
+    signs = np.where(np.asarray(widths) < 0.0, -1.0, 1.0)
+    return np.abs(widths), signs * norms
+
+
+def update_hash(sha, key, value):
+    """Update the hash with the name and the value of a dataset."""
+    value = np.ascontiguousarray(value)
+    sha.update(key.encode('ascii'))
+    sha.update(str(value.dtype).encode('ascii'))
+    sha.update(repr(value.shape).encode('ascii'))
+    sha.update(value.tobytes())
 
 
 def create_maxfev(p0):
     maxfev = 20000 * (len(p0) + 1)
-    return maxfev
\ No newline at end of file
+    return maxfev
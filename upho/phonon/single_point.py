@@ -5,6 +5,7 @@ from __future__ import (absolute_import, division,
 import h5py
 from phonopy.units import VaspToTHz
 from upho.phonon.eigenstates import Eigenstates
+from upho.phonon.band_hdf5 import mark_completed
 
 __author__ = "Yuji Ikeda"
 
@@ -48,3 +49,4 @@ class SinglePoint(object):
         eigenstates.extract_eigenstates(qpoint)
 
         eigenstates.write_hdf5(self._hdf5_file, group='')
+        mark_completed(self._hdf5_file)